@@ -11,6 +11,7 @@ import os
 import random
 import re
 import time
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Dict, Set
 
@@ -147,6 +148,50 @@ def embed_func(idx: int, content: str, *, num_perm: int) -> Dict[str, Any]:
     return {"__signature__": m.hashvalues, "__id__": idx}
 
 
+@lru_cache(maxsize=None)
+def open_signatures(path: str) -> np.memmap:
+    """
+    Map the shared signature matrix, once per process.
+
+    Parameters
+    ----------
+    path : str
+        The `.npy` file of the `(records, num_perm)` matrix.
+
+    Returns
+    -------
+    np.memmap
+        The writable matrix.
+    """
+    return np.load(path, mmap_mode="r+")
+
+
+def embed_func_shared(idx: int, content: str, *, num_perm: int, path: str) -> Dict[str, Any]:
+    """
+    Embed the content of a record and write its signature into the row `idx` of the shared
+    signature matrix, instead of returning it. The pages of the memory-mapped file are shared by
+    all processes, so the signatures never go through an Arrow cache file.
+
+    Parameters
+    ----------
+    idx : int
+        The index of the record.
+    content : str
+        The content to embed.
+    num_perm : int
+        The number of permutations to use in the MinHash object.
+    path : str
+        The `.npy` file of the matrix, preallocated with `np.lib.format.open_memmap`.
+
+    Returns
+    -------
+    Dict[str, Any]
+        Nothing, so that no cache file is written.
+    """
+    open_signatures(path)[idx] = embed_func(idx, content, num_perm=num_perm)["__signature__"]
+    return {}
+
+
 def query_func(idx: int, signature: np.ndarray, *, index: MinHashLSH) -> Dict[str, Any]:
     """
     Query the MinHashLSH index for the record. This function can be used with multiprocessing
@@ -175,6 +220,27 @@ def query_func(idx: int, signature: np.ndarray, *, index: MinHashLSH) -> Dict[st
     }
 
 
+def query_func_shared(idx: int, *, index: MinHashLSH, path: str) -> Dict[str, Any]:
+    """
+    Like `query_func`, with the signature read from the shared signature matrix.
+
+    Parameters
+    ----------
+    idx : int
+        The index of the record.
+    index : MinHashLSH
+        The MinHashLSH index.
+    path : str
+        The `.npy` file of the matrix written by `embed_func_shared`.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The query result.
+    """
+    return query_func(idx, open_signatures(path)[idx], index=index)
+
+
 def jaccard_similarity(code1: str, code2: str) -> float:
     """
     Calculate the jaccard similarity between two code snippets.
@@ -218,6 +284,9 @@ if __name__ == "__main__":
         verbose: bool = typer.Option(False, "--verbose", "-v", help="Verbose logging"),
         output: str = typer.Option(None, help="Store the deduplicated dataset"),
         lfs: bool = typer.Option(False, help="Use LFS files"),
+        shared_signatures: bool = typer.Option(
+            False, help="Fingerprinting workers write the signatures into one memory-mapped matrix"
+        ),
     ):
         global dup_ids
 
@@ -262,14 +331,30 @@ if __name__ == "__main__":
         DATA_SIZE = len(ds)
         start_time = time.time()
 
-        embedded = ds.map(
-            function=embed_func,
-            fn_kwargs={"num_perm": conf["num_perm"]},
-            input_columns=["__id__", conf["column"]],
-            remove_columns=[conf["column"]],
-            num_proc=os.cpu_count(),
-            desc=f"Fingerprinting...",
-        )
+        if shared_signatures:
+            # the records are only queried by id, their signatures are read from the shared matrix
+            signatures_path = str(OUTPUT_BASE / "signatures.npy")
+            np.lib.format.open_memmap(signatures_path, mode="w+", dtype=np.uint64, shape=(DATA_SIZE, num_perm))
+            open_signatures.cache_clear()
+            ds.map(
+                function=embed_func_shared,
+                fn_kwargs={"num_perm": conf["num_perm"], "path": signatures_path},
+                input_columns=["__id__", conf["column"]],
+                remove_columns=ds.column_names,
+                num_proc=os.cpu_count(),
+                load_from_cache_file=False,
+                desc=f"Fingerprinting...",
+            )
+            embedded = ds.remove_columns([name for name in ds.column_names if name != "__id__"])
+        else:
+            embedded = ds.map(
+                function=embed_func,
+                fn_kwargs={"num_perm": conf["num_perm"]},
+                input_columns=["__id__", conf["column"]],
+                remove_columns=[conf["column"]],
+                num_proc=os.cpu_count(),
+                desc=f"Fingerprinting...",
+            )
 
         duplicate_results = []
         for _, benchmark in enumerate(DATASETS_TO_CHECK):
@@ -301,13 +386,12 @@ if __name__ == "__main__":
                     session.insert(record["__id__"], LeanMinHash(seed=MINHASH_SEED, hashvalues=record["__signature__"]))
 
             queried = embedded.map(
-                function=lambda x, y: query_func(x, y, index=globals()[benchmark["index"]]),
+                function=(lambda x: query_func_shared(x, index=globals()[benchmark["index"]], path=signatures_path))
+                if shared_signatures
+                else (lambda x, y: query_func(x, y, index=globals()[benchmark["index"]])),
                 num_proc=os.cpu_count(),
-                input_columns=[
-                    "__id__",
-                    "__signature__",
-                ],
-                remove_columns=["__signature__"],
+                input_columns=["__id__"] if shared_signatures else ["__id__", "__signature__"],
+                remove_columns=[] if shared_signatures else ["__signature__"],
                 desc="Querying...",
                 features=Features(
                     {
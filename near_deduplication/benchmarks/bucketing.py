@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory and wall time of the dict-of-sets LSH tables against the sort-based bucketer.
+
+Run from `near_deduplication/`:
+
+    python -m benchmarks.bucketing --num-docs 200000
+"""
+from __future__ import annotations
+
+import logging
+import time
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+import typer
+
+from minhash_deduplication import UnionFind
+from utils.bucketing import band_keys
+from utils.bucketing import bucket_edges
+from utils.lsh import optimal_param
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def planted_signatures(num_docs: int, num_perm: int, dup_rate: float, seed: int = 42) -> np.ndarray:
+    """
+    Random 32-bit signatures in which a fraction of the rows copy part of an earlier row.
+
+    Parameters
+    ----------
+    num_docs : int
+        The number of signatures.
+    num_perm : int
+        The number of permutations.
+    dup_rate : float
+        The fraction of near-duplicate rows.
+    seed : int
+        The random seed.
+
+    Returns
+    -------
+    np.ndarray
+        The `(num_docs, num_perm)` signature matrix.
+    """
+    rng = np.random.RandomState(seed)
+    signatures = rng.randint(0, 2**32, size=(num_docs, num_perm), dtype=np.uint64)
+    dups = np.flatnonzero(rng.rand(num_docs) < dup_rate)
+    dups = dups[dups > 0]
+    sources = rng.randint(0, dups)
+    same = rng.rand(len(dups), num_perm) < 0.8
+    signatures[dups] = np.where(same, signatures[sources], signatures[dups])
+    return signatures
+
+
+def dict_bucketing(signatures: np.ndarray, hashranges) -> np.ndarray:
+    tables = [defaultdict(set) for _ in hashranges]
+    swapped = signatures.astype(">u8")
+    for key, sig in enumerate(swapped):
+        for (start, end), table in zip(hashranges, tables):
+            table[sig[start:end].tobytes()].add(key)
+    uf = UnionFind(len(signatures))
+    for table in tables:
+        src, dst = [], []
+        for cluster in table.values():
+            if len(cluster) <= 1:
+                continue
+            idx = min(cluster)
+            src.extend(cluster)
+            dst.extend([idx] * len(cluster))
+        uf.union_pairs(np.array(src), np.array(dst))
+    return uf.cluster_ids()
+
+
+def sort_bucketing(signatures: np.ndarray, hashranges) -> np.ndarray:
+    keys = np.ascontiguousarray(band_keys(signatures, hashranges).T)
+    ids = np.arange(len(signatures))
+    uf = UnionFind(len(signatures))
+    for band in keys:
+        uf.union_pairs(*bucket_edges(band, ids))
+    return uf.cluster_ids()
+
+
+if __name__ == "__main__":
+
+    def run(
+        num_docs: int = typer.Option(200_000, help="Number of synthetic signatures"),
+        num_perm: int = typer.Option(256, help="Number of permutations"),
+        threshold: float = typer.Option(0.7, help="Minhash threshold"),
+        dup_rate: float = typer.Option(0.3, help="Fraction of planted near-duplicates"),
+    ):
+        logging.basicConfig(level=logging.INFO)
+        B, R = optimal_param(threshold, num_perm)
+        hashranges = [(i * R, (i + 1) * R) for i in range(B)]
+        signatures = planted_signatures(num_docs, num_perm, dup_rate)
+
+        PAD = 32
+        results = {}
+        for name, func in [("dict", dict_bucketing), ("sort", sort_bucketing)]:
+            tracemalloc.start()
+            start = time.time()
+            results[name] = func(signatures, hashranges)
+            elapsed = time.time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            logger.info(f"{name:<{PAD}}: {elapsed:.2f} seconds, peak {peak / 2**20:.1f} MB")
+        logger.info(f"{'Identical clusters':<{PAD}}: {np.array_equal(results['dict'], results['sort'])}")
+        logger.info(f"{'Kept':<{PAD}}: {len(np.unique(results['sort']))} / {num_docs}")
+
+    typer.run(run)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Size of the LSH band payload (what the dict tables hold and what Spark shuffles) and the resulting
+collisions for the legacy uint64 bands, the uint32 bands and b-bit truncated bands.
+
+Run from `near_deduplication/`:
+
+    python -m benchmarks.compact --num-docs 100000
+"""
+from __future__ import annotations
+
+import logging
+import pickle
+
+import numpy as np
+import typer
+
+from benchmarks.bucketing import planted_signatures
+from minhash_deduplication import UnionFind
+from utils.bucketing import band_keys
+from utils.bucketing import bucket_edges
+from utils.bucketing import truncate_signatures
+from utils.lsh import optimal_param
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+if __name__ == "__main__":
+
+    def run(
+        num_docs: int = typer.Option(100_000, help="Number of synthetic signatures"),
+        num_perm: int = typer.Option(256, help="Number of permutations"),
+        threshold: float = typer.Option(0.7, help="Minhash threshold"),
+        dup_rate: float = typer.Option(0.3, help="Fraction of planted near-duplicates"),
+        sample: int = typer.Option(1000, help="Documents used to measure the pickled shuffle records"),
+    ):
+        logging.basicConfig(level=logging.INFO)
+        B, R = optimal_param(threshold, num_perm)
+        hashranges = [(i * R, (i + 1) * R) for i in range(B)]
+        signatures = planted_signatures(num_docs, num_perm, dup_rate)
+        ids = np.arange(num_docs)
+
+        PAD = 12
+        logger.info(f"{B=}, {R=}, {num_docs} documents")
+        logger.info(f"{'Signatures':<{PAD}}: uint64 {num_perm * 8} B/doc, uint32 {num_perm * 4} B/doc")
+        logger.info(
+            f"{'band bits':<{PAD}} {'band B/doc':>12} {'shuffle B/doc':>14} {'edges':>10} {'kept':>10} "
+            f"{'P(candidate | J=0.5)':>21}"
+        )
+        for band_bits in [64, 32, 16, 8]:
+            truncated = truncate_signatures(signatures[:sample], band_bits)
+            # what the Spark scripts shuffle: pickled (band_idx, band bytes, idx) tuples
+            records = [
+                (band_idx, sig[start:end].tobytes(), idx)
+                for idx, sig in enumerate(truncated)
+                for band_idx, (start, end) in enumerate(hashranges)
+            ]
+            shuffle = len(pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL)) / sample
+            band = B * R * np.dtype(truncated.dtype).itemsize
+
+            keys = band_keys(signatures, hashranges, band_bits)
+            uf = UnionFind(num_docs)
+            edges = 0
+            for col in range(B):
+                src, dst = bucket_edges(keys[:, col], ids)
+                edges += len(src)
+                uf.union_pairs(src, dst)
+            kept = len(np.unique(uf.cluster_ids()))
+            # two rows agree with probability J, or by accident on the kept bits
+            row = 0.5 + 0.5 * 2.0 ** -min(band_bits, 32)
+            candidate = 1 - (1 - row**R) ** B
+            logger.info(f"{band_bits:<{PAD}} {band:>12} {shuffle:>14.0f} {edges:>10} {kept:>10} {candidate:>21.5f}")
+
+    typer.run(run)
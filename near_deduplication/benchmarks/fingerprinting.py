@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fingerprinting throughput of the per-document `embed_func` against `embed_func_batched`, with both hash schemes.
+
+Run from `near_deduplication/`:
+
+    python -m benchmarks.fingerprinting --num-docs 2000
+"""
+from __future__ import annotations
+
+import logging
+import time
+
+import numpy as np
+import typer
+
+from minhash_deduplication import MERSENNE_PRIME
+from minhash_deduplication import embed_func
+from minhash_deduplication import embed_func_batched
+from utils.lsh import optimal_param
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def synthetic_corpus(num_docs: int, doc_length: int, vocab_size: int = 5000, seed: int = 42):
+    """
+    Generate random code-like documents, with varying lengths.
+
+    Parameters
+    ----------
+    num_docs : int
+        The number of documents.
+    doc_length : int
+        The average number of tokens per document.
+    vocab_size : int
+        The number of distinct tokens.
+    seed : int
+        The random seed.
+
+    Returns
+    -------
+    List[str]
+        The documents.
+    """
+    rng = np.random.RandomState(seed)
+    vocab = np.array([f"tok{i}" for i in range(vocab_size)])
+    lengths = rng.randint(1, 2 * doc_length, size=num_docs)
+    return [" = ".join(vocab[rng.randint(0, vocab_size, size=n)]) for n in lengths]
+
+
+if __name__ == "__main__":
+
+    def run(
+        num_docs: int = typer.Option(2000, help="Number of synthetic documents"),
+        doc_length: int = typer.Option(500, help="Average number of tokens per document"),
+        ngram_size: int = typer.Option(5, help="The ngram size to use for MinHash"),
+        num_perm: int = typer.Option(256, help="Number of permutations"),
+        threshold: float = typer.Option(0.7, help="Minhash threshold"),
+        batch_size: int = typer.Option(1000, help="Number of documents fingerprinted at once"),
+    ):
+        logging.basicConfig(level=logging.INFO)
+        rng = np.random.RandomState(42)
+        permutations = np.array(
+            [
+                (rng.randint(1, MERSENNE_PRIME, dtype=np.uint64), rng.randint(0, MERSENNE_PRIME, dtype=np.uint64))
+                for _ in range(num_perm)
+            ],
+            dtype=np.uint64,
+        ).T
+        B, R = optimal_param(threshold, num_perm)
+        hashranges = [(i * R, (i + 1) * R) for i in range(B)]
+        docs = synthetic_corpus(num_docs, doc_length)
+        size_mb = sum(len(doc.encode("utf-8")) for doc in docs) / 2**20
+
+        start = time.time()
+        expected = [
+            embed_func(
+                doc,
+                i,
+                num_perm=num_perm,
+                ngram_size=ngram_size,
+                hashranges=hashranges,
+                permutations=permutations,
+            )["__signatures__"]
+            for i, doc in enumerate(docs)
+        ]
+        elapsed = {"embed_func": time.time() - start}
+
+        start = time.time()
+        actual = []
+        for i in range(0, num_docs, batch_size):
+            actual.extend(
+                embed_func_batched(
+                    docs[i : i + batch_size],
+                    list(range(i, min(i + batch_size, num_docs))),
+                    ngram_size=ngram_size,
+                    hashranges=hashranges,
+                    permutations=permutations,
+                    band_bits=64,
+                )["__signatures__"]
+            )
+        elapsed["embed_func_batched"] = time.time() - start
+
+        start = time.time()
+        for i in range(0, num_docs, batch_size):
+            embed_func_batched(
+                docs[i : i + batch_size],
+                list(range(i, min(i + batch_size, num_docs))),
+                ngram_size=ngram_size,
+                hashranges=hashranges,
+                permutations=permutations,
+                hash_scheme="rolling",
+            )
+        elapsed["embed_func_batched (rolling)"] = time.time() - start
+
+        PAD = 32
+        logger.info(f"{'Documents':<{PAD}}: {num_docs} ({size_mb:.2f} MB)")
+        for name, seconds in elapsed.items():
+            logger.info(f"{name:<{PAD}}: {num_docs / seconds:.1f} docs/s, {size_mb / seconds:.2f} MB/s")
+        logger.info(f"{'Speedup':<{PAD}}: {elapsed['embed_func'] / elapsed['embed_func_batched']:.2f}x")
+        logger.info(f"{'Identical signatures':<{PAD}}: {actual == expected}")
+
+    typer.run(run)
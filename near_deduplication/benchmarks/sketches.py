@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Recall and precision of classic MinHash against one-permutation hashing (OPH) on a corpus with
+planted near-duplicates, using the same banding as the deduplication script.
+
+Every base document gets a few copies with a random fraction of their tokens replaced. A pair is a
+true duplicate when the exact Jaccard similarity of its shingle sets reaches the threshold, and a
+predicted one when it shares at least one band.
+
+Run from `near_deduplication/`:
+
+    python -m benchmarks.sketches --num-bases 500
+"""
+from __future__ import annotations
+
+import logging
+import time
+from itertools import combinations
+
+import numpy as np
+import typer
+
+from benchmarks.fingerprinting import synthetic_corpus
+from minhash_deduplication import MERSENNE_PRIME
+from minhash_deduplication import embed_func_batched
+from minhash_deduplication import shingle_hashes
+from utils.bucketing import band_keys
+from utils.lsh import optimal_param
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def planted_corpus(num_bases: int, num_copies: int, doc_length: int, max_edit: float, seed: int = 42):
+    """
+    Base documents followed by edited copies of them.
+
+    Parameters
+    ----------
+    num_bases : int
+        The number of base documents.
+    num_copies : int
+        The number of copies of each base document.
+    doc_length : int
+        The average number of tokens per document.
+    max_edit : float
+        The largest fraction of tokens replaced in a copy.
+    seed : int
+        The random seed.
+
+    Returns
+    -------
+    Tuple[List[str], List[int]]
+        The documents and the base document each one comes from.
+    """
+    rng = np.random.RandomState(seed)
+    docs = synthetic_corpus(num_bases, doc_length, seed=seed)
+    groups = list(range(num_bases))
+    for base in range(num_bases):
+        tokens = docs[base].split(" ")
+        for _ in range(num_copies):
+            edited = list(tokens)
+            for pos in np.flatnonzero(rng.rand(len(edited)) < rng.uniform(0, max_edit)):
+                edited[pos] = f"edit{rng.randint(1 << 30)}"
+            docs.append(" ".join(edited))
+            groups.append(base)
+    return docs, groups
+
+
+def jaccard(a: set, b: set) -> float:
+    return len(a & b) / max(1, len(a | b))
+
+
+if __name__ == "__main__":
+
+    def run(
+        num_bases: int = typer.Option(500, help="Number of base documents"),
+        num_copies: int = typer.Option(3, help="Near-duplicates planted per base document"),
+        doc_length: int = typer.Option(300, help="Average number of tokens per document"),
+        max_edit: float = typer.Option(0.3, help="Largest fraction of tokens edited in a copy"),
+        ngram_size: int = typer.Option(5, help="The ngram size to use for MinHash"),
+        num_perm: int = typer.Option(256, help="Number of permutations"),
+        threshold: float = typer.Option(0.7, help="Minhash threshold"),
+    ):
+        logging.basicConfig(level=logging.INFO)
+        rng = np.random.RandomState(42)
+        permutations = np.array(
+            [
+                (rng.randint(1, MERSENNE_PRIME, dtype=np.uint64), rng.randint(0, MERSENNE_PRIME, dtype=np.uint64))
+                for _ in range(num_perm)
+            ],
+            dtype=np.uint64,
+        ).T
+        B, R = optimal_param(threshold, num_perm)
+        hashranges = [(i * R, (i + 1) * R) for i in range(B)]
+        docs, groups = planted_corpus(num_bases, num_copies, doc_length, max_edit)
+        shingles = [set(shingle_hashes(doc, ngram_size, 5).tolist()) for doc in docs]
+
+        positives = set()
+        for i, j in combinations(range(len(docs)), 2):
+            if groups[i] == groups[j] and jaccard(shingles[i], shingles[j]) >= threshold:
+                positives.add((i, j))
+
+        PAD = 12
+        logger.info(f"{B=}, {R=}, {len(docs)} documents, {len(positives)} pairs above {threshold}")
+        logger.info(f"{'sketch':<{PAD}} {'seconds':>8} {'candidates':>11} {'recall':>8} {'precision':>10}")
+        for sketch in ["minhash", "oph"]:
+            start = time.time()
+            signatures = embed_func_batched(
+                docs,
+                list(range(len(docs))),
+                ngram_size=ngram_size,
+                hashranges=hashranges,
+                permutations=permutations,
+                output="signatures",
+                sketch=sketch,
+            )["__signature__"]
+            elapsed = time.time() - start
+
+            keys = band_keys(signatures, hashranges)
+            predicted = set()
+            for band in keys.T:
+                buckets = {}
+                for idx, key in enumerate(band.tolist()):
+                    buckets.setdefault(key, []).append(idx)
+                for members in buckets.values():
+                    predicted.update(combinations(members, 2))
+            hits = sum(jaccard(shingles[i], shingles[j]) >= threshold for i, j in predicted)
+            recall = len(predicted & positives) / max(1, len(positives))
+            precision = hits / max(1, len(predicted))
+            logger.info(f"{sketch:<{PAD}} {elapsed:>8.2f} {len(predicted):>11} {recall:>8.3f} {precision:>10.3f}")
+
+    typer.run(run)
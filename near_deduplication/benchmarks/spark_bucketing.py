@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shuffle volume and time of the LSH bucketing of `minhash_deduplication_spark.py` in Spark local
+mode: the RDD bucketing of pickled `(band_idx, band bytes, idx)` tuples against the DataFrame
+bucketing of `(band, band_hash, __id__)` columns from `mapInPandas`.
+
+The shuffle bytes are read from the REST API of the Spark UI, as the total `shuffleWriteBytes` of
+the stages that each setting ran. Both settings must find the same edges.
+
+The RDD bucketing that the scripts used before is kept here as the baseline only. It hashes with
+the same `minhash_signature` and `truncate_signatures` as the DataFrame bucketing, and only the
+layout of the shuffled records differs.
+
+Run from `near_deduplication/`, with PySpark and Java available:
+
+    python -m benchmarks.spark_bucketing --num-bases 2000
+"""
+from __future__ import annotations
+
+import json
+import logging
+import time
+import urllib.request
+from functools import partial
+from typing import List
+from typing import Tuple
+
+import numpy as np
+import typer
+from pyspark import SparkConf
+from pyspark.sql import SparkSession
+
+from benchmarks.fingerprinting import synthetic_corpus
+from benchmarks.sketches import planted_corpus
+from minhash_deduplication_spark import MERSENNE_PRIME
+from minhash_deduplication_spark import minhash_signature
+from utils.bucketing import truncate_signatures
+from utils.lsh import optimal_param
+from utils.spark import BAND_SCHEMA
+from utils.spark import band_edges
+from utils.spark import band_frames
+from utils.spark import bucket_table
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def generate_hash_values(
+    content: str,
+    idx: int,
+    num_perm: int,
+    ngram_size: int,
+    hashranges: List[Tuple[int, int]],
+    permutations: np.ndarray,
+    min_ngram_size: int,
+    band_bits: int = 32,
+    sketch: str = "minhash",
+) -> List[Tuple[int, bytes, int]]:
+    """
+    Generate the MinHashLSH values for a given document, as tuples for the RDD bucketing baseline.
+
+    Parameters
+    ----------
+    content : str
+        The content of the document.
+    idx : int
+        The index of the document.
+    num_perm : int
+        The number of permutations.
+    ngram_size : int
+        The size of the n-grams.
+    hashranges : list
+        The ranges of offsets for each hash value.
+    permutations : np.ndarray
+        The permutations for the hash values.
+    min_ngram_size : int
+        The minimum number of items in the sequence to generate n-grams.
+    band_bits : int
+        The number of bits per hash value in the band bytes that are shuffled, see `truncate_signatures`.
+    sketch : str
+        `minhash` for classic MinHash, or `oph` for one-permutation hashing with densification.
+
+    Returns
+    -------
+    List[Tuple[int, bytes, int]]
+        The list of (band_idx, hash value, idx) for the document.
+    """
+    hashvalues = minhash_signature(content, num_perm, ngram_size, permutations, min_ngram_size, sketch)
+    hashvalues = truncate_signatures(hashvalues, band_bits)
+    Hs = [hashvalues[start:end].tobytes() for start, end in hashranges]
+    return [(band_idx, H, idx) for band_idx, H in enumerate(Hs)]
+
+
+def generate_edges(nodes: List[int]) -> List[Tuple[int, int]]:
+    """
+    Generate edges from a cluster. Instead of generating N^2 edges, we only need all nodes align to a single node, since
+    we will be running connected components on the edges later.
+
+    Parameters
+    ----------
+    nodes : List[int]
+        The list of nodes in the cluster.
+
+    Returns
+    -------
+    List[Tuple[int, int]]
+        The list of edges.
+    """
+    if len(nodes) <= 1:
+        return []
+
+    min_node = min(nodes)
+    return [(n, min_node) for n in nodes if n != min_node]
+
+
+def shuffle_write_bytes(spark: SparkSession) -> int:
+    """
+    The bytes written by the shuffles of all completed stages so far.
+    """
+    sc = spark.sparkContext
+    url = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}/stages?status=complete"
+    with urllib.request.urlopen(url) as response:
+        return sum(stage["shuffleWriteBytes"] for stage in json.load(response))
+
+
+if __name__ == "__main__":
+
+    def run(
+        num_bases: int = typer.Option(2000, help="Number of base documents"),
+        num_copies: int = typer.Option(3, help="Near-duplicates planted per base document"),
+        num_unique: int = typer.Option(20000, help="Documents without any near-duplicate"),
+        doc_length: int = typer.Option(300, help="Average number of tokens per document"),
+        ngram_size: int = typer.Option(5, help="The ngram size to use for MinHash"),
+        num_perm: int = typer.Option(256, help="Number of permutations"),
+        threshold: float = typer.Option(0.7, help="Minhash threshold"),
+        partitions: int = typer.Option(64, help="Number of partitions of the documents"),
+    ):
+        logging.basicConfig(level=logging.INFO)
+        docs, _ = planted_corpus(num_bases, num_copies, doc_length, max_edit=0.2)
+        docs += synthetic_corpus(num_unique, doc_length, seed=7)
+        rng = np.random.RandomState(42)
+        permutations = np.array(
+            [
+                (rng.randint(1, MERSENNE_PRIME, dtype=np.uint64), rng.randint(0, MERSENNE_PRIME, dtype=np.uint64))
+                for _ in range(num_perm)
+            ],
+            dtype=np.uint64,
+        ).T
+        B, R = optimal_param(threshold, num_perm)
+        hashranges = [(i * R, (i + 1) * R) for i in range(B)]
+
+        conf = SparkConf().set("spark.sql.shuffle.partitions", str(partitions))
+        spark = SparkSession.builder.master("local[*]").config(conf=conf).getOrCreate()
+        records = spark.createDataFrame(list(enumerate(docs)), schema="__id__ long, content string")
+        records = records.repartition(partitions).cache()
+        records.count()
+
+        def rdd_bucketing():
+            return (
+                records.rdd.flatMap(
+                    lambda x: generate_hash_values(
+                        content=x[1],
+                        idx=x[0],
+                        num_perm=num_perm,
+                        ngram_size=ngram_size,
+                        hashranges=hashranges,
+                        permutations=permutations,
+                        min_ngram_size=5,
+                    )
+                )
+                .groupBy(lambda x: (x[0], x[1]))
+                .flatMap(lambda x: generate_edges([i[2] for i in x[1]]))
+                .distinct()
+                .collect()
+            )
+
+        def dataframe_bucketing():
+            signature = partial(
+                minhash_signature, num_perm=num_perm, ngram_size=ngram_size, permutations=permutations, min_ngram_size=5
+            )
+            bands = records.mapInPandas(
+                lambda frames: band_frames(frames, "content", signature, hashranges), schema=BAND_SCHEMA
+            )
+            return [tuple(row) for row in band_edges(bucket_table(bands)).select("src", "dst").collect()]
+
+        PAD = 12
+        logger.info(f"{len(docs)} documents, {B=}, {R=}")
+        logger.info(f"{'bucketing':<{PAD}} {'seconds':>8} {'shuffle MB':>11} {'edges':>8}")
+        results = {}
+        for name, bucketing in [("rdd", rdd_bucketing), ("dataframe", dataframe_bucketing)]:
+            before = shuffle_write_bytes(spark)
+            start = time.time()
+            results[name] = set(bucketing())
+            elapsed = time.time() - start
+            # the listener of the UI catches up with the last stages asynchronously
+            time.sleep(2)
+            shuffled = shuffle_write_bytes(spark) - before
+            logger.info(f"{name:<{PAD}} {elapsed:>8.2f} {shuffled / 2**20:>11.2f} {len(results[name]):>8}")
+        assert results["rdd"] == results["dataframe"], "the two bucketings found different edges"
+        spark.stop()
+
+    typer.run(run)
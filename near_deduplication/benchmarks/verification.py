@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+End-to-end cost and quality of LSH with and without exact Jaccard verification of the candidate
+pairs, on a corpus with planted near-duplicates (see `benchmarks.sketches`).
+
+Every setting fingerprints, bands, buckets and clusters the corpus like the deduplication script;
+verified settings also shingle the candidates again and drop the pairs below the threshold. The
+precision is the fraction of merged pairs that reach the threshold, the recall the fraction of
+planted pairs above the threshold that end up in the same cluster. Like in real corpora, most
+documents have no near-duplicate, so only a fraction of them are shingled again.
+
+Run from `near_deduplication/`:
+
+    python -m benchmarks.verification --num-bases 500
+"""
+from __future__ import annotations
+
+import logging
+import time
+from itertools import combinations
+
+import numpy as np
+import typer
+
+from benchmarks.fingerprinting import synthetic_corpus
+from benchmarks.sketches import planted_corpus
+from minhash_deduplication import MERSENNE_PRIME
+from minhash_deduplication import UnionFind
+from minhash_deduplication import embed_func_batched
+from minhash_deduplication import shingle_func_batched
+from utils.bucketing import bucket_edges
+from utils.jaccard import jaccard
+from utils.jaccard import pair_jaccard
+from utils.lsh import optimal_param
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def deduplicate(docs, num_perm: int, ngram_size: int, threshold: float, verify: bool):
+    """
+    Cluster the documents, and return the cluster ids with the merged pairs.
+    """
+    rng = np.random.RandomState(42)
+    permutations = np.array(
+        [
+            (rng.randint(1, MERSENNE_PRIME, dtype=np.uint64), rng.randint(0, MERSENNE_PRIME, dtype=np.uint64))
+            for _ in range(num_perm)
+        ],
+        dtype=np.uint64,
+    ).T
+    B, R = optimal_param(threshold, num_perm)
+    hashranges = [(i * R, (i + 1) * R) for i in range(B)]
+    ids = np.arange(len(docs))
+    keys = embed_func_batched(
+        docs, ids.tolist(), ngram_size=ngram_size, hashranges=hashranges, permutations=permutations, output="keys"
+    )["__keys__"]
+    edges = [bucket_edges(band, ids) for band in keys.T]
+    pairs = np.unique(
+        np.concatenate([(src.astype(np.uint64) << np.uint64(32)) | dst.astype(np.uint64) for src, dst in edges])
+    )
+    src, dst = (pairs >> np.uint64(32)).astype(np.int64), (pairs & np.uint64(0xFFFFFFFF)).astype(np.int64)
+    if verify:
+        candidates = np.union1d(src, dst)
+        shingles = shingle_func_batched([docs[i] for i in candidates], ngram_size=ngram_size, min_ngram_size=5)
+        shingles = shingles["__shingles__"]
+        offsets = np.cumsum([0] + [len(s) for s in shingles])
+        similarity = pair_jaccard(
+            np.concatenate(shingles), offsets, np.searchsorted(candidates, src), np.searchsorted(candidates, dst)
+        )
+        src, dst = src[similarity >= threshold], dst[similarity >= threshold]
+    uf = UnionFind(len(docs))
+    uf.union_pairs(src, dst)
+    return uf.cluster_ids(), list(zip(src.tolist(), dst.tolist())), (B, R)
+
+
+if __name__ == "__main__":
+
+    def run(
+        num_bases: int = typer.Option(500, help="Number of base documents"),
+        num_copies: int = typer.Option(3, help="Near-duplicates planted per base document"),
+        num_unique: int = typer.Option(8000, help="Documents without any near-duplicate"),
+        doc_length: int = typer.Option(300, help="Average number of tokens per document"),
+        max_edit: float = typer.Option(0.4, help="Largest fraction of tokens edited in a copy"),
+        ngram_size: int = typer.Option(5, help="The ngram size to use for MinHash"),
+        threshold: float = typer.Option(0.7, help="Minhash threshold"),
+    ):
+        logging.basicConfig(level=logging.INFO)
+        docs, groups = planted_corpus(num_bases, num_copies, doc_length, max_edit)
+        docs += synthetic_corpus(num_unique, doc_length, seed=7)
+        groups += [-1 - i for i in range(num_unique)]
+        shingles = shingle_func_batched(docs, ngram_size=ngram_size, min_ngram_size=5)["__shingles__"]
+        positives = [
+            (i, j)
+            for i, j in combinations(range(len(groups) - num_unique), 2)
+            if groups[i] == groups[j] and jaccard(shingles[i], shingles[j]) >= threshold
+        ]
+
+        PAD = 16
+        logger.info(f"{len(docs)} documents, {len(positives)} pairs above {threshold}")
+        logger.info(f"{'setting':<{PAD}} {'(b, r)':>9} {'seconds':>8} {'speedup':>8} {'recall':>7} {'precision':>10}")
+        baseline = None
+        for num_perm, verify in [(256, False), (128, False), (64, False), (128, True), (64, True)]:
+            start = time.time()
+            clusters, merged, (B, R) = deduplicate(docs, num_perm, ngram_size, threshold, verify)
+            elapsed = time.time() - start
+            baseline = baseline or elapsed
+            recall = sum(clusters[i] == clusters[j] for i, j in positives) / max(1, len(positives))
+            precision = sum(jaccard(shingles[i], shingles[j]) >= threshold for i, j in merged) / max(1, len(merged))
+            name = f"{num_perm}{' verified' if verify else ''}"
+            logger.info(
+                f"{name:<{PAD}} {f'({B}, {R})':>9} {elapsed:>8.2f} {baseline / elapsed:>7.2f}x "
+                f"{recall:>7.3f} {precision:>10.3f}"
+            )
+
+    typer.run(run)
@@ -3,13 +3,17 @@
 # @Author  : Chenghao Mou (mouchenghao@gmail.com)
 
 import argparse
-import math
 import re
 import sys
 import time
 import warnings
+from functools import partial
 from logging import Logger
+from pathlib import Path
+from typing import Any
+from typing import Dict
 from typing import List
+from typing import Optional
 from typing import Set
 from typing import Tuple
 
@@ -24,7 +28,31 @@ with warnings.catch_warnings():
     from pyspark.sql import DataFrame
     from pyspark.sql import SparkSession
     from pyspark.sql import functions as F
-    from scipy.integrate import quad as integrate
+
+# shared with the single-node script, shipped to the cluster with `--py-files`
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from utils.lsh import optimal_param  # noqa: E402
+from utils.shingling import rolling_shingle_hashes  # noqa: E402
+from utils.signature_store import store_metadata  # noqa: E402
+from utils.sketches import SKETCHES  # noqa: E402
+from utils.sketches import densify_table  # noqa: E402
+from utils.sketches import oph_signatures  # noqa: E402
+from utils.spark import BAND_SCHEMA  # noqa: E402
+from utils.spark import band_edges  # noqa: E402
+from utils.spark import band_frames  # noqa: E402
+from utils.spark import best_duplicates  # noqa: E402
+from utils.spark import bucket_table  # noqa: E402
+from utils.spark import candidate_shingles  # noqa: E402
+from utils.spark import content_key  # noqa: E402
+from utils.spark import document_signatures  # noqa: E402
+from utils.spark import duplicates_of_reference  # noqa: E402
+from utils.spark import heavy_buckets  # noqa: E402
+from utils.spark import oversized_buckets  # noqa: E402
+from utils.spark import read_signatures  # noqa: E402
+from utils.spark import stored_band_frames  # noqa: E402
+from utils.spark import verified_edges  # noqa: E402
+from utils.spark import write_parquet  # noqa: E402
+from utils.spark import write_signatures  # noqa: E402
 
 SEED = 42
 RNG = np.random.RandomState(SEED)
@@ -34,33 +62,6 @@ MAX_HASH = 4_294_967_295  # maximum 32-bit unsigned integer
 MOD_PRIME = 4_294_967_291  # maximum 32-bit prime number
 
 
-def generate_edges(nodes: List[int]) -> List[Tuple[int, int]]:
-    """
-    Generate edges from a cluster. Instead of generating N^2 edges, we only need all nodes align to a single node, since
-    we will be running connected components on the edges later.
-
-    Parameters
-    ----------
-    nodes : List[int]
-        The list of nodes in the cluster.
-
-    Returns
-    -------
-    List[Tuple[int, int]]
-        The list of edges.
-
-    Examples
-    --------
-    >>> generate_edges([1, 2, 3])
-    [(2, 1), (3, 1)]
-    """
-    if len(nodes) <= 1:
-        return []
-
-    min_node = min(nodes)
-    return [(n, min_node) for n in nodes if n != min_node]
-
-
 # region: Hashing
 def ngrams(content: str, n: int, min_length: int = 5) -> Set[int]:
     """
@@ -97,168 +98,167 @@ def ngrams(content: str, n: int, min_length: int = 5) -> Set[int]:
     return {xxhash.xxh32_intdigest(n) for n in ng}
 
 
-def generate_hash_values(
-    content: str,
-    idx: int,
-    num_perm: int,
-    ngram_size: int,
-    min_length: int,
-    hashranges: List[Tuple[int, int]],
-    permutations: Tuple[npt.NDArray[DTYPE], npt.NDArray[DTYPE]],
-) -> List[Tuple[int, bytes, int]]:
+def rolling_ngrams(content: str, n: int, min_length: int = 5) -> npt.NDArray[DTYPE]:
     """
-    Generate the MinHashLSH values for a given document.
+    Same shingles as `ngrams`, but hashed with a rolling combination of the token hashes instead of
+    joining each n-gram into a string. The hash values differ from the ones of `ngrams`.
+
+    Parameters
+    ----------
+    content : str
+        The content of the document.
+    n : int
+        The length of each ngram.
+    min_length : int, optional
+        The minimum length of each ngram, by default 5
+
+    Returns
+    -------
+    np.ndarray
+        The distinct ngram hash values.
+
+    Examples
+    --------
+    >>> len(rolling_ngrams("a b c d", 2, min_length=1))
+    3
+    >>> len(rolling_ngrams("a b c d", 2, min_length=5))
+    0
+    >>> len(rolling_ngrams("a b", 3, min_length=1))
+    1
+    """
+    tokens: List[str] = NON_ALPHA.split(content.lower())
+    if len(tokens) < min_length:
+        return np.empty(0, dtype=DTYPE)
+    return rolling_shingle_hashes(tokens, n, xxhash.xxh32_intdigest, pad_short=True).astype(DTYPE)
+
+
+def shingle_set(content: str, ngram_size: int, min_length: int, hash_scheme: str = "xxh32") -> npt.NDArray[DTYPE]:
+    """
+    The shingle hashes of a document as a sorted array, the set that MinHash approximates.
 
     Parameters
     ----------
     content : str
         The content of the document.
-    idx : int
-        The index of the document.
-    num_perm : int
-        The number of permutations.
     ngram_size : int
         The size of the n-grams.
     min_length : int
         The minimum number of tokens in a document.
-    hashranges : list
-        The ranges of offsets for each hash value.
-    permutations : Tuple[np.ndarray, np.ndarray]
-        The permutations for the hash values.
+    hash_scheme : str
+        `xxh32` to hash the joined n-gram strings (`ngrams`), or `rolling` (`rolling_ngrams`).
 
     Returns
     -------
-    List[Tuple[int, bytes, int]]
-        The list of (band_idx, hash value, idx) for the document.
+    np.ndarray
+        The sorted unique shingle hashes.
 
     Examples
     --------
-    >>> content = "hello world"
-    >>> idx = 0
-    >>> num_perm = 250
-    >>> ngram_size = 1
-    >>> hashranges = [(i, i + 25) for i in range(0, 250, 25)]
-    >>> PERMUTATIONS = (
-    ...     RNG.randint(1, MOD_PRIME, size=(num_perm,), dtype=DTYPE),
-    ...     RNG.randint(0, MOD_PRIME, size=(num_perm,), dtype=DTYPE),
-    ... )
-    >>> res = generate_hash_values(content, idx, num_perm, ngram_size, 0, hashranges, PERMUTATIONS)
-    >>> len(res)
-    10
-    >>> sum(len(h) for _, h, _ in res) == len(res) * 25 * np.dtype(DTYPE).itemsize
+    >>> shingle_set("a b c a b", 2, min_length=1).tolist() == sorted(ngrams("a b c a b", 2, min_length=1))
     True
     """
-    a, b = permutations
-    hashes = np.array(list(ngrams(content, ngram_size, min_length)), dtype=DTYPE)
-    p_hashes = ((np.outer(hashes, a) + b) % MOD_PRIME) & MAX_HASH
-    min_hashes = np.vstack([p_hashes, np.full(num_perm, MAX_HASH, dtype=DTYPE)]).min(axis=0)
-    return [(band_idx, min_hashes[start:end].data.tobytes(), idx) for band_idx, (start, end) in enumerate(hashranges)]
-
-
-# endregion
+    if hash_scheme == "rolling":
+        return rolling_ngrams(content, ngram_size, min_length)
+    return np.sort(np.array(list(ngrams(content, ngram_size, min_length)), dtype=DTYPE))
 
 
-# region: MinHashLSH
-def optimal_param(
-    threshold: float,
+def minhash_signature(
+    content: str,
     num_perm: int,
-    false_positive_weight: float = 0.5,
-    false_negative_weight: float = 0.5,
-):
+    ngram_size: int,
+    min_length: int,
+    permutations: Tuple[npt.NDArray[DTYPE], npt.NDArray[DTYPE]],
+    sketch: str = "minhash",
+    hash_scheme: str = "xxh32",
+) -> npt.NDArray[DTYPE]:
     """
-    Compute the optimal `MinHashLSH` parameter that minimizes the weighted sum
-    of probabilities of false positive and false negative, taken from datasketch.
+    The MinHash signature of a document.
 
     Parameters
     ----------
-    threshold : float
-        The threshold for similarity.
+    content : str
+        The content of the document.
     num_perm : int
         The number of permutations.
-    false_positive_weight : float
-        The weight of false positive.
-    false_negative_weight : float
-        The weight of false negative.
+    ngram_size : int
+        The size of the n-grams.
+    min_length : int
+        The minimum number of tokens in a document.
+    permutations : Tuple[np.ndarray, np.ndarray]
+        The permutations for the hash values.
+    sketch : str
+        `minhash` for classic MinHash, or `oph` for one-permutation hashing with densification.
+    hash_scheme : str
+        `xxh32` to hash the joined n-gram strings (`ngrams`), or `rolling` (`rolling_ngrams`).
 
     Returns
     -------
-    Tuple[int, int]
-        The optimal `b` and `r` parameters.
-        The number of bands, and the number of rows per band respectively.
+    np.ndarray
+        The `num_perm` hash values.
 
     Examples
     --------
-    >>> optimal_param(0.7, 256)
-    (25, 10)
+    >>> PERMUTATIONS = (
+    ...     RNG.randint(1, MOD_PRIME, size=(8,), dtype=DTYPE),
+    ...     RNG.randint(0, MOD_PRIME, size=(8,), dtype=DTYPE),
+    ... )
+    >>> minhash_signature("", 8, 1, 5, PERMUTATIONS).tolist() == [MAX_HASH] * 8
+    True
+    >>> minhash_signature("hello world", 8, 1, 0, PERMUTATIONS, sketch="oph").dtype
+    dtype('uint32')
     """
-
-    def false_positive_area(threshold: float, b: int, r: int):
-        """Source: `datasketch.lsh`"""
-
-        def area(s):
-            return 1 - (1 - s ** float(r)) ** float(b)
-
-        a, _ = integrate(area, 0.0, threshold)
-        return a
-
-    def false_negative_area(threshold: float, b: int, r: int):
-        """Source: `datasketch.lsh`"""
-
-        def area(s):
-            return 1 - (1 - (1 - s ** float(r)) ** float(b))
-
-        a, _ = integrate(area, threshold, 1.0)
-        return a
-
-    min_error = float("inf")
-    opt = (0, 0)
-    for b in range(1, num_perm + 1):
-        max_r = int(num_perm / b)
-        for r in range(1, max_r + 1):
-            fp = false_positive_area(threshold, b, r)
-            fn = false_negative_area(threshold, b, r)
-            error = fp * false_positive_weight + fn * false_negative_weight
-            if error < min_error:
-                min_error = error
-                opt = (b, r)
-    return opt
+    a, b = permutations
+    hashes = shingle_set(content, ngram_size, min_length, hash_scheme)
+    if sketch == "oph":
+        values = ((hashes * a[0] + b[0]) % MOD_PRIME) & MAX_HASH
+        min_hashes = oph_signatures(values, np.array([0, len(values)]), num_perm, densify_table(num_perm))[0]
+        return min_hashes.astype(DTYPE)
+    p_hashes = ((np.outer(hashes, a) + b) % MOD_PRIME) & MAX_HASH
+    return np.vstack([p_hashes, np.full(num_perm, MAX_HASH, dtype=DTYPE)]).min(axis=0)
 
 
 # endregion
 
 
 # region: IO
-def partitioned_save(df: DataFrame, chunk_size: int, max_partitions: int, output: str):
+def write_audit(assignment: DataFrame, edges: DataFrame, output: str, log: Logger, top: int = 10):
     """
-    Save a Spark DataFrame to a GCS directory in batches of `chunk_size` rows. PySpark natively does not support this
-    functionality, so this workaround is necessary.
+    Write the cluster membership table, and log a summary of the cluster sizes. The table has the
+    `__id__`, `__root__` (connected component), `__size__` and `__band__` of every clustered
+    document, where the band is the first one that linked the document to another one, or -1 if it
+    was only linked as an exact copy.
 
     Parameters
     ----------
-    df : pyspark.sql.DataFrame
-        The Spark DataFrame to save.
-    chunk_size : int
-        The number of rows per batch.
-    max_partitions : int
-        The maximum number of partitions.
+    assignment : pyspark.sql.DataFrame
+        The `(id, component)` connected components.
+    edges : pyspark.sql.DataFrame
+        The `(src, dst, band)` edges.
     output : str
         The GCS output directory.
-
-    Raises
-    ------
-    RuntimeError
-        If the save fails.
+    log : Logger
+        The logger of the summary.
+    top : int
+        The number of largest clusters to log.
     """
-
-    total_rows = df.count()
-    partitions = max(256, min(math.ceil(total_rows / chunk_size), max_partitions))
-
-    (
-        df.repartition(partitions)
-        .withColumn("__pid__", F.spark_partition_id())
-        .write.partitionBy("__pid__")
-        .parquet(output, mode="overwrite", compression="snappy")
+    bands = (
+        edges.select(F.col("src").alias("__id__"), F.col("band"))
+        .union(edges.select(F.col("dst").alias("__id__"), F.col("band")))
+        .groupBy("__id__")
+        # exact copy edges only count for the documents without any band
+        .agg(F.coalesce(F.min(F.when(F.col("band") >= 0, F.col("band"))), F.lit(-1)).alias("__band__"))
     )
+    clusters = assignment.select(F.col("id").alias("__id__"), F.col("component").alias("__root__"))
+    sizes = clusters.groupBy("__root__").agg(F.count("*").alias("__size__")).persist(pyspark.StorageLevel.DISK_ONLY)
+    clusters.join(sizes, on="__root__").join(bands, on="__id__", how="left").select(
+        "__id__", "__root__", "__size__", "__band__"
+    ).write.parquet(output, mode="overwrite", compression="snappy")
+
+    for row in sizes.groupBy("__size__").count().orderBy("__size__").collect():
+        log.debug(f"Clusters of size {row['__size__']:<8}: {row['count']}")
+    for row in sizes.orderBy(F.desc("__size__")).limit(top).collect():
+        log.debug(f"Large cluster {row['__root__']:<20}: {row['__size__']}")
+    sizes.unpersist()
 
 
 # endregion
@@ -275,14 +275,58 @@ if __name__ == "__main__":  # pragma: no cover
     parser.add_argument("--b", type=int, default=None, help="Number of bands")
     parser.add_argument("--r", type=int, default=None, help="Number of rows per band")
     parser.add_argument("--column", "-c", type=str, default="content", help="Column to deduplicate on")
+    parser.add_argument(
+        "--band_bits", type=int, default=32, choices=[32, 16, 8], help="Bits per hash value in the LSH bands"
+    )
+    parser.add_argument("--sketch", type=str, default="minhash", choices=SKETCHES, help="Signature algorithm")
+    parser.add_argument(
+        "--hash_scheme", type=str, default="xxh32", choices=["xxh32", "rolling"], help="Shingle hashing"
+    )
+    parser.add_argument(
+        "--exact_dedup", action="store_true", help="Only MinHash one copy of each group of exact duplicates"
+    )
+    parser.add_argument(
+        "--verify", action="store_true", help="Drop candidate pairs whose exact Jaccard similarity is below threshold"
+    )
+    parser.add_argument(
+        "--skew_threshold", type=int, default=None, help="Salt the buckets estimated to hold this many documents"
+    )
+    parser.add_argument("--skew_sample", type=float, default=0.01, help="Fraction sampled to estimate bucket sizes")
+    parser.add_argument("--num_salts", type=int, default=64, help="Number of sub-buckets of a heavy bucket")
+    parser.add_argument("--max_bucket_size", type=int, default=None, help="Skip the buckets of more documents")
+    parser.add_argument(
+        "--oversized_output", type=str, default=None, help="GCS output directory of the skipped buckets"
+    )
+    parser.add_argument(
+        "--signature_output", type=str, default=None, help="GCS output directory of the (__id__, signature) table"
+    )
+    parser.add_argument(
+        "--signatures", type=str, default=None, help="Band the signatures stored by --signature_output, without hashing"
+    )
+    parser.add_argument(
+        "--reference_signatures",
+        type=str,
+        default=None,
+        help="Drop the documents that collide with the signatures stored by --signature_output of another corpus",
+    )
+    parser.add_argument("--audit_output", type=str, default=None, help="GCS output directory of the cluster table")
     parser.add_argument("--repo_column", type=str, required=True, help="Code repo column")
     parser.add_argument("--output", "-o", type=str, required=True, help="GCS output directory of parquet files")
+    parser.add_argument("--target_file_mb", type=int, default=256, help="Target size of each output file in MB")
+    parser.add_argument("--row_group_mb", type=int, default=128, help="Parquet row group size in MB")
+    parser.add_argument(
+        "--compression", type=str, default="snappy", choices=["snappy", "zstd"], help="Parquet compression"
+    )
     parser.add_argument("--rank", action="store_true", help="Rank the duplicates by quality indicators")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
     parser.add_argument("--profile", action="store_true", help="Enable profiling")
     parser.add_argument("--profile_dir", type=str, default="./profile", help="Checkpoint directory")
     parser.add_argument("--checkpoint_dir", type=str, default="./checkpoints", help="Checkpoint directory")
     args = parser.parse_args()
+    if args.max_bucket_size is not None and args.oversized_output is None:
+        parser.error("--max_bucket_size requires --oversized_output")
+    if args.signatures is not None and args.signature_output is not None:
+        parser.error("--signatures and --signature_output cannot be combined")
     # endregion
 
     # region: Spark Configuration
@@ -305,8 +349,6 @@ if __name__ == "__main__":  # pragma: no cover
 
     # region: Global Variables
     FINAL_SIZE: int = 0
-    MAX_WRITE_CHUNK_SIZE: int = 200_000
-    MAX_WRITE_PARTITIONS: int = 2048
 
     B, R = args.b, args.r
     if B is None or R is None:
@@ -317,6 +359,19 @@ if __name__ == "__main__":  # pragma: no cover
         RNG.randint(1, MOD_PRIME, size=(args.num_perm,), dtype=DTYPE),
         RNG.randint(0, MOD_PRIME, size=(args.num_perm,), dtype=DTYPE),
     )
+    # everything that determines the stored signatures, which are banded again with any --band_bits. They are matched
+    # by content, so --exact_dedup, which only skips copies with the same signature, does not matter.
+    SIGNATURE_PARAMS: Dict[str, Any] = store_metadata(
+        seed=SEED,
+        num_perm=args.num_perm,
+        ngram_size=args.ngram_size,
+        min_ngram_size=args.min_length,
+        hash_name=args.hash_scheme,
+        tokenizer=NON_ALPHA.pattern,
+        permutations=np.array(PERMUTATIONS),
+        sketch=args.sketch,
+    )
+    SIGNATURE_PARAMS.pop("exact_dedup")
     # endregion
 
     start_time: float = time.time()
@@ -351,32 +406,161 @@ if __name__ == "__main__":  # pragma: no cover
         exit(0)
     # endregion
 
+    # region: Exact Duplicates
+    # every copy of a content is linked to its first copy, and only first copies are MinHashed
+    exact_edges: DataFrame = spark.createDataFrame([], schema="src long, dst long, band int")
+    documents: DataFrame = df
+
+    def first_copies(rows: DataFrame) -> DataFrame:
+        if not args.exact_dedup:
+            return rows
+        return rows.join(exact.select(F.col("__exact__").alias("__id__")), on="__id__", how="left_semi")
+
+    if args.exact_dedup:
+        hashes: DataFrame = df.select("__id__", *content_key(args.column))
+        exact: DataFrame = (
+            hashes.groupBy("__hash__", "__length__")
+            .agg(F.min("__id__").alias("__exact__"), F.count("*").alias("__copies__"))
+            .persist(pyspark.StorageLevel.DISK_ONLY)
+        )
+        exact_edges = (
+            hashes.join(exact.filter(F.col("__copies__") > 1), on=["__hash__", "__length__"])
+            .filter(F.col("__id__") != F.col("__exact__"))
+            .select(F.col("__id__").alias("src"), F.col("__exact__").alias("dst"), F.lit(-1).alias("band"))
+        )
+        documents = first_copies(df)
+        UNIQUE_SIZE: int = exact.count()
+        log.debug(f"Exact duplicates: {DATA_SIZE - UNIQUE_SIZE}")
+        log.debug(f"MinHash skipped:  {(DATA_SIZE - UNIQUE_SIZE) / DATA_SIZE * 100:.2f}% of the documents")
+    # endregion
+
     # region: MinHash
-    edges: pyspark.RDD = (
-        df.select("__id__", args.column)
-        .rdd.flatMap(
-            lambda x: generate_hash_values(
-                content=x[1],  # args.column
-                idx=x[0],  # __id__
-                num_perm=args.num_perm,
-                ngram_size=args.ngram_size,
-                min_length=args.min_length,
-                hashranges=HASH_RANGES,
-                permutations=PERMUTATIONS,
-            )
-        )  # (band_idx, band hash value, idx)
-        .groupBy(lambda x: (x[0], x[1]))  # group by (band_idx, band hash value), potential bottleneck
-        .flatMap(lambda x: generate_edges([ele[2] for ele in x[1]]))
-        .distinct()
-    ).persist(pyspark.StorageLevel.DISK_ONLY)
-    log.debug(f"Initial edges: {edges.count()}")
+    signature = partial(
+        minhash_signature,
+        num_perm=args.num_perm,
+        ngram_size=args.ngram_size,
+        min_length=args.min_length,
+        permutations=PERMUTATIONS,
+        sketch=args.sketch,
+        hash_scheme=args.hash_scheme,
+    )
+    sources: DataFrame = documents.select("__id__", args.column)
+
+    def hashed_bands(rows: DataFrame) -> DataFrame:
+        # the band rows come out of a vectorized UDF as columns, and the buckets are grouped by Spark
+        return rows.mapInPandas(
+            lambda frames: band_frames(frames, args.column, signature, HASH_RANGES, args.band_bits),
+            schema=BAND_SCHEMA,
+        )
+
+    def stored_bands(rows: DataFrame) -> DataFrame:
+        return rows.mapInPandas(
+            lambda frames: stored_band_frames(frames, HASH_RANGES, args.band_bits), schema=BAND_SCHEMA
+        )
+
+    to_bands = hashed_bands
+    if args.signatures is not None or args.signature_output is not None:
+        if args.signature_output is not None:
+            write_signatures(spark, documents, args.column, signature, args.signature_output, SIGNATURE_PARAMS)
+        # the signatures are matched to the documents by content, the ids of the run that stored them do not matter
+        sources = document_signatures(
+            read_signatures(spark, args.signatures or args.signature_output, SIGNATURE_PARAMS), documents, args.column
+        ).persist(pyspark.StorageLevel.DISK_ONLY)
+        MISSING_SIGNATURES: int = sources.filter(F.col("signature").isNull()).count()
+        if MISSING_SIGNATURES > 0:
+            raise ValueError(f"{MISSING_SIGNATURES} documents have no signature in the stored signatures")
+        to_bands = stored_bands
+
+    bands: DataFrame = to_bands(sources)  # (band, band_hash, __id__)
+    REFERENCE_DUPLICATES: int = 0
+    if args.reference_signatures is not None:
+        # a document that shares a bucket with the reference corpus is dropped, with its exact copies, and only the
+        # other documents are deduplicated among themselves
+        new_bands: DataFrame = bands.persist(pyspark.StorageLevel.DISK_ONLY)
+        # only the band keys of the reference matter, the content hashes stand in for its ids
+        reference: DataFrame = read_signatures(spark, args.reference_signatures, SIGNATURE_PARAMS).select(
+            F.col("__hash__").alias("__id__"), "signature"
+        )
+        reference_duplicates: DataFrame = duplicates_of_reference(
+            new_bands, stored_bands(reference), exact_edges
+        ).persist(pyspark.StorageLevel.DISK_ONLY)
+        REFERENCE_DUPLICATES = reference_duplicates.count()
+        log.debug(f"Reference duplicates: {REFERENCE_DUPLICATES}")
+        bands = new_bands.join(reference_duplicates, on="__id__", how="left_anti").persist(
+            pyspark.StorageLevel.DISK_ONLY
+        )
+        kept: DataFrame = df.join(reference_duplicates, on="__id__", how="left_anti").persist(
+            pyspark.StorageLevel.DISK_ONLY
+        )
+        # persist trigger, before the frames they are filtered from are released
+        bands.count()
+        kept.count()
+        df.unpersist()
+        new_bands.unpersist()
+        reference_duplicates.unpersist()
+        df = kept
+        documents = first_copies(df)
+    heavy: Optional[DataFrame] = None
+    if args.skew_threshold is not None:
+        # bucket sizes are estimated from the bands of a sample, which hashes at most a fraction of the documents again
+        sample: DataFrame = sources.sample(fraction=args.skew_sample, seed=SEED)
+        if args.reference_signatures is not None:
+            # only the documents left after the reference are bucketed
+            sample = sample.join(df.select("__id__"), on="__id__", how="left_semi")
+        heavy = heavy_buckets(to_bands(sample), args.skew_sample, args.skew_threshold).persist(
+            pyspark.StorageLevel.MEMORY_AND_DISK
+        )
+        log.debug(f"Heavy buckets: {heavy.count()}")
+    buckets: DataFrame = bucket_table(bands, heavy, args.num_salts)
+    if args.max_bucket_size is not None:
+        # the buckets are needed twice, for the side table and for the edges
+        buckets = buckets.persist(pyspark.StorageLevel.DISK_ONLY)
+        oversized: DataFrame = oversized_buckets(buckets, args.max_bucket_size).persist(pyspark.StorageLevel.DISK_ONLY)
+        oversized.write.parquet(args.oversized_output, mode="overwrite", compression="snappy")
+        log.debug(f"Oversized buckets: {oversized.count()}")
+        oversized.unpersist()
+    candidates: DataFrame = band_edges(buckets, args.max_bucket_size)  # (src, dst, band)
+    if args.verify:
+        # every candidate is shingled once, and the pairs are compared in batches in a vectorized UDF
+        shingles: DataFrame = candidate_shingles(
+            candidates,
+            documents,
+            args.column,
+            partial(
+                shingle_set, ngram_size=args.ngram_size, min_length=args.min_length, hash_scheme=args.hash_scheme
+            ),
+        ).persist(pyspark.StorageLevel.DISK_ONLY)
+        candidates = verified_edges(candidates, shingles, args.threshold)
+    edges: DataFrame = candidates.unionByName(exact_edges).persist(pyspark.StorageLevel.DISK_ONLY)
+    EDGE_COUNT: int = edges.count()
+    log.debug(f"Initial edges: {EDGE_COUNT}")
+    if args.exact_dedup:
+        exact.unpersist()
+    if heavy is not None:
+        heavy.unpersist()
+    if args.signatures is not None or args.signature_output is not None:
+        sources.unpersist()
+    if args.verify:
+        shingles.unpersist()
+    if args.max_bucket_size is not None:
+        buckets.unpersist()
+    if args.reference_signatures is not None:
+        bands.unpersist()
 
     # endregion
 
     # region: Connected Components
 
-    if edges.isEmpty():
-        partitioned_save(df, MAX_WRITE_CHUNK_SIZE, MAX_WRITE_PARTITIONS, args.output)
+    if EDGE_COUNT == 0:
+        write_parquet(
+            df,
+            args.output,
+            num_rows=DATA_SIZE - REFERENCE_DUPLICATES,
+            target_file_mb=args.target_file_mb,
+            row_group_mb=args.row_group_mb,
+            compression=args.compression,
+            range_column="__id__",
+        )
         df.unpersist()
         edges.unpersist()
 
@@ -390,11 +574,7 @@ if __name__ == "__main__":  # pragma: no cover
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        edges_df: DataFrame = (
-            spark.createDataFrame(edges, schema=["src", "dst"])
-            .repartition(4096)
-            .persist(pyspark.StorageLevel.DISK_ONLY)
-        )
+        edges_df: DataFrame = edges.repartition(4096).persist(pyspark.StorageLevel.DISK_ONLY)
         log.debug(f"Edges DataFrame: {edges_df.count()}")
         vertices_df: DataFrame = (
             edges_df.select(F.col("src").alias("id"))
@@ -408,7 +588,10 @@ if __name__ == "__main__":  # pragma: no cover
             GraphFrame(vertices_df, edges_df).connectedComponents().persist(pyspark.StorageLevel.DISK_ONLY)
         )
         log.debug(f"Assignment DataFrame: {assignment.count()}")
+        if args.audit_output:
+            write_audit(assignment, edges_df, args.audit_output, log)
         edges_df.unpersist()
+        edges.unpersist()
         vertices_df.unpersist()
     # endregion
 
@@ -475,49 +658,22 @@ if __name__ == "__main__":  # pragma: no cover
         rank_columns = [
             "__component__",
             "__id__",
-            args.repo_column,
             "revision_date",
             "visit_date",
             "fork_events_count",
             "star_events_count",
             "license_type",
         ]
-        # justification: this is needed for the ranking
-        duplicates: pyspark.RDD = (
-            df.filter(F.col("__component__").isNotNull())
-            .select(*rank_columns)
-            .rdd.map(lambda x: (x[0], x))
-            .persist(pyspark.StorageLevel.DISK_ONLY)
-        )
-
-        def compare_records(a, b):
-            return sorted(
-                [a, b],
-                key=lambda x: (
-                    # license_type, the more permissive the better
-                    ["permissive", "no_license", "non_permissive"].index(x[-1]) if x[-1] is not None else float("inf"),
-                    # star_events_count, the more the better
-                    -x[-2] if x[-2] is not None else 0.0,
-                    # fork_events_count, the more the better
-                    -x[-3] if x[-3] is not None else 0.0,
-                    # revision_date, the latest the better
-                    -np.datetime64(x[-5]).astype(np.uint64).item() if x[-5] is not None else float("inf"),
-                    # visit_date, the latest the better
-                    -np.datetime64(x[-4]).astype(np.uint64).item() if x[-4] is not None else float("inf"),
-                ),
-            )[0]
-
-        log.debug(f"Ranking duplicates: {duplicates.count()}")
-        flags: pyspark.RDD = (
-            duplicates.reduceByKey(lambda x, y: compare_records(x, y))
-            .map(lambda x: (x[1][1], True))
+        # the best document of every component, picked in the JVM with a window per component
+        flags: DataFrame = (
+            best_duplicates(df.filter(F.col("__component__").isNotNull()).select(*rank_columns))
+            .withColumn("__keep__", F.lit(True))
             .persist(pyspark.StorageLevel.DISK_ONLY)
         )
         log.debug(f"Keeping duplicates: {flags.count()}")
-        duplicates.unpersist()
 
         df = (
-            df.join(spark.createDataFrame(flags, schema=["__id__", "__keep__"]), on="__id__", how="left")
+            df.join(flags, on="__id__", how="left")
             .filter(F.col("__component__").isNull() | F.col("__keep__"))
             .drop("__keep__", "__component__")
             .persist(pyspark.StorageLevel.DISK_ONLY)
@@ -535,7 +691,15 @@ if __name__ == "__main__":  # pragma: no cover
     # endregion
 
     # region: Output
-    partitioned_save(df, MAX_WRITE_CHUNK_SIZE, MAX_WRITE_PARTITIONS, args.output)
+    write_parquet(
+        df,
+        args.output,
+        num_rows=FINAL_SIZE,
+        target_file_mb=args.target_file_mb,
+        row_group_mb=args.row_group_mb,
+        compression=args.compression,
+        range_column="__id__",
+    )
     df.unpersist()
 
     # endregion
@@ -45,6 +45,9 @@ if ! gcloud dataproc clusters list --region $REGION | grep -q RUNNING | grep -q
     gcloud dataproc clusters start $CLUSTER_NAME --region $REGION
 fi
 
+# Shared modules (`utils/`) are shipped to the cluster as a zip
+(cd .. && zip -qr bigcode-v2/utils.zip utils -x "*__pycache__*")
+
 # Progress bar
 TOTAL=$(echo "${DIRS}" | wc -w)
 LENGTH=20
@@ -78,6 +81,7 @@ for DIR in $DIRS; do
     gcloud dataproc jobs submit pyspark --cluster ${CLUSTER_NAME} \
         --region $REGION \
         --jars $SPARK_JARS \
+        --py-files utils.zip \
         --driver-log-levels root=FATAL,__main__=DEBUG \
         --properties="spark.executor.memory=210g,spark.driver.memory=16g,spark.executor.cores=59,spark.jars.packages=graphframes:graphframes:0.8.2-spark3.2-s_2.12" \
         intra_dedup.py -- \
@@ -4,13 +4,13 @@
 # created     : 10/4/22
 from __future__ import annotations
 
-import gc
 import hashlib
+import json
 import logging
 import multiprocessing as mp
 import os
-import random
 import re
+import shutil
 import struct
 import time
 import warnings
@@ -29,15 +29,47 @@ with warnings.catch_warnings():
     import numpy as np
     import typer
     from datasets import load_dataset
-    from scipy.integrate import quad as integrate
     from tqdm import tqdm
 
+from utils.audit import write_audit
+from utils.bucketing import band_keys
+from utils.bucketing import bucket_edges
+from utils.bucketing import exact_representatives
+from utils.bucketing import load_partition
+from utils.bucketing import partition_count
+from utils.bucketing import relink_unverified
+from utils.bucketing import spill_band_keys
+from utils.bucketing import truncate_signatures
+from utils.checkpoint import Checkpoints
+from utils.jaccard import pair_jaccard
+from utils.lsh import optimal_param
+from utils.parquet_shards import ParquetShards
+from utils.ranking import RANK_COLUMNS
+from utils.ranking import rank_keys
+from utils.ranking import ranked_clusters
+from utils.shared_matrix import create_matrix
+from utils.shared_matrix import open_matrix
+from utils.shingling import ROLLING_VERSION
+from utils.shingling import rolling_shingle_hashes
+from utils.signature_store import check_compatible
+from utils.signature_store import content_hash
+from utils.signature_store import is_complete
+from utils.signature_store import iter_signatures
+from utils.signature_store import num_rows
+from utils.signature_store import store_metadata
+from utils.signature_store import write_signatures
+from utils.sketches import SKETCHES
+from utils.sketches import densify_table
+from utils.sketches import oph_signatures
+
 
 SEED = 42
 NON_ALPHA = re.compile("[^A-Za-z_0-9]")
 RNG = np.random.RandomState(SEED)
 MAX_HASH = np.uint64((1 << 32) - 1)
 MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+# the name of each shingle hash scheme, as recorded in signature stores
+HASH_SCHEMES = {"sha1": "sha1_hash32", "rolling": f"{ROLLING_VERSION}-sha1_hash32"}
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 datasets.logging.set_verbosity_error()
@@ -130,81 +162,383 @@ def embed_func(
     return {"__signatures__": Hs, "__id__": idx}
 
 
-def optimal_param(
-    threshold: float,
-    num_perm: int,
-    false_positive_weight: float = 0.5,
-    false_negative_weight: float = 0.5,
-):
+def shingle_hashes(content: str, ngram_size: int, min_ngram_size: int, hash_scheme: str = "sha1") -> np.ndarray:
     """
-    Compute the optimal `MinHashLSH` parameter that minimizes the weighted sum
-    of probabilities of false positive and false negative, taken from datasketch.
+    Hash the unique n-gram shingles of a document. The `sha1` scheme does it the same way as
+    `embed_func`, the `rolling` scheme hashes every token once and combines the token hashes.
 
     Parameters
     ----------
-    threshold : float
-        The threshold for similarity.
-    num_perm : int
-        The number of permutations.
-    false_positive_weight : float
-        The weight of false positive.
-    false_negative_weight : float
-        The weight of false negative.
+    content : str
+        The content to be shingled.
+    ngram_size : int
+        The size of n-grams.
+    min_ngram_size : int
+        The minimum size of n-grams.
+    hash_scheme : str
+        The shingle hash scheme, one of `HASH_SCHEMES`.
 
     Returns
     -------
-    Tuple[int, int]
-        The optimal `b` and `r` parameters.
-        The number of bands, and the number of rows per band respectively.
+    np.ndarray
+        The `uint64` hash values of the shingles.
+    """
+    if hash_scheme == "rolling":
+        tokens = NON_ALPHA.split(content)
+        if len(tokens) < min_ngram_size:
+            return np.empty(0, dtype=np.uint64)
+        return rolling_shingle_hashes(tokens, ngram_size, sha1_hash32)
+    tokens = {" ".join(t) for t in ngrams(NON_ALPHA.split(content), ngram_size, min_ngram_size)}
+    return np.array([sha1_hash32(token.encode("utf-8")) for token in tokens], dtype=np.uint64)
+
+
+def minhash_signatures(
+    hashes: np.ndarray,
+    offsets: np.ndarray,
+    permutations: np.ndarray,
+    chunk_size: int = 8192,
+) -> np.ndarray:
+    """
+    Compute the MinHash signatures of a whole batch of documents at once. All permutations are
+    applied with a single broadcast and reduced per document with a segmented minimum.
+
+    Parameters
+    ----------
+    hashes : np.ndarray
+        The shingle hashes of all documents, concatenated.
+    offsets : np.ndarray
+        The start offset of each document in `hashes`, followed by `len(hashes)`.
+    permutations : np.ndarray
+        The permutations for the minhash.
+    chunk_size : int
+        The maximum number of shingles permuted at once, to bound memory usage.
+
+    Returns
+    -------
+    np.ndarray
+        The `(batch, num_perm)` signature matrix, identical to the one of `embed_func`.
+    """
+    a, b = permutations
+    num_docs = len(offsets) - 1
+    # permutations along the rows, so every document is a contiguous run of columns
+    signatures = np.full((len(a), num_docs), MAX_HASH, dtype=np.uint64)
+    doc_ids = np.repeat(np.arange(num_docs), np.diff(offsets))
+    buffer = np.empty((len(a), min(chunk_size, len(hashes))), dtype=np.uint64)
+    for start in range(0, len(hashes), chunk_size):
+        hv = hashes[start : start + chunk_size]
+        ids = doc_ids[start : start + chunk_size]
+        phv = buffer[:, : len(hv)]
+        np.multiply(a[:, None], hv, out=phv)
+        np.add(phv, b[:, None], out=phv)
+        np.remainder(phv, MERSENNE_PRIME, out=phv)
+        np.bitwise_and(phv, MAX_HASH, out=phv)
+        # a document can span two chunks, so merge with what is already there
+        heads = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        cols = ids[heads]
+        signatures[:, cols] = np.minimum(signatures[:, cols], np.minimum.reduceat(phv, heads, axis=1))
+    return signatures.T
+
+
+def embed_func_batched(
+    contents: List[str],
+    idx: List[int],
+    *,
+    ngram_size: int,
+    hashranges: List[Tuple[int, int]],
+    permutations: np.ndarray,
+    min_ngram_size: int = 5,
+    output: str = "bands",
+    band_bits: int = 32,
+    sketch: str = "minhash",
+    hash_scheme: str = "sha1",
+) -> Dict[str, Any]:
     """
+    Batched version of `embed_func`, to be used with `ds.map(batched=True)`.
 
-    def false_positive_probability(threshold: float, b: int, r: int):
-        """Source: `datasketch.lsh`"""
+    Parameters
+    ----------
+    contents : List[str]
+        The contents to be embedded.
+    idx : List[int]
+        The indices of the contents.
+    ngram_size : int
+        The size of n-grams.
+    hashranges : List[Tuple[int, int]]
+        The ranges of hash values.
+    permutations : np.ndarray
+        The permutations for the minhash.
+    min_ngram_size : int
+        The minimum size of n-grams.
+    output : str
+        What to return: `bands`, the band bytes (`__signatures__`) for the dict bucketer, `keys`,
+        one 64-bit key per band (`__keys__`) for the sort bucketer, or `signatures`, the full
+        uint32 signatures (`__signature__`) and content hashes (`__content_hash__`) for the store.
+    band_bits : int
+        The number of bits per hash value in the bands, see `truncate_signatures`. 64 gives the
+        same bytes as `embed_func`, 32 the same buckets at half the size.
+    sketch : str
+        `minhash` for classic MinHash, or `oph` for one-permutation hashing, which only applies
+        the first permutation and densifies the empty bins.
+    hash_scheme : str
+        The shingle hash scheme, see `shingle_hashes`.
 
-        def proba(s):
-            return 1 - (1 - s ** float(r)) ** float(b)
+    Returns
+    -------
+    Dict[str, Any]
+        The hash values in each range and the index of every content.
+    """
+    hvs = [shingle_hashes(content, ngram_size, min_ngram_size, hash_scheme) for content in contents]
+    offsets = np.zeros(len(hvs) + 1, dtype=np.int64)
+    np.cumsum([len(hv) for hv in hvs], out=offsets[1:])
+    hashes = np.concatenate(hvs) if hvs else np.empty(0, dtype=np.uint64)
+    if sketch == "oph":
+        a, b = permutations
+        values = np.bitwise_and((hashes * a[0] + b[0]) % MERSENNE_PRIME, MAX_HASH)
+        signatures = oph_signatures(values, offsets, len(a), densify_table(len(a)))
+    else:
+        signatures = minhash_signatures(hashes, offsets, permutations)
+    if output == "keys":
+        return {"__keys__": band_keys(signatures, hashranges, band_bits), "__id__": idx}
+    if output == "signatures":
+        return {
+            "__signature__": signatures.astype(np.uint32),
+            "__content_hash__": np.array([content_hash(content) for content in contents], dtype=np.uint64),
+            "__id__": idx,
+        }
+    signatures = truncate_signatures(signatures, band_bits)
+    Hs = [[sig[start:end].tobytes() for start, end in hashranges] for sig in signatures]
+    return {"__signatures__": Hs, "__id__": idx}
 
-        a, _ = integrate(proba, 0.0, threshold)
-        return a
 
-    def false_negative_probability(threshold: float, b: int, r: int):
-        """Source: `datasketch.lsh`"""
+def embed_func_spill(
+    contents: List[str],
+    idx: List[int],
+    *,
+    spill_dir: str,
+    num_partitions: int,
+    **kwargs,
+) -> Dict[str, Any]:
+    """
+    Out-of-core version of `embed_func_batched`: the band keys are written to the partition
+    files on disk instead of being returned.
+
+    Parameters
+    ----------
+    contents : List[str]
+        The contents to be embedded.
+    idx : List[int]
+        The indices of the contents.
+    spill_dir : str
+        The spill directory.
+    num_partitions : int
+        The number of partitions.
+    **kwargs
+        The arguments of `embed_func_batched`.
 
-        def proba(s):
-            return 1 - (1 - (1 - s ** float(r)) ** float(b))
+    Returns
+    -------
+    Dict[str, Any]
+        The index of every content.
+    """
+    keys = embed_func_batched(contents, idx, output="keys", **kwargs)["__keys__"]
+    spill_band_keys(keys, np.asarray(idx), spill_dir, num_partitions)
+    return {"__id__": idx}
 
-        a, _ = integrate(proba, threshold, 1.0)
-        return a
 
-    min_error = float("inf")
-    opt = (0, 0)
-    for b in range(1, num_perm + 1):
-        max_r = int(num_perm / b)
-        for r in range(1, max_r + 1):
-            fp = false_positive_probability(threshold, b, r)
-            fn = false_negative_probability(threshold, b, r)
-            error = fp * false_positive_weight + fn * false_negative_weight
-            if error < min_error:
-                min_error = error
-                opt = (b, r)
-    return opt
+def embed_func_shared(
+    contents: List[str],
+    idx: List[int],
+    *,
+    keys_path: str,
+    **kwargs,
+) -> Dict[str, Any]:
+    """
+    Shared-memory version of `embed_func_batched`: the band keys are written into the columns
+    `idx` of the `(bands, documents)` matrix in `keys_path` instead of being returned.
+
+    Parameters
+    ----------
+    contents : List[str]
+        The contents to be embedded.
+    idx : List[int]
+        The indices of the contents.
+    keys_path : str
+        The `.npy` file of the matrix, see `utils.shared_matrix`.
+    **kwargs
+        The arguments of `embed_func_batched`.
+
+    Returns
+    -------
+    Dict[str, Any]
+        Nothing, so that no cache file is written.
+    """
+    keys = embed_func_batched(contents, idx, output="keys", **kwargs)["__keys__"]
+    open_matrix(keys_path)[:, idx] = keys.T
+    return {}
+
+
+def shingle_func_batched(
+    contents: List[str],
+    *,
+    ngram_size: int,
+    min_ngram_size: int,
+    hash_scheme: str = "sha1",
+) -> Dict[str, Any]:
+    """
+    Compute the shingle sets of a batch of contents, to verify candidate pairs with their exact
+    Jaccard similarity.
+
+    Parameters
+    ----------
+    contents : List[str]
+        The contents to be shingled.
+    ngram_size : int
+        The size of n-grams.
+    min_ngram_size : int
+        The minimum size of n-grams.
+    hash_scheme : str
+        The shingle hash scheme, one of `HASH_SCHEMES`.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The sorted unique 32-bit shingle hashes of every content.
+    """
+    return {
+        "__shingles__": [
+            np.unique(shingle_hashes(content, ngram_size, min_ngram_size, hash_scheme)).astype(np.uint32)
+            for content in contents
+        ]
+    }
+
+
+def content_hash_batched(contents: List[str]) -> Dict[str, Any]:
+    """
+    Hash the raw contents, to find exact duplicates before fingerprinting.
+
+    Parameters
+    ----------
+    contents : List[str]
+        The contents to be hashed.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The content hash and the size in bytes of every content.
+    """
+    return {
+        "__content_hash__": np.array([content_hash(content) for content in contents], dtype=np.uint64),
+        "__size__": [len(content.encode("utf-8")) for content in contents],
+    }
 
 
 class UnionFind:
-    def __init__(self):
-        self.parent: Dict[int, int] = {}
+    """
+    Disjoint-set over the dense id range `[0, size)`, backed by NumPy arrays instead of a dict
+    so that hundreds of millions of ids fit in a few GB. It uses union by rank and iterative
+    path halving, so long chains never hit the recursion limit.
 
-    def find(self, x):
-        if x not in self.parent:
-            self.parent[x] = x
-        if self.parent[x] != x:
-            self.parent[x] = self.find(self.parent[x])
-        return self.parent[x]
+    Parameters
+    ----------
+    size : int
+        The number of elements, i.e. the number of documents.
+    """
+
+    def __init__(self, size: int):
+        dtype = np.uint32 if size <= np.iinfo(np.uint32).max else np.uint64
+        self.parent = np.arange(size, dtype=dtype)
+        self.rank = np.zeros(size, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    def find(self, x: int) -> int:
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return int(x)
+
+    def union(self, x: int, y: int):
+        self.union_pairs(np.array([x]), np.array([y]))
+
+    def find_many(self, xs: np.ndarray) -> np.ndarray:
+        """
+        Vectorized `find`. Every pass halves the paths of all the elements still climbing.
 
-    def union(self, x, y):
-        px = self.find(x)
-        py = self.find(y)
-        self.parent[px] = self.parent[py] = min(px, py)
+        Parameters
+        ----------
+        xs : np.ndarray
+            The elements to look up.
+
+        Returns
+        -------
+        np.ndarray
+            The root of each element.
+        """
+        parent = self.parent
+        roots = parent[xs]
+        active = np.flatnonzero(parent[roots] != roots)
+        while len(active):
+            nodes = roots[active]
+            grandparents = parent[parent[nodes]]
+            parent[nodes] = grandparents
+            roots[active] = grandparents
+            active = active[parent[grandparents] != grandparents]
+        return roots
+
+    def union_pairs(self, src: np.ndarray, dst: np.ndarray):
+        """
+        Merge the sets of every `(src[i], dst[i])` edge. Each round hooks all the roots that
+        still differ at once, the lower-ranked root under the higher-ranked one.
+
+        Parameters
+        ----------
+        src : np.ndarray
+            The first end of each edge.
+        dst : np.ndarray
+            The second end of each edge.
+        """
+        parent, rank = self.parent, self.rank
+        src = np.asarray(src, dtype=parent.dtype)
+        dst = np.asarray(dst, dtype=parent.dtype)
+        while len(src):
+            src, dst = self.find_many(src), self.find_many(dst)
+            pending = src != dst
+            src, dst = src[pending], dst[pending]
+            if not len(src):
+                break
+            # ties go to the smaller id, which keeps the hooking free of cycles
+            swap = (rank[src] < rank[dst]) | ((rank[src] == rank[dst]) & (src > dst))
+            winner = np.where(swap, dst, src)
+            loser = np.where(swap, src, dst)
+            tied = rank[winner] == rank[loser]
+            parent[loser] = winner
+            rank[winner[tied]] = np.minimum(rank[winner[tied]], 254) + 1
+
+    def flatten(self) -> np.ndarray:
+        """
+        Point every element directly at its root.
+
+        Returns
+        -------
+        np.ndarray
+            The parent array, which now holds the root of each element.
+        """
+        self.parent[:] = self.find_many(np.arange(len(self.parent)))
+        return self.parent
+
+    def cluster_ids(self) -> np.ndarray:
+        """
+        Label each element with the smallest element of its set, which is the one we keep.
+
+        Returns
+        -------
+        np.ndarray
+            The cluster id of each element.
+        """
+        _, first, inverse = np.unique(self.flatten(), return_index=True, return_inverse=True)
+        return first[inverse.reshape(-1)].astype(self.parent.dtype)
 
 
 if __name__ == "__main__":
@@ -222,34 +556,120 @@ if __name__ == "__main__":
         threshold: float = typer.Option(0.7, help="Minhash threshold"),
         min_ngram_size: int = typer.Option(5, help="Shorter documents will be removed"),
         output: str = typer.Option(None, help="Store the deduplicated dataset"),
+        batch_size: int = typer.Option(1000, help="Number of documents fingerprinted at once"),
+        bucketer: str = typer.Option("sort", help="LSH bucketing: `sort` (flat key arrays) or `dict` (hash tables)"),
+        memory_budget: float = typer.Option(
+            None, help="Spill band keys to disk and cluster them in partitions that fit in this many GB"
+        ),
+        signatures: str = typer.Option(
+            None, help="Reuse the signature store in this directory, or fingerprint into it if there is none"
+        ),
+        band_bits: int = typer.Option(32, help="Bits per hash value in the LSH bands: 32, or 16/8 (b-bit MinHash)"),
+        sketch: str = typer.Option("minhash", help="Signature algorithm: `minhash` or `oph` (one-permutation hashing)"),
+        hash_scheme: str = typer.Option("sha1", help="Shingle hashing: `sha1` (n-gram strings) or `rolling`"),
+        exact_dedup: bool = typer.Option(False, help="Only fingerprint one copy of each group of exact duplicates"),
+        checkpoint_dir: str = typer.Option(
+            None, help="Checkpoint every stage in this directory, and resume from the last completed one"
+        ),
+        thresholds: str = typer.Option(
+            None, help="Comma-separated thresholds, fingerprinted once, with a keep-index file for each"
+        ),
+        verify: bool = typer.Option(
+            False, help="Drop candidate pairs whose exact Jaccard similarity is below the threshold"
+        ),
+        parquet_dir: str = typer.Option(
+            None, help="Stream a local directory of Parquet shards instead of loading a dataset"
+        ),
+        shared_keys: bool = typer.Option(
+            False, help="Fingerprinting workers write the band keys into one memory-mapped matrix"
+        ),
+        rank: bool = typer.Option(
+            False, help="Keep the best duplicate by license, stars, forks and dates (The Stack columns)"
+        ),
     ):
-        global uf
         OUTPUT_BASE = Path(output or "output")
         OUTPUT_BASE.mkdir(exist_ok=True, parents=True)
         output = OUTPUT_BASE / "deduplicated"
 
         logging.basicConfig(level=logging.INFO)
+        if bucketer not in {"sort", "dict"}:
+            raise typer.BadParameter(f"Unknown bucketer: {bucketer}")
+        if memory_budget is not None and bucketer != "sort":
+            raise typer.BadParameter("--memory-budget requires the sort bucketer")
+        if signatures is not None and bucketer != "sort":
+            raise typer.BadParameter("--signatures requires the sort bucketer")
+        if checkpoint_dir is not None and bucketer != "sort":
+            raise typer.BadParameter("--checkpoint-dir requires the sort bucketer")
+        if verify and bucketer != "sort":
+            raise typer.BadParameter("--verify requires the sort bucketer")
+        if verify and memory_budget is not None:
+            # the candidate pairs of every band are verified together, so they would all be in memory
+            raise typer.BadParameter("--verify cannot be combined with --memory-budget")
+        if parquet_dir is not None and bucketer != "sort":
+            raise typer.BadParameter("--parquet-dir requires the sort bucketer")
+        if shared_keys and bucketer != "sort":
+            raise typer.BadParameter("--shared-keys requires the sort bucketer")
+        if shared_keys and any(o is not None for o in (memory_budget, signatures, checkpoint_dir, thresholds)):
+            raise typer.BadParameter(
+                "--shared-keys cannot be combined with --memory-budget, --signatures, --checkpoint-dir or --thresholds"
+            )
+        MULTI = thresholds is not None
+        THRESHOLDS = sorted({float(t) for t in thresholds.split(",")}) if MULTI else [threshold]
+        if MULTI and bucketer != "sort":
+            raise typer.BadParameter("--thresholds requires the sort bucketer")
+        if MULTI and memory_budget is not None:
+            raise typer.BadParameter("--thresholds cannot be combined with --memory-budget")
+        if MULTI and signatures is None and checkpoint_dir is None:
+            # the full signatures are kept for banding them once per threshold
+            signatures = str(OUTPUT_BASE / "signatures")
+        if checkpoint_dir is not None and signatures is None:
+            # the signatures stage is a signature store, the later stages are NumPy arrays
+            signatures = str(Path(checkpoint_dir) / "signatures")
+        if band_bits not in {32, 16, 8}:
+            raise typer.BadParameter("--band-bits must be 32, 16 or 8")
+        if sketch not in SKETCHES:
+            raise typer.BadParameter(f"Unknown sketch: {sketch}")
+        if hash_scheme not in HASH_SCHEMES:
+            raise typer.BadParameter(f"Unknown hash scheme: {hash_scheme}")
 
         time_measures = {}
+        REUSED = set()
+        SUMMARIES = []
         start_time = time.time()
 
-        B, R = optimal_param(threshold, num_perm)
+        B, R = optimal_param(THRESHOLDS[0], num_perm)
         HASH_RANGES = [(i * R, (i + 1) * R) for i in range(B)]
-        HASH_TABLES = [defaultdict(set) for _ in range(B)]
 
         time_measures["load_dataset"] = time.time()
-        ds = load_dataset(
-            dataset,
-            config,
-            data_dir=data_dir,
-            split=split,
-            use_auth_token=True,
-            cache_dir=cache_dir,
-            revision=revision,
-            num_proc=os.cpu_count(),
-        )
+        if parquet_dir is not None:
+            # nothing is loaded, the shards are read again by every pass over the text
+            shards = ParquetShards(parquet_dir, column)
+            DATA_SIZE = len(shards)
+        else:
+            ds = load_dataset(
+                dataset,
+                config,
+                data_dir=data_dir,
+                split=split,
+                use_auth_token=True,
+                cache_dir=cache_dir,
+                revision=revision,
+                num_proc=os.cpu_count(),
+            )
+            DATA_SIZE = len(ds)
         time_measures["load_dataset"] = time.time() - time_measures["load_dataset"]
-        DATA_SIZE = len(ds)
+        if rank:
+            COLUMN_NAMES = shards.column_names if parquet_dir is not None else ds.column_names
+            MISSING_COLUMNS = set(RANK_COLUMNS) - set(COLUMN_NAMES)
+            if MISSING_COLUMNS:
+                raise typer.BadParameter(f"--rank requires the columns {', '.join(sorted(MISSING_COLUMNS))}")
+            time_measures["ranking"] = time.time()
+            # one integer key per criterion and row, the whole ranking is a single lexsort later on
+            if parquet_dir is not None:
+                RANK_KEYS = rank_keys(shards.read_columns(RANK_COLUMNS))
+            else:
+                RANK_KEYS = rank_keys(ds.select_columns(RANK_COLUMNS).with_format("arrow")[:])
+            time_measures["ranking"] = time.time() - time_measures["ranking"]
         PERMUTATIONS = np.array(
             [
                 (
@@ -261,85 +681,449 @@ if __name__ == "__main__":
             dtype=np.uint64,
         ).T
 
+        if exact_dedup:
+            time_measures["exact"] = time.time()
+            if parquet_dir is not None:
+                hashed = list(shards.map(content_hash_batched, batch_size=batch_size))
+                HASHES = np.concatenate([batch["__content_hash__"] for batch in hashed])
+                SIZES = np.concatenate([np.asarray(batch["__size__"], dtype=np.int64) for batch in hashed])
+            else:
+                hashed = ds.map(
+                    function=content_hash_batched,
+                    input_columns=[column],
+                    remove_columns=ds.column_names,
+                    num_proc=os.cpu_count(),
+                    batched=True,
+                    batch_size=batch_size,
+                    desc="Hashing contents...",
+                ).with_format("numpy")
+                HASHES, SIZES = hashed["__content_hash__"], hashed["__size__"]
+            # every document points at the first copy of its content, only those are fingerprinted
+            EXACT = exact_representatives(HASHES)
+            REPRESENTATIVES = np.flatnonzero(EXACT == np.arange(DATA_SIZE))
+            if parquet_dir is None:
+                fingerprinted = ds.select(REPRESENTATIVES)
+            SKIPPED_BYTES = SIZES.sum() - SIZES[REPRESENTATIVES].sum()
+            time_measures["exact"] = time.time() - time_measures["exact"]
+        else:
+            EXACT = REPRESENTATIVES = np.arange(DATA_SIZE)
+            if parquet_dir is None:
+                fingerprinted = ds
+        NUM_FINGERPRINTED = len(REPRESENTATIVES)
+
+        if memory_budget is not None:
+            # the union-find arrays stay in memory next to the partition being bucketed
+            NUM_PARTITIONS = partition_count(NUM_FINGERPRINTED * B, memory_budget * 2**30)
+            SPILL_DIR = OUTPUT_BASE / "partitions"
+            shutil.rmtree(SPILL_DIR, ignore_errors=True)
+            for p in range(NUM_PARTITIONS):
+                (SPILL_DIR / f"{p:05d}").mkdir(parents=True)
+            logger.info(f"Spilling band keys into {NUM_PARTITIONS} partitions at {SPILL_DIR}")
+
         time_measures["minhash"] = time.time()
-        embedded = ds.map(
-            function=embed_func,
-            fn_kwargs={
-                "num_perm": num_perm,
-                "hashranges": HASH_RANGES,
-                "ngram_size": ngram_size,
-                "permutations": PERMUTATIONS,
-                "min_ngram_size": min_ngram_size,
-            },
-            input_columns=[column],
-            remove_columns=ds.column_names,
-            num_proc=os.cpu_count(),
-            with_indices=True,
-            desc="Fingerprinting...",
-        )
+        embed_kwargs = {
+            "hashranges": HASH_RANGES,
+            "ngram_size": ngram_size,
+            "permutations": PERMUTATIONS,
+            "min_ngram_size": min_ngram_size,
+            "band_bits": band_bits,
+            "sketch": sketch,
+            "hash_scheme": hash_scheme,
+        }
+        if signatures is not None:
+            STORE_METADATA = store_metadata(
+                seed=SEED,
+                num_perm=num_perm,
+                ngram_size=ngram_size,
+                min_ngram_size=min_ngram_size,
+                hash_name=HASH_SCHEMES[hash_scheme],
+                tokenizer=NON_ALPHA.pattern,
+                permutations=PERMUTATIONS,
+                sketch=sketch,
+                exact_dedup=exact_dedup,
+            )
+            if is_complete(signatures):
+                check_compatible(signatures, STORE_METADATA)
+                if num_rows(signatures) != NUM_FINGERPRINTED:
+                    raise ValueError(f"Signature store {signatures} does not match the size of the dataset")
+                logger.info(f"Reusing signatures from {signatures}")
+                REUSED.add("minhash")
+            else:
+                if parquet_dir is not None:
+                    batches = shards.map(
+                        embed_func_batched,
+                        {**embed_kwargs, "output": "signatures"},
+                        rows=REPRESENTATIVES,
+                        with_indices=True,
+                        batch_size=batch_size,
+                    )
+                else:
+                    embedded = fingerprinted.map(
+                        function=embed_func_batched,
+                        fn_kwargs={**embed_kwargs, "output": "signatures"},
+                        input_columns=[column],
+                        remove_columns=fingerprinted.column_names,
+                        num_proc=os.cpu_count(),
+                        with_indices=True,
+                        batched=True,
+                        batch_size=batch_size,
+                        desc="Fingerprinting...",
+                    ).with_format("numpy")
+                    batches = (embedded[i : i + 10000] for i in range(0, len(embedded), 10000))
+                write_signatures(
+                    signatures,
+                    (
+                        (REPRESENTATIVES[batch["__id__"]], batch["__content_hash__"], batch["__signature__"])
+                        for batch in batches
+                    ),
+                    STORE_METADATA,
+                )
+        elif shared_keys:
+            # one contiguous row of keys per band, filled in place by the workers
+            KEYS_PATH = OUTPUT_BASE / "keys.npy"
+            create_matrix(KEYS_PATH, (B, NUM_FINGERPRINTED), np.uint64)
+            shared_kwargs = {**embed_kwargs, "keys_path": str(KEYS_PATH)}
+            if parquet_dir is not None:
+                for _ in shards.map(
+                    embed_func_shared, shared_kwargs, rows=REPRESENTATIVES, with_indices=True, batch_size=batch_size
+                ):
+                    pass
+            else:
+                fingerprinted.map(
+                    function=embed_func_shared,
+                    fn_kwargs=shared_kwargs,
+                    input_columns=[column],
+                    remove_columns=fingerprinted.column_names,
+                    num_proc=os.cpu_count(),
+                    with_indices=True,
+                    batched=True,
+                    batch_size=batch_size,
+                    # the side effect is the point, a cached result would leave the matrix empty
+                    load_from_cache_file=False,
+                    desc="Fingerprinting...",
+                )
+        elif parquet_dir is not None:
+            # a list of NumPy batches stands in for the embedded dataset
+            embedded = list(
+                shards.map(
+                    embed_func_spill if memory_budget is not None else embed_func_batched,
+                    {**embed_kwargs, "spill_dir": str(SPILL_DIR), "num_partitions": NUM_PARTITIONS}
+                    if memory_budget is not None
+                    else {**embed_kwargs, "output": "keys"},
+                    rows=REPRESENTATIVES,
+                    with_indices=True,
+                    batch_size=batch_size,
+                )
+            )
+        elif memory_budget is not None:
+            embedded = fingerprinted.map(
+                function=embed_func_spill,
+                fn_kwargs={**embed_kwargs, "spill_dir": str(SPILL_DIR), "num_partitions": NUM_PARTITIONS},
+                input_columns=[column],
+                remove_columns=fingerprinted.column_names,
+                num_proc=os.cpu_count(),
+                with_indices=True,
+                batched=True,
+                batch_size=batch_size,
+                # the side effect is the point, a cached result would leave the partitions empty
+                load_from_cache_file=False,
+                desc="Fingerprinting...",
+            )
+        else:
+            embedded = fingerprinted.map(
+                function=embed_func_batched,
+                fn_kwargs={**embed_kwargs, "output": "keys" if bucketer == "sort" else "bands"},
+                input_columns=[column],
+                remove_columns=fingerprinted.column_names,
+                num_proc=os.cpu_count(),
+                with_indices=True,
+                batched=True,
+                batch_size=batch_size,
+                desc="Fingerprinting...",
+            )
         time_measures["minhash"] = time.time() - time_measures["minhash"]
 
-        time_measures["clustering"] = time.time()
-        batch_size: int = 10000
-        for i in tqdm(
-            range(0, len(embedded), batch_size), dynamic_ncols=True, desc="Iterating MinHashes..."  # noqa: E501
-        ):
-            batch = embedded[i : i + batch_size]
-            for key, Hs in zip(batch["__id__"], batch["__signatures__"]):
-                for H, hashtable in zip(Hs, HASH_TABLES):
-                    hashtable[H].add(key)
-        for table in tqdm(HASH_TABLES, dynamic_ncols=True, desc="Clustering..."):
-            for cluster in table.values():
-                if len(cluster) <= 1:
-                    continue
-                idx = min(cluster)
-                for x in cluster:
-                    uf.union(x, idx)
-        time_measures["clustering"] = time.time() - time_measures["clustering"]
-
-        time_measures["filtering"] = time.time()
-        gc.freeze()
-        gc.disable()
-        ds = ds.map(
-            function=lambda _, idx: {"__cluster__": uf.find(idx)},
-            with_indices=True,
-            num_proc=os.cpu_count(),
-            new_fingerprint=str(random.getrandbits(128)),
-            desc="Finding clusters...",
-        )
-        gc.enable()
-        gc.collect()
-        # This is where the deduplication happens
-        # Since there is no easy groupby in datasets
-        # I will use this simple filter for now
-        final_data = ds.filter(
-            function=lambda record, idx: record["__cluster__"] == idx,
-            with_indices=True,
-            num_proc=os.cpu_count(),
-            desc="Filtering clusters...",
-        )
-        time_measures["filtering"] = time.time() - time_measures["filtering"]
+        for threshold in THRESHOLDS:
+            # the signatures are shared, every threshold only bands and clusters them again
+            SUFFIX = f" ({threshold})" if MULTI else ""
+            if MULTI:
+                (OUTPUT_BASE / f"threshold-{threshold}").mkdir(exist_ok=True)
+            B, R = optimal_param(threshold, num_perm)
+            HASH_RANGES = [(i * R, (i + 1) * R) for i in range(B)]
+
+            CHECKPOINT_DIR = checkpoint_dir
+            if MULTI and checkpoint_dir is not None:
+                CHECKPOINT_DIR = Path(checkpoint_dir) / f"threshold-{threshold}"
+            checkpoints = Checkpoints(
+                CHECKPOINT_DIR,
+                {
+                    "signatures": hashlib.sha1(json.dumps(STORE_METADATA, sort_keys=True).encode()).hexdigest()
+                    if checkpoint_dir is not None
+                    else None,
+                    "num_rows": NUM_FINGERPRINTED,
+                    "hashranges": HASH_RANGES,
+                    "band_bits": band_bits,
+                    "num_partitions": NUM_PARTITIONS if memory_budget is not None else None,
+                    "verify": verify,
+                },
+            )
+
+            time_measures[f"clustering{SUFFIX}"] = time.time()
+            # clustering works on positions among the fingerprinted documents
+            uf = UnionFind(NUM_FINGERPRINTED)
+            # the band that first linked each document, for the audit table
+            NOT_LINKED = np.iinfo(np.int16).max
+            FIRST_BAND = np.full(NUM_FINGERPRINTED, NOT_LINKED, dtype=np.int16)
+            if bucketer == "sort" and checkpoints.done("union-find"):
+                arrays = checkpoints.load("union-find")
+                uf.parent, uf.rank, FIRST_BAND = arrays["parent"], arrays["rank"], arrays["first_band"]
+                REUSED.add(f"clustering{SUFFIX}")
+            elif bucketer == "sort":
+                # the edges of every band, or of every spill partition, are a stage of their own
+                STAGES = [f"band-{i:05d}" for i in range(B)]
+                if memory_budget is not None:
+                    STAGES = [f"partition-{p:05d}" for p in range(NUM_PARTITIONS)]
+                PENDING = [i for i, stage in enumerate(STAGES) if not checkpoints.done(stage)]
+                if len(PENDING) < len(STAGES):
+                    logger.info(f"Reusing the edges of {len(STAGES) - len(PENDING)}/{len(STAGES)} stages")
+                if shared_keys:
+                    # zero-copy: the bands are read from the pages the workers wrote
+                    KEYS = np.load(KEYS_PATH, mmap_mode="r")
+                elif memory_budget is None and PENDING:
+                    # one contiguous (key, id) pair of arrays per band
+                    KEYS = np.empty((B, NUM_FINGERPRINTED), dtype=np.uint64)
+                if PENDING and signatures is not None:
+                    for ids, sigs in tqdm(
+                        iter_signatures(signatures), dynamic_ncols=True, desc="Banding signatures..."
+                    ):
+                        keys = band_keys(sigs, HASH_RANGES, band_bits)
+                        ids = np.searchsorted(REPRESENTATIVES, ids)
+                        if memory_budget is not None:
+                            spill_band_keys(keys, ids, SPILL_DIR, NUM_PARTITIONS)
+                        else:
+                            KEYS[:, ids] = keys.T
+                elif PENDING and memory_budget is None and not shared_keys:
+                    if parquet_dir is not None:
+                        batches = embedded
+                    else:
+                        numpy_embedded = embedded.with_format("numpy")
+                        batches = (numpy_embedded[i : i + 10000] for i in range(0, len(embedded), 10000))
+                    for batch in tqdm(batches, dynamic_ncols=True, desc="Iterating MinHashes..."):
+                        KEYS[:, batch["__id__"]] = batch["__keys__"].T
+
+                IDS = np.arange(NUM_FINGERPRINTED)
+                EDGES = []
+                for i, stage in enumerate(tqdm(STAGES, dynamic_ncols=True, desc="Clustering...")):
+                    if checkpoints.done(stage):
+                        arrays = checkpoints.load(stage)
+                        src, dst = arrays["src"], arrays["dst"]
+                    else:
+                        if memory_budget is not None:
+                            src, dst = bucket_edges(*load_partition(SPILL_DIR, i))
+                        else:
+                            src, dst = bucket_edges(KEYS[i], IDS)
+                        checkpoints.save(stage, src=src, dst=dst)
+                    if verify:
+                        EDGES.append((src.astype(np.int64), dst.astype(np.int64)))
+                        continue
+                    if memory_budget is None:
+                        # a spill partition mixes all bands
+                        FIRST_BAND[src] = np.minimum(FIRST_BAND[src], i)
+                        FIRST_BAND[dst] = np.minimum(FIRST_BAND[dst], i)
+                    uf.union_pairs(src, dst)
+                if verify:
+                    # every bucket is a star around its smallest id. The members that are not similar to it are linked
+                    # to the smallest of them in the next round, until none is left, so two near-duplicates that are
+                    # both far from the smallest id are still compared. A member similar to the smallest id is not
+                    # compared with the other members again.
+                    CANDIDATES = np.unique(np.concatenate([np.concatenate(edges) for edges in EDGES] + [IDS[:0]]))
+                    SHINGLE_KWARGS = {
+                        "ngram_size": ngram_size,
+                        "min_ngram_size": min_ngram_size,
+                        "hash_scheme": hash_scheme,
+                    }
+                    if parquet_dir is not None:
+                        shingles = [
+                            shingle
+                            for batch in shards.map(
+                                shingle_func_batched,
+                                SHINGLE_KWARGS,
+                                rows=REPRESENTATIVES[CANDIDATES],
+                                batch_size=batch_size,
+                            )
+                            for shingle in batch["__shingles__"]
+                        ]
+                        VALUES = np.concatenate(shingles + [np.empty(0, dtype=np.uint32)])
+                        OFFSETS = np.cumsum([0] + [len(shingle) for shingle in shingles])
+                    else:
+                        shingles = (
+                            fingerprinted.select(CANDIDATES)
+                            .map(
+                                function=shingle_func_batched,
+                                fn_kwargs=SHINGLE_KWARGS,
+                                input_columns=[column],
+                                remove_columns=fingerprinted.column_names,
+                                num_proc=os.cpu_count(),
+                                batched=True,
+                                batch_size=batch_size,
+                                desc="Shingling candidates...",
+                            )
+                            .with_format("arrow")[:]["__shingles__"]
+                            .combine_chunks()
+                        )
+                        VALUES = shingles.flatten().to_numpy()
+                        OFFSETS = shingles.offsets.to_numpy()
+                        OFFSETS = OFFSETS - OFFSETS[0]
+                    NUM_PAIRS, NUM_VERIFIED = 0, 0
+                    while any(len(src) for src, _ in EDGES):
+                        # a pair is usually a candidate in several bands, it is only verified once,
+                        # and the first occurrence of a pair is in its first band
+                        PAIRS, FIRST = np.unique(
+                            np.concatenate(
+                                [(src.astype(np.uint64) << np.uint64(32)) | dst.astype(np.uint64) for src, dst in EDGES]
+                            ),
+                            return_index=True,
+                        )
+                        PAIR_BANDS = np.repeat(np.arange(len(EDGES), dtype=np.int16), [len(src) for src, _ in EDGES])[
+                            FIRST
+                        ]
+                        src = (PAIRS >> np.uint64(32)).astype(np.int64)
+                        dst = (PAIRS & np.uint64(0xFFFFFFFF)).astype(np.int64)
+                        SIMILARITY = pair_jaccard(
+                            VALUES,
+                            OFFSETS,
+                            np.searchsorted(CANDIDATES, src),
+                            np.searchsorted(CANDIDATES, dst),
+                        )
+                        VERIFIED = SIMILARITY >= threshold
+                        NUM_PAIRS += len(PAIRS)
+                        NUM_VERIFIED += np.count_nonzero(VERIFIED)
+                        np.minimum.at(FIRST_BAND, src[VERIFIED], PAIR_BANDS[VERIFIED])
+                        np.minimum.at(FIRST_BAND, dst[VERIFIED], PAIR_BANDS[VERIFIED])
+                        uf.union_pairs(src[VERIFIED], dst[VERIFIED])
+                        PASSED = PAIRS[VERIFIED]
+                        EDGES = [
+                            relink_unverified(
+                                src,
+                                dst,
+                                np.isin((src.astype(np.uint64) << np.uint64(32)) | dst.astype(np.uint64), PASSED),
+                            )
+                            for src, dst in EDGES
+                        ]
+                    logger.info(f"Verified {NUM_VERIFIED}/{NUM_PAIRS} candidate pairs")
+                if memory_budget is not None:
+                    shutil.rmtree(SPILL_DIR)
+                if memory_budget is None and PENDING:
+                    del KEYS
+                if shared_keys:
+                    KEYS_PATH.unlink()
+                checkpoints.save("union-find", parent=uf.parent, rank=uf.rank, first_band=FIRST_BAND)
+            else:
+                HASH_TABLES = [defaultdict(set) for _ in range(B)]
+                for i in tqdm(
+                    range(0, len(embedded), 10000), dynamic_ncols=True, desc="Iterating MinHashes..."  # noqa: E501
+                ):
+                    batch = embedded[i : i + 10000]
+                    for key, Hs in zip(batch["__id__"], batch["__signatures__"]):
+                        for H, hashtable in zip(Hs, HASH_TABLES):
+                            hashtable[H].add(key)
+                for band_idx, table in enumerate(tqdm(HASH_TABLES, dynamic_ncols=True, desc="Clustering...")):
+                    src: List[int] = []
+                    dst: List[int] = []
+                    for cluster in table.values():
+                        if len(cluster) <= 1:
+                            continue
+                        idx = min(cluster)
+                        src.extend(cluster)
+                        dst.extend([idx] * len(cluster))
+                    FIRST_BAND[src] = np.minimum(FIRST_BAND[src], band_idx)
+                    uf.union_pairs(np.array(src), np.array(dst))
+                del HASH_TABLES
+            time_measures[f"clustering{SUFFIX}"] = time.time() - time_measures[f"clustering{SUFFIX}"]
+
+            time_measures[f"filtering{SUFFIX}"] = time.time()
+            # exact copies join the cluster of their representative
+            CLUSTERS = REPRESENTATIVES[uf.cluster_ids()][np.searchsorted(REPRESENTATIVES, EXACT)]
+            if rank:
+                CLUSTERS = ranked_clusters(CLUSTERS, RANK_KEYS)
+            # This is where the deduplication happens: the first (or best) document of every cluster is kept
+            KEEP = np.flatnonzero(CLUSTERS == np.arange(DATA_SIZE))
+            BANDS = None
+            if memory_budget is None:
+                BANDS = np.where(FIRST_BAND == NOT_LINKED, -1, FIRST_BAND)[np.searchsorted(REPRESENTATIVES, EXACT)]
+                BANDS[EXACT != np.arange(DATA_SIZE)] = -1
+            write_audit(OUTPUT_BASE / f"threshold-{threshold}" if MULTI else OUTPUT_BASE, CLUSTERS, BANDS)
+            time_measures[f"filtering{SUFFIX}"] = time.time() - time_measures[f"filtering{SUFFIX}"]
+
+            if MULTI:
+                CLUSTER_SIZES = np.bincount(CLUSTERS)
+                THRESHOLD_DIR = OUTPUT_BASE / f"threshold-{threshold}"
+                np.save(THRESHOLD_DIR / "keep.npy", KEEP)
+                SUMMARIES.append(
+                    {
+                        "threshold": threshold,
+                        "b": B,
+                        "r": R,
+                        "before": DATA_SIZE,
+                        "after": len(KEEP),
+                        "duplicates": DATA_SIZE - len(KEEP),
+                        "clusters": int(np.count_nonzero(CLUSTER_SIZES > 1)),
+                        "largest_cluster": int(CLUSTER_SIZES.max()),
+                    }
+                )
+                (THRESHOLD_DIR / "summary.json").write_text(json.dumps(SUMMARIES[-1], indent=2))
+
+        if MULTI:
+            PAD = 32
+            for key, value in time_measures.items():
+                if key in REUSED:
+                    key = f"{key} (reused)"
+                logger.info(f"{key:<{PAD}}: {value:.2f} seconds")
+            logger.info(f"{'Data Number (before)':<{PAD}}: {DATA_SIZE}")
+            for summary in SUMMARIES:
+                logger.info(
+                    f"{'Threshold ' + str(summary['threshold']):<{PAD}}: b={summary['b']}, r={summary['r']}, "
+                    f"{summary['after']} kept ({summary['after'] / DATA_SIZE:.2%}), "
+                    f"{summary['duplicates']} duplicates, largest cluster {summary['largest_cluster']}"
+                )
+            logger.info(f"{'Total Time':<{PAD}}: {time.time() - start_time:.2f} seconds")
+            logger.info(f"{'Keep Indices':<{PAD}}: {OUTPUT_BASE}/threshold-*/keep.npy")
+            return
 
         time_measures["save"] = time.time()
-        final_data = final_data.remove_columns(["__cluster__"])
-        final_data.save_to_disk(output)
+        if parquet_dir is not None:
+            KEPT = np.zeros(DATA_SIZE, dtype=bool)
+            KEPT[KEEP] = True
+            FINAL_DATA_SIZE = shards.filter(KEPT, output)
+        else:
+            final_data = ds.select(KEEP)
+            final_data.save_to_disk(str(output))
+            FINAL_DATA_SIZE = len(final_data)
         time_measures["save"] = time.time() - time_measures["save"]
 
-        FINAL_DATA_SIZE = len(final_data)
         DUP_SIZE = DATA_SIZE - FINAL_DATA_SIZE
         PAD = 32
 
         for key, value in time_measures.items():
+            if key in REUSED:
+                key = f"{key} (reused)"
             logger.info(f"{key:<{PAD}}: {value:.2f} seconds")
         logger.info(f"{'Data Number (before)':<{PAD}}: {DATA_SIZE}")
         logger.info(
             f"{'Data Number (after)':<{PAD}}: {FINAL_DATA_SIZE} ({FINAL_DATA_SIZE / DATA_SIZE:.2%})"  # noqa: E501
         )
         logger.info(f"{'Duplicate Number':<{PAD}}: {DUP_SIZE} ({DUP_SIZE / DATA_SIZE:.2%})")  # noqa: E501
+        if exact_dedup:
+            EXACT_SIZE = DATA_SIZE - NUM_FINGERPRINTED
+            logger.info(f"{'Exact Duplicate Number':<{PAD}}: {EXACT_SIZE} ({EXACT_SIZE / DATA_SIZE:.2%})")
+            logger.info(
+                f"{'Fingerprinting Skipped':<{PAD}}: {SKIPPED_BYTES / 2**20:.2f} MB "
+                f"({SKIPPED_BYTES / max(1, SIZES.sum()):.2%} of the content)"
+            )
         logger.info(f"{'Total Time':<{PAD}}: {time.time() - start_time:.2f} seconds")
         logger.info(f"{'Deduplicated Dataset':<{PAD}}: {output}")
+        logger.info(f"{'Cluster Audit':<{PAD}}: {OUTPUT_BASE / 'clusters.parquet'}")
         logger.info("🤗 Happy Deduplicating 🤗")
 
     mp.set_start_method("fork", force=True)
-    uf = UnionFind()
     typer.run(run)
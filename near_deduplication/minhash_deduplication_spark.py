@@ -2,17 +2,27 @@ import hashlib
 import re
 import struct
 import sys
+from functools import partial
 from itertools import tee
 from logging import Logger
 from typing import Iterable
 from typing import List
-from typing import Tuple
 
 import numpy as np
 from pyspark import SparkConf
 from pyspark.sql import SparkSession
 from pyspark.sql import functions as F
-from scipy.integrate import quad as integrate
+
+from utils.lsh import optimal_param
+from utils.sketches import SKETCHES
+from utils.sketches import densify_table
+from utils.sketches import oph_signatures
+from utils.spark import BAND_SCHEMA
+from utils.spark import band_edges
+from utils.spark import band_frames
+from utils.spark import bucket_table
+from utils.spark import connected_components
+from utils.spark import write_parquet
 
 SEED = 42
 NON_ALPHA = re.compile("[^A-Za-z_0-9]")
@@ -21,33 +31,6 @@ MAX_HASH = np.uint64((1 << 32) - 1)
 MERSENNE_PRIME = np.uint64((1 << 61) - 1)
 
 
-# Connected Components in MapReduce and Beyond
-def large_star_map(edge):
-    return [(edge[0], edge[1]), (edge[1], edge[0])]
-
-
-def large_star_reduce(group):
-    x, neighbors = group
-    nodes = [x] + list(neighbors)
-    minimum = min(nodes)
-    return [(n, minimum) for n in nodes if n > x]
-
-
-def small_star_map(edge):
-    x, y = edge
-    if y <= x:
-        return (x, y)
-    else:
-        return (y, x)
-
-
-def small_star_reduce(group):
-    x, neighbors = group
-    nodes = [x] + list(neighbors)
-    minimum = min(nodes)
-    return [(n, minimum) for n in nodes if n != minimum]
-
-
 def ngrams(sequence: List[str], n: int, min_ngram_size: int = 5) -> Iterable:
     """
     Code taken from NLTK, without padding.
@@ -108,135 +91,46 @@ def sha1_hash32(data):
     return struct.unpack("<I", hashlib.sha1(data).digest()[:4])[0]
 
 
-def generate_hash_values(
+def minhash_signature(
     content: str,
-    idx: int,
     num_perm: int,
     ngram_size: int,
-    hashranges: List[Tuple[int, int]],
     permutations: np.ndarray,
     min_ngram_size: int,
-) -> List[Tuple[int, bytes, int]]:
+    sketch: str = "minhash",
+) -> np.ndarray:
     """
-    Generate the MinHashLSH values for a given document.
+    The MinHash signature of a document.
 
     Parameters
     ----------
     content : str
         The content of the document.
-    idx : int
-        The index of the document.
     num_perm : int
         The number of permutations.
     ngram_size : int
         The size of the n-grams.
-    hashranges : list
-        The ranges of offsets for each hash value.
     permutations : np.ndarray
         The permutations for the hash values.
     min_ngram_size : int
         The minimum number of items in the sequence to generate n-grams.
+    sketch : str
+        `minhash` for classic MinHash, or `oph` for one-permutation hashing with densification.
 
     Returns
     -------
-    List[Tuple[int, bytes, int]]
-        The list of (band_idx, hash value, idx) for the document.
+    np.ndarray
+        The `num_perm` hash values.
     """
     hashvalues = np.ones(num_perm, dtype=np.uint64) * MAX_HASH
     tokens = {" ".join(t) for t in ngrams(NON_ALPHA.split(content), ngram_size, min_ngram_size)}
     hv = np.array([sha1_hash32(token.encode("utf-8")) for token in tokens], dtype=np.uint64)
     a, b = permutations
+    if sketch == "oph":
+        values = np.bitwise_and((hv * a[0] + b[0]) % MERSENNE_PRIME, MAX_HASH)
+        return oph_signatures(values, np.array([0, len(hv)]), num_perm, densify_table(num_perm))[0]
     phv = np.bitwise_and(((hv * np.tile(a, (len(hv), 1)).T).T + b) % MERSENNE_PRIME, MAX_HASH)
-    hashvalues = np.vstack([phv, hashvalues]).min(axis=0)
-    Hs = [bytes(hashvalues[start:end].byteswap().data) for start, end in hashranges]
-    return [(band_idx, H, idx) for band_idx, H in enumerate(Hs)]
-
-
-def optimal_param(
-    threshold: float,
-    num_perm: int,
-    false_positive_weight: float = 0.5,
-    false_negative_weight: float = 0.5,
-):
-    """
-    Compute the optimal `MinHashLSH` parameter that minimizes the weighted sum
-    of probabilities of false positive and false negative, taken from datasketch.
-
-    Parameters
-    ----------
-    threshold : float
-        The threshold for similarity.
-    num_perm : int
-        The number of permutations.
-    false_positive_weight : float
-        The weight of false positive.
-    false_negative_weight : float
-        The weight of false negative.
-
-    Returns
-    -------
-    Tuple[int, int]
-        The optimal `b` and `r` parameters.
-        The number of bands, and the number of rows per band respectively.
-
-    Examples
-    --------
-    >>> optimal_param(0.7, 256)
-    (25, 10)
-    """
-
-    def false_positive_probability(threshold: float, b: int, r: int):
-        """Source: `datasketch.lsh`"""
-
-        def proba(s):
-            return 1 - (1 - s ** float(r)) ** float(b)
-
-        a, _ = integrate(proba, 0.0, threshold)
-        return a
-
-    def false_negative_probability(threshold: float, b: int, r: int):
-        """Source: `datasketch.lsh`"""
-
-        def proba(s):
-            return 1 - (1 - (1 - s ** float(r)) ** float(b))
-
-        a, _ = integrate(proba, threshold, 1.0)
-        return a
-
-    min_error = float("inf")
-    opt = (0, 0)
-    for b in range(1, num_perm + 1):
-        max_r = int(num_perm / b)
-        for r in range(1, max_r + 1):
-            fp = false_positive_probability(threshold, b, r)
-            fn = false_negative_probability(threshold, b, r)
-            error = fp * false_positive_weight + fn * false_negative_weight
-            if error < min_error:
-                min_error = error
-                opt = (b, r)
-    return opt
-
-
-def generate_edges(nodes: List[int]) -> List[Tuple[int, int]]:
-    """
-    Generate edges from a cluster. Instead of generating N^2 edges, we only need all nodes align to a single node, since
-    we will be running connected components on the edges later.
-
-    Parameters
-    ----------
-    nodes : List[int]
-        The list of nodes in the cluster.
-
-    Returns
-    -------
-    List[Tuple[int, int]]
-        The list of edges.
-    """
-    if len(nodes) <= 1:
-        return []
-
-    min_node = min(nodes)
-    return [(n, min_node) for n in nodes if n != min_node]
+    return np.vstack([phv, hashvalues]).min(axis=0)
 
 
 if __name__ == "__main__":
@@ -252,7 +146,20 @@ if __name__ == "__main__":
     parser.add_argument("--b", type=int, default=None, help="Number of bands")
     parser.add_argument("--r", type=int, default=None, help="Number of rows per band")
     parser.add_argument("--column", "-c", type=str, default="content", help="Column to deduplicate")
+    parser.add_argument(
+        "--band_bits", type=int, default=32, choices=[32, 16, 8], help="Bits per hash value in the LSH bands"
+    )
+    parser.add_argument("--sketch", type=str, default="minhash", choices=SKETCHES, help="Signature algorithm")
     parser.add_argument("--output", "-o", type=str, required=True, help="Output directory")
+    parser.add_argument("--target_file_mb", type=int, default=256, help="Target size of each output file in MB")
+    parser.add_argument("--row_group_mb", type=int, default=128, help="Parquet row group size in MB")
+    parser.add_argument(
+        "--compression", type=str, default="snappy", choices=["snappy", "zstd"], help="Parquet compression"
+    )
+    parser.add_argument("--checkpoint_dir", type=str, default="./checkpoints", help="Checkpoint directory")
+    parser.add_argument(
+        "--checkpoint_interval", type=int, default=5, help="Connected components rounds between two checkpoints"
+    )
     args = parser.parse_args()
 
     conf = SparkConf()
@@ -260,6 +167,7 @@ if __name__ == "__main__":
     conf.set("spark.debug.maxToStringFields", "100")
     spark = SparkSession.builder.config(conf=conf).getOrCreate()
     log: Logger = spark.sparkContext._jvm.org.apache.log4j.LogManager.getLogger(__name__)  # type: ignore
+    spark.sparkContext.setCheckpointDir(args.checkpoint_dir)
 
     if args.b is None or args.r is None:
         B, R = optimal_param(args.threshold, args.num_perm)
@@ -281,51 +189,43 @@ if __name__ == "__main__":
 
     df = spark.read.format("bigquery").option("table", args.table).load()
     df = df.withColumn("__id__", F.monotonically_increasing_id()).cache()
-    records = df.select("__id__", args.column).rdd
-    records = records.repartition(args.num_perm * 2).cache()
-
-    edges = (
-        records.flatMap(
-            lambda x: generate_hash_values(
-                content=x[1],
-                idx=x[0],
-                num_perm=args.num_perm,
-                ngram_size=args.ngram_size,
-                hashranges=HASH_RANGES,
-                permutations=PERMUTATIONS,
-                min_ngram_size=args.min_ngram_size,
-            )
-        )
-        .groupBy(lambda x: (x[0], x[1]))
-        .flatMap(lambda x: generate_edges([i[2] for i in x[1]]))
-        .distinct()
-        .cache()
+    NUM_ROWS = df.count()
+    records = df.select("__id__", args.column).repartition(args.num_perm * 2)
+    signature = partial(
+        minhash_signature,
+        num_perm=args.num_perm,
+        ngram_size=args.ngram_size,
+        permutations=PERMUTATIONS,
+        min_ngram_size=args.min_ngram_size,
+        sketch=args.sketch,
     )
+    bands = records.mapInPandas(
+        lambda frames: band_frames(frames, args.column, signature, HASH_RANGES, args.band_bits),
+        schema=BAND_SCHEMA,
+    )
+    edges = band_edges(bucket_table(bands)).select("src", "dst")
+    components = connected_components(edges, args.checkpoint_interval)
 
-    a = edges
-    while True:
-        b = a.flatMap(large_star_map).groupByKey().flatMap(large_star_reduce).distinct().cache()
-        a = b.map(small_star_map).groupByKey().flatMap(small_star_reduce).distinct().cache()
-        changes = a.subtract(b).union(b.subtract(a)).collect()
-        if len(changes) == 0:
-            break
-
-    results = a.collect()
-    if len(results) == 0:
+    NUM_DUPLICATES = components.count()
+    if NUM_DUPLICATES == 0:
         log.info("No components found.")
-        df.write.option(
-            "maxRecordsPerFile", 300_000
-        ).option(
-            "intermediateFormat", "orc"
-        ).parquet(args.output, mode="overwrite")
+        write_parquet(
+            df,
+            args.output,
+            num_rows=NUM_ROWS,
+            target_file_mb=args.target_file_mb,
+            row_group_mb=args.row_group_mb,
+            compression=args.compression,
+        )
         sys.exit(0)
 
-    components = spark.createDataFrame(results, schema=["__id__", "component"]).sort(["component", "__id__"])
-    components.show()
-    df = df.join(components, on="__id__", how="left")
-    df = df.filter(F.col("component").isNull()).drop("__id__", "component").cache()
-    df.write.option(
-        "maxRecordsPerFile", 300_000
-    ).option(
-        "intermediateFormat", "orc"
-    ).parquet(args.output, mode="overwrite")
+    log.info(f"Removing {NUM_DUPLICATES} duplicates.")
+    df = df.join(components, on="__id__", how="left_anti").drop("__id__").cache()
+    write_parquet(
+        df,
+        args.output,
+        num_rows=NUM_ROWS - NUM_DUPLICATES,
+        target_file_mb=args.target_file_mb,
+        row_group_mb=args.row_group_mb,
+        compression=args.compression,
+    )
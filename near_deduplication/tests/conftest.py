@@ -0,0 +1,13 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def spark():
+    from pyspark.sql import SparkSession
+
+    try:
+        session = SparkSession.builder.master("local[2]").config("spark.sql.shuffle.partitions", "4").getOrCreate()
+    except Exception as e:  # no Java
+        pytest.skip(f"Spark is not available: {e}")
+    yield session
+    session.stop()
@@ -0,0 +1,24 @@
+import json
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from minhash_deduplication import UnionFind
+from utils.audit import write_audit
+
+
+def test_audit_from_union_find(tmp_path):
+    uf = UnionFind(8)
+    uf.union_pairs(np.array([2, 5, 6, 7]), np.array([1, 2, 1, 3]))
+    clusters = uf.cluster_ids()
+    bands = np.array([-1, 0, 0, 4, -1, 1, 3, 4])
+    write_audit(tmp_path, clusters, bands, top=1)
+
+    table = pq.read_table(tmp_path / "clusters.parquet").to_pydict()
+    assert table["__id__"] == [1, 2, 3, 5, 6, 7]
+    assert table["__root__"] == [1, 1, 3, 1, 1, 3]
+    assert table["__size__"] == [4, 4, 2, 4, 4, 2]
+    assert table["__band__"] == [0, 0, 4, 1, 3, 4]
+    summary = json.loads((tmp_path / "clusters.json").read_text())
+    assert summary["histogram"] == {"2": 1, "4": 1}
+    assert summary["largest"] == [{"root": 1, "size": 4}]
@@ -0,0 +1,67 @@
+import numpy as np
+
+from minhash_deduplication import UnionFind
+from utils.bucketing import band_keys
+from utils.bucketing import bucket_edges
+from utils.bucketing import exact_representatives
+from utils.bucketing import load_partition
+from utils.bucketing import relink_unverified
+from utils.bucketing import spill_band_keys
+
+RNG = np.random.RandomState(0)
+SIGNATURES = RNG.randint(0, 4, size=(500, 12)).astype(np.uint64)
+HASH_RANGES = [(0, 3), (3, 6), (6, 9), (9, 12)]
+
+
+def in_memory_clusters(keys):
+    uf = UnionFind(len(keys))
+    for band in keys.T:
+        uf.union_pairs(*bucket_edges(band, np.arange(len(keys))))
+    return uf.cluster_ids()
+
+
+def test_bucket_edges_match_band_bytes():
+    keys = band_keys(SIGNATURES, HASH_RANGES)
+    for band_idx, (start, end) in enumerate(HASH_RANGES):
+        groups = {}
+        for i, sig in enumerate(SIGNATURES):
+            groups.setdefault(sig[start:end].tobytes(), []).append(i)
+        expected = {(x, min(g)) for g in groups.values() for x in g if x != min(g)}
+        src, dst = bucket_edges(keys[:, band_idx], np.arange(len(keys)))
+        assert set(zip(src.tolist(), dst.tolist())) == expected
+
+
+def test_spilled_partitions_give_the_same_clusters(tmp_path):
+    keys = band_keys(SIGNATURES, HASH_RANGES)
+    for p in range(4):
+        (tmp_path / f"{p:05d}").mkdir()
+    for start in range(0, len(keys), 64):
+        spill_band_keys(keys[start : start + 64], np.arange(start, min(start + 64, len(keys))), tmp_path, 4)
+    uf = UnionFind(len(keys))
+    for p in range(4):
+        uf.union_pairs(*bucket_edges(*load_partition(tmp_path, p)))
+    assert np.array_equal(uf.cluster_ids(), in_memory_clusters(keys))
+
+
+def test_exact_representatives_merge_back_into_clusters():
+    # rows 250.. are exact copies of rows ..250, clustering the first half is enough
+    keys = band_keys(SIGNATURES, HASH_RANGES)
+    hashes = np.concatenate([np.arange(250), np.arange(250)]).astype(np.uint64)
+    keys[250:] = keys[:250]
+    exact = exact_representatives(hashes)
+    representatives = np.flatnonzero(exact == np.arange(len(exact)))
+    assert representatives.tolist() == list(range(250))
+    clusters = representatives[in_memory_clusters(keys[representatives])][np.searchsorted(representatives, exact)]
+    assert np.array_equal(clusters, in_memory_clusters(keys))
+
+
+def test_unverified_members_are_compared_with_one_another():
+    # one bucket of 0, 3, 5 and 8, where only 3 and 5 are near-duplicates and 8 is similar to 0
+    similar = {(3, 5), (0, 8)}
+    src, dst = bucket_edges(np.zeros(4, dtype=np.uint64), np.array([0, 3, 5, 8]))
+    found = set()
+    while len(src):
+        verified = np.array([(min(a, b), max(a, b)) in similar for a, b in zip(src.tolist(), dst.tolist())])
+        found |= {(min(a, b), max(a, b)) for a, b in zip(src[verified].tolist(), dst[verified].tolist())}
+        src, dst = relink_unverified(src, dst, verified)
+    assert found == similar
@@ -0,0 +1,27 @@
+import numpy as np
+
+from minhash_deduplication import UnionFind
+from utils.checkpoint import Checkpoints
+
+PARAMS = {"num_rows": 10, "hashranges": [(0, 2), (2, 4)], "band_bits": 32}
+
+
+def test_resume_union_find(tmp_path):
+    uf = UnionFind(10)
+    uf.union_pairs(np.array([1, 3, 5]), np.array([0, 1, 4]))
+    Checkpoints(tmp_path, PARAMS).save("union-find", parent=uf.parent, rank=uf.rank)
+
+    checkpoints = Checkpoints(tmp_path, PARAMS)
+    assert checkpoints.done("union-find")
+    resumed = UnionFind(10)
+    arrays = checkpoints.load("union-find")
+    resumed.parent, resumed.rank = arrays["parent"], arrays["rank"]
+    assert np.array_equal(resumed.cluster_ids(), uf.cluster_ids())
+
+
+def test_stale_or_unfinished_stages_are_not_done(tmp_path):
+    Checkpoints(tmp_path, PARAMS).save("band-00000", src=np.arange(3), dst=np.zeros(3))
+    assert not Checkpoints(tmp_path, {**PARAMS, "band_bits": 16}).done("band-00000")
+    # the arrays without their manifest, as left by a crash in the middle of `save`
+    (tmp_path / "band-00000.json").unlink()
+    assert not Checkpoints(tmp_path, PARAMS).done("band-00000")
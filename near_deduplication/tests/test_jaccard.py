@@ -0,0 +1,26 @@
+import numpy as np
+
+from minhash_deduplication import shingle_func_batched
+from utils.jaccard import jaccard
+from utils.jaccard import pair_jaccard
+
+DOCS = [
+    " ".join(f"tok{i % 40}" for i in range(200)),
+    " ".join(f"tok{i % 50}" for i in range(200)),
+    "def foo(bar):\n    return bar + 1\n" * 5,
+    "short",
+    "",
+]
+
+
+def test_pair_jaccard_matches_sets():
+    shingles = shingle_func_batched(DOCS, ngram_size=3, min_ngram_size=5)["__shingles__"]
+    offsets = np.cumsum([0] + [len(s) for s in shingles])
+    src, dst = np.triu_indices(len(DOCS), k=1)
+    # tiny batches so that pairs are split across them
+    actual = pair_jaccard(np.concatenate(shingles), offsets, src, dst, batch_size=3)
+    expected = [jaccard(shingles[i], shingles[j]) for i, j in zip(src, dst)]
+    assert np.allclose(actual, expected)
+    for (i, j), similarity in zip(zip(src, dst), actual):
+        a, b = set(shingles[i].tolist()), set(shingles[j].tolist())
+        assert similarity == (len(a & b) / len(a | b) if a | b else 1.0)
@@ -0,0 +1,54 @@
+import pytest
+from scipy.integrate import quad as integrate
+
+from utils import lsh
+from utils.lsh import optimal_param
+
+
+def scipy_optimal_param(threshold, num_perm, false_positive_weight=0.5, false_negative_weight=0.5):
+    """The original implementation, with one adaptive integration per area."""
+
+    def false_positive_area(threshold, b, r):
+        a, _ = integrate(lambda s: 1 - (1 - s ** float(r)) ** float(b), 0.0, threshold)
+        return a
+
+    def false_negative_area(threshold, b, r):
+        a, _ = integrate(lambda s: 1 - (1 - (1 - s ** float(r)) ** float(b)), threshold, 1.0)
+        return a
+
+    min_error = float("inf")
+    opt = (0, 0)
+    for b in range(1, num_perm + 1):
+        for r in range(1, int(num_perm / b) + 1):
+            error = (
+                false_positive_area(threshold, b, r) * false_positive_weight
+                + false_negative_area(threshold, b, r) * false_negative_weight
+            )
+            if error < min_error:
+                min_error = error
+                opt = (b, r)
+    return opt
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(lsh, "CACHE_FILE", tmp_path / "optimal_param.json")
+    optimal_param.cache_clear()
+
+
+@pytest.mark.parametrize("num_perm", [64, 128, 250, 256])
+@pytest.mark.parametrize("threshold", [0.5, 0.7, 0.8, 0.85, 0.9])
+def test_parity_with_scipy(threshold, num_perm):
+    assert optimal_param(threshold, num_perm) == scipy_optimal_param(threshold, num_perm)
+
+
+def test_parity_with_weights():
+    assert optimal_param(0.7, 128, 0.2, 0.8) == scipy_optimal_param(0.7, 128, 0.2, 0.8)
+
+
+def test_disk_cache():
+    assert optimal_param(0.7, 256) == (25, 10)
+    assert lsh.CACHE_FILE.exists()
+    optimal_param.cache_clear()
+    lsh.CACHE_FILE.write_text('{"0.7/256/0.5/0.5": [1, 2]}')
+    assert optimal_param(0.7, 256) == (1, 2)
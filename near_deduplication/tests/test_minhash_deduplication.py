@@ -0,0 +1,89 @@
+import multiprocessing as mp
+
+import numpy as np
+
+from minhash_deduplication import MERSENNE_PRIME
+from minhash_deduplication import embed_func
+from minhash_deduplication import embed_func_batched
+from minhash_deduplication import embed_func_shared
+from minhash_deduplication import minhash_signatures
+from minhash_deduplication import shingle_hashes
+from utils.shared_matrix import create_matrix
+
+NUM_PERM = 64
+RNG = np.random.RandomState(0)
+PERMUTATIONS = np.array(
+    [
+        (RNG.randint(1, MERSENNE_PRIME, dtype=np.uint64), RNG.randint(0, MERSENNE_PRIME, dtype=np.uint64))
+        for _ in range(NUM_PERM)
+    ],
+    dtype=np.uint64,
+).T
+HASH_RANGES = [(i * 8, (i + 1) * 8) for i in range(8)]
+DOCS = [
+    "def foo(bar):\n    return bar + 1\n" * 20,
+    "short",
+    "",
+    " ".join(f"x{i} = y{i} * {i}" for i in range(3000)),
+    "import os\nimport sys\nprint(os.path.join(sys.argv[0], 'a'))",
+]
+
+
+def test_embed_func_batched_is_bit_identical():
+    expected = [
+        embed_func(doc, i, num_perm=NUM_PERM, ngram_size=5, hashranges=HASH_RANGES, permutations=PERMUTATIONS)
+        for i, doc in enumerate(DOCS)
+    ]
+    actual = embed_func_batched(
+        DOCS,
+        list(range(len(DOCS))),
+        ngram_size=5,
+        hashranges=HASH_RANGES,
+        permutations=PERMUTATIONS,
+        band_bits=64,
+    )
+    assert actual["__id__"] == [e["__id__"] for e in expected]
+    assert actual["__signatures__"] == [e["__signatures__"] for e in expected]
+
+
+def test_minhash_signatures_across_chunks():
+    hvs = [shingle_hashes(doc, 5, 5) for doc in DOCS]
+    offsets = np.cumsum([0] + [len(hv) for hv in hvs])
+    hashes = np.concatenate(hvs)
+    expected = minhash_signatures(hashes, offsets, PERMUTATIONS)
+    # tiny chunks force documents to span several of them
+    actual = minhash_signatures(hashes, offsets, PERMUTATIONS, chunk_size=7)
+    assert actual.shape == (len(DOCS), NUM_PERM)
+    assert np.array_equal(actual, expected)
+
+
+def test_rolling_hash_scheme_keeps_shingle_structure():
+    for doc in DOCS:
+        sha1 = shingle_hashes(doc, 5, 5)
+        rolling = shingle_hashes(doc, 5, 5, hash_scheme="rolling")
+        assert len(rolling) == len(sha1)
+        assert np.array_equal(rolling, np.unique(rolling))
+    # the same shingles hash the same way wherever they appear
+    a = set(shingle_hashes("a b c d e f g h", 3, 1, hash_scheme="rolling"))
+    b = set(shingle_hashes("x y a b c d e", 3, 1, hash_scheme="rolling"))
+    assert len(a & b) == 3
+
+
+def _embed_shared(task):
+    contents, idx, path = task
+    return embed_func_shared(
+        contents, idx, keys_path=path, ngram_size=5, hashranges=HASH_RANGES, permutations=PERMUTATIONS
+    )
+
+
+def test_shared_keys_are_written_by_the_workers(tmp_path):
+    path = tmp_path / "keys.npy"
+    create_matrix(path, (len(HASH_RANGES), len(DOCS)), np.uint64)
+    # every worker writes its own columns, out of order
+    tasks = [([DOCS[i] for i in idx], idx, str(path)) for idx in ([3, 1], [0, 4], [2])]
+    with mp.get_context("fork").Pool(2) as pool:
+        assert pool.map(_embed_shared, tasks) == [{}, {}, {}]
+    expected = embed_func_batched(
+        DOCS, list(range(len(DOCS))), ngram_size=5, hashranges=HASH_RANGES, permutations=PERMUTATIONS, output="keys"
+    )["__keys__"]
+    assert np.array_equal(np.load(path, mmap_mode="r"), expected.T)
@@ -0,0 +1,41 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from minhash_deduplication import content_hash_batched
+from utils.parquet_shards import ParquetShards
+from utils.signature_store import content_hash
+
+CONTENTS = [f"document {i}" for i in range(23)]
+
+
+def write_shards(directory):
+    directory.mkdir(exist_ok=True)
+    for start, end in [(0, 10), (10, 11), (11, 23)]:
+        table = pa.table({"content": CONTENTS[start:end], "stars": pa.array(range(start, end), pa.int16())})
+        pq.write_table(table, directory / f"shard-{start:02d}.parquet", row_group_size=4)
+
+
+def echo(contents, indices):
+    return {"contents": contents, "indices": indices}
+
+
+def test_map_selected_rows_in_order(tmp_path):
+    write_shards(tmp_path)
+    shards = ParquetShards(tmp_path, "content")
+    rows = np.array([0, 3, 9, 10, 12, 22])
+    batches = list(shards.map(echo, rows=rows, with_indices=True, batch_size=3, num_proc=2))
+    assert [c for batch in batches for c in batch["contents"]] == [CONTENTS[i] for i in rows]
+    assert [i for batch in batches for i in batch["indices"]] == list(range(len(rows)))
+    hashes = np.concatenate([batch["__content_hash__"] for batch in shards.map(content_hash_batched, num_proc=2)])
+    assert hashes.tolist() == [content_hash(c) for c in CONTENTS]
+
+
+def test_filter_keeps_the_schema(tmp_path):
+    write_shards(tmp_path / "input")
+    shards = ParquetShards(tmp_path / "input", "content")
+    keep = np.arange(len(shards)) % 3 == 0
+    assert shards.filter(keep, tmp_path / "output", batch_size=5, num_proc=2) == keep.sum()
+    table = pq.read_table(tmp_path / "output")
+    assert table.column("content").to_pylist() == [c for c, k in zip(CONTENTS, keep) if k]
+    assert table.schema == pq.read_table(tmp_path / "input").schema
@@ -0,0 +1,39 @@
+import numpy as np
+import pyarrow as pa
+
+from utils.ranking import rank_keys
+from utils.ranking import ranked_clusters
+
+
+def test_ranked_clusters_follow_the_ranking_criteria():
+    table = pa.table(
+        {
+            "license_type": ["non_permissive", "permissive", "permissive", "permissive", None, "no_license", None],
+            "star_events_count": [100, 1, 5, 5, 7, None, 0],
+            "fork_events_count": [0, 0, 1, 3, 0, 0, 0],
+            "revision_date": ["2022-01-01", "2022-01-01", "2021-01-01", "2021-01-01", None, "2020-01-01", None],
+            "visit_date": [None] * 7,
+        }
+    )
+    # {0, 1, 2, 3}: the license, then the stars, then the forks, decide
+    # {4, 5}: a known license beats a missing one, whatever the stars
+    # {6}: alone
+    clusters = np.array([0, 0, 0, 0, 4, 4, 6])
+    assert ranked_clusters(clusters, rank_keys(table)).tolist() == [3, 3, 3, 3, 5, 5, 6]
+
+
+def test_ranked_clusters_break_ties_by_index():
+    table = pa.table(
+        {
+            "license_type": ["permissive"] * 3,
+            "star_events_count": [1, 2, 2],
+            "fork_events_count": [0, 0, 0],
+            "revision_date": pa.array([10, 20, 30], pa.timestamp("s")),
+            "visit_date": pa.array([None, 5, 5], pa.timestamp("s")),
+        }
+    )
+    keys = rank_keys(table)
+    # the latest revision wins among the two best starred
+    assert ranked_clusters(np.array([0, 0, 0]), keys).tolist() == [2, 2, 2]
+    keys[3][:] = 0
+    assert ranked_clusters(np.array([0, 0, 0]), keys).tolist() == [1, 1, 1]
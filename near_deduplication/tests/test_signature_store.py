@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from utils.signature_store import check_compatible
+from utils.signature_store import is_complete
+from utils.signature_store import iter_signatures
+from utils.signature_store import num_rows
+from utils.signature_store import store_metadata
+from utils.signature_store import write_signatures
+
+METADATA = store_metadata(
+    seed=42,
+    num_perm=16,
+    ngram_size=5,
+    min_ngram_size=5,
+    hash_name="sha1_hash32",
+    tokenizer="[^A-Za-z_0-9]",
+    permutations=np.arange(32, dtype=np.uint64).reshape(2, 16),
+)
+
+
+def test_round_trip(tmp_path):
+    rng = np.random.RandomState(0)
+    signatures = rng.randint(0, 2**32, size=(250, 16), dtype=np.uint64)
+    ids = np.arange(250)
+    hashes = rng.randint(0, 2**63, size=250, dtype=np.uint64) * np.uint64(2)
+    batches = [(ids[i : i + 100], hashes[i : i + 100], signatures[i : i + 100]) for i in range(0, 250, 100)]
+    write_signatures(tmp_path, batches, METADATA)
+
+    assert is_complete(tmp_path)
+    assert num_rows(tmp_path) == 250
+    loaded = list(iter_signatures(tmp_path, batch_size=64))
+    assert np.array_equal(np.concatenate([i for i, _ in loaded]), ids)
+    assert np.array_equal(np.concatenate([s for _, s in loaded]), signatures)
+
+
+def test_incompatible_store_is_refused(tmp_path):
+    write_signatures(tmp_path, [], METADATA)
+    check_compatible(tmp_path, METADATA)
+    with pytest.raises(ValueError, match="ngram_size"):
+        check_compatible(tmp_path, {**METADATA, "ngram_size": 3})
@@ -0,0 +1,24 @@
+import numpy as np
+
+from utils.sketches import densify_table
+from utils.sketches import oph_signatures
+
+
+def test_oph_agreement_estimates_jaccard():
+    rng = np.random.RandomState(0)
+    num_perm = 256
+    shared = rng.randint(0, 2**32, size=600, dtype=np.uint64)
+    a = np.concatenate([shared, rng.randint(0, 2**32, size=200, dtype=np.uint64)])
+    b = np.concatenate([shared, rng.randint(0, 2**32, size=200, dtype=np.uint64)])
+    offsets = np.array([0, len(a), len(a) + len(b)])
+    sigs = oph_signatures(np.concatenate([a, b]), offsets, num_perm, densify_table(num_perm))
+    # 600 / 1000
+    assert abs((sigs[0] == sigs[1]).mean() - 0.6) < 0.1
+
+
+def test_densification_is_consistent_across_documents():
+    # a handful of shingles leaves most bins empty, equal sets must still get equal signatures
+    values = np.array([5, 2**31, 3 * 2**30], dtype=np.uint64)
+    sigs = oph_signatures(np.concatenate([values, values[::-1]]), np.array([0, 3, 6]), 64, densify_table(64))
+    assert np.array_equal(sigs[0], sigs[1])
+    assert len(np.unique(sigs[0])) == 3
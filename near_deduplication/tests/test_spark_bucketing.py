@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("pyspark")
+
+from utils.spark import BAND_SCHEMA  # noqa: E402
+from utils.spark import band_edges  # noqa: E402
+from utils.spark import bucket_table  # noqa: E402
+from utils.spark import oversized_buckets  # noqa: E402
+
+
+@pytest.fixture
+def bands(spark):
+    # one heavy bucket of 50 documents in band 0, and small buckets of 2 and 3 documents in band 1
+    rows = [(0, b"heavy", idx) for idx in range(10, 60)]
+    rows += [(1, b"pair", 3), (1, b"pair", 70), (1, b"triple", 11), (1, b"triple", 80), (1, b"triple", 81)]
+    rows += [(1, b"alone", 90)]
+    return spark.createDataFrame(rows, schema=BAND_SCHEMA)
+
+
+def edge_set(edges):
+    return {tuple(row) for row in edges.select("src", "dst", "band").collect()}
+
+
+def test_salting_finds_the_same_edges(spark, bands):
+    heavy = spark.createDataFrame([(0, b"heavy")], schema="band int, band_hash binary")
+    expected = edge_set(band_edges(bucket_table(bands)))
+    assert len(expected) == 49 + 1 + 2
+    assert edge_set(band_edges(bucket_table(bands, heavy, num_salts=8))) == expected
+    sizes = {row["__size__"] for row in bucket_table(bands, heavy, num_salts=8).filter("band = 0").collect()}
+    assert sizes == {50}
+
+
+def test_capped_buckets_go_to_the_side_table(spark, bands):
+    heavy = spark.createDataFrame([(0, b"heavy")], schema="band int, band_hash binary")
+    buckets = bucket_table(bands, heavy, num_salts=8)
+    assert edge_set(band_edges(buckets, max_bucket_size=10)) == {(70, 3, 1), (80, 11, 1), (81, 11, 1)}
+    assert [tuple(row) for row in oversized_buckets(buckets, 10).collect()] == [(0, b"heavy", 50)]
@@ -0,0 +1,25 @@
+import random
+
+import pytest
+
+pytest.importorskip("pyspark")
+
+from minhash_deduplication import UnionFind  # noqa: E402
+from utils.spark import connected_components  # noqa: E402
+
+
+def test_connected_components_match_union_find(spark, tmp_path):
+    spark.sparkContext.setCheckpointDir(str(tmp_path))
+    rng = random.Random(0)
+    edges = {(rng.randrange(300), rng.randrange(300)) for _ in range(400)}
+    edges = [(src, dst) for src, dst in edges if src != dst]
+    uf = UnionFind(300)
+    for src, dst in edges:
+        uf.union(src, dst)
+    roots = {}
+    for x in range(300):
+        roots.setdefault(uf.find(x), []).append(x)
+    expected = {(x, min(members)) for members in roots.values() for x in members if x != min(members)}
+    # a checkpoint every other round
+    components = connected_components(spark.createDataFrame(edges, schema="src long, dst long"), 2)
+    assert {(row["__id__"], row["component"]) for row in components.collect()} == expected
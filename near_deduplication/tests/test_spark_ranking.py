@@ -0,0 +1,52 @@
+import datetime
+import random
+from functools import reduce
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pyspark")
+
+from utils.spark import best_duplicates  # noqa: E402
+
+SCHEMA = (
+    "__component__ long, __id__ long, revision_date timestamp, visit_date timestamp, "
+    "fork_events_count long, star_events_count long, license_type string"
+)
+
+
+def compare_records(a, b):
+    """The `reduceByKey` comparator that `best_duplicates` replaced in intra_dedup.py."""
+    return sorted(
+        [a, b],
+        key=lambda x: (
+            ["permissive", "no_license", "non_permissive"].index(x[-1]) if x[-1] is not None else float("inf"),
+            -x[-2] if x[-2] is not None else 0.0,
+            -x[-3] if x[-3] is not None else 0.0,
+            -np.datetime64(x[-5]).astype(np.uint64).item() if x[-5] is not None else float("inf"),
+            -np.datetime64(x[-4]).astype(np.uint64).item() if x[-4] is not None else float("inf"),
+        ),
+    )[0]
+
+
+def test_best_duplicates_match_the_comparator(spark):
+    rng = random.Random(0)
+    day = datetime.datetime(2022, 1, 1)
+    rows = [
+        (
+            rng.randrange(40),
+            idx,
+            rng.choice([None, day + datetime.timedelta(days=rng.randrange(5))]),
+            rng.choice([None, day + datetime.timedelta(hours=rng.randrange(48))]),
+            rng.choice([None, 0, 1, 2]),
+            rng.choice([None, 0, 3, 10]),
+            rng.choice([None, "permissive", "no_license", "non_permissive"]),
+        )
+        for idx in range(2000)
+    ]
+    # reducing in id order, ties keep the smallest id like the window does
+    expected = {
+        reduce(compare_records, [row for row in rows if row[0] == component])[1] for component in {r[0] for r in rows}
+    }
+    actual = {row["__id__"] for row in best_duplicates(spark.createDataFrame(rows, schema=SCHEMA)).collect()}
+    assert actual == expected
@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyspark")
+
+from pyspark.sql import functions as F  # noqa: E402
+
+from utils.spark import BAND_SCHEMA  # noqa: E402
+from utils.spark import EDGE_SCHEMA  # noqa: E402
+from utils.spark import band_edges  # noqa: E402
+from utils.spark import band_frames  # noqa: E402
+from utils.spark import bucket_table  # noqa: E402
+from utils.spark import duplicates_of_reference  # noqa: E402
+from utils.spark import read_signatures  # noqa: E402
+from utils.spark import stored_band_frames  # noqa: E402
+from utils.spark import write_signatures  # noqa: E402
+
+
+def test_reference_duplicates_are_dropped_with_their_copies(spark):
+    # 1 collides with the reference in band 0, 2 is an exact copy of 1, 3 and 4 are near-duplicates of each other
+    bands = spark.createDataFrame(
+        [(0, b"ref", 1), (1, b"one", 1), (0, b"new", 3), (1, b"pair", 3), (0, b"other", 4), (1, b"pair", 4)]
+        + [(0, b"alone", 5), (1, b"alone", 5)],
+        schema=BAND_SCHEMA,
+    )
+    reference = spark.createDataFrame([(0, b"ref", 100), (1, b"pair", 101), (0, b"ref", 102)], schema=BAND_SCHEMA)
+    exact_edges = spark.createDataFrame([(2, 1, -1)], schema=EDGE_SCHEMA)
+    # only the band 0 keys of the reference first, so that 3 and 4 do not collide with it
+    dropped = duplicates_of_reference(bands, reference.filter("band = 0"), exact_edges)
+    assert {row["__id__"] for row in dropped.collect()} == {1, 2}
+
+    remaining = bands.join(dropped, on="__id__", how="left_anti")
+    edges = band_edges(bucket_table(remaining)).select("src", "dst", "band")
+    assert {tuple(row) for row in edges.collect()} == {(4, 3, 1)}
+    # with the band 1 keys, the pair collides with the reference too
+    assert {row["__id__"] for row in duplicates_of_reference(bands, reference, exact_edges).collect()} == {1, 2, 3, 4}
+
+
+def test_reference_written_by_an_earlier_run(spark, tmp_path):
+    # "one" collides with the reference in the first band, "three" and "four" only with each other
+    table = {
+        "ref": np.array([1, 2, 3, 4], dtype=np.uint32),
+        "one": np.array([1, 2, 9, 9], dtype=np.uint32),
+        "three": np.array([5, 6, 7, 8], dtype=np.uint32),
+        "four": np.array([0, 0, 7, 8], dtype=np.uint32),
+        "five": np.array([11, 12, 13, 14], dtype=np.uint32),
+    }
+    hashranges = [(0, 2), (2, 4)]
+    path = str(tmp_path / "reference")
+    metadata = {"seed": 42, "num_perm": 4}
+    earlier = spark.createDataFrame(pd.DataFrame({"__id__": [0], "content": ["ref"]}))
+    write_signatures(spark, earlier, "content", lambda content: table[content], path, metadata)
+
+    reference = read_signatures(spark, path, metadata).select(F.col("__hash__").alias("__id__"), "signature")
+    reference_bands = reference.mapInPandas(
+        lambda frames: stored_band_frames(frames, hashranges, 32), schema=BAND_SCHEMA
+    )
+    documents = spark.createDataFrame(
+        pd.DataFrame({"__id__": [1, 3, 4, 5], "content": ["one", "three", "four", "five"]})
+    )
+    bands = documents.mapInPandas(
+        lambda frames: band_frames(frames, "content", lambda content: table[content], hashranges, 32),
+        schema=BAND_SCHEMA,
+    )
+    exact_edges = spark.createDataFrame([(2, 1, -1)], schema=EDGE_SCHEMA)
+    dropped = duplicates_of_reference(bands, reference_bands, exact_edges)
+    assert {row["__id__"] for row in dropped.collect()} == {1, 2}
+
+    remaining = bands.join(dropped, on="__id__", how="left_anti")
+    edges = band_edges(bucket_table(remaining)).select("src", "dst", "band")
+    assert {tuple(row) for row in edges.collect()} == {(4, 3, 1)}
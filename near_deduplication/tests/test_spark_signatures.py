@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyspark")
+
+from utils.spark import band_frames  # noqa: E402
+from utils.spark import check_signature_metadata  # noqa: E402
+from utils.spark import document_signatures  # noqa: E402
+from utils.spark import read_signatures  # noqa: E402
+from utils.spark import signature_frames  # noqa: E402
+from utils.spark import stored_band_frames  # noqa: E402
+from utils.spark import write_signature_metadata  # noqa: E402
+from utils.spark import write_signatures  # noqa: E402
+
+
+def test_stored_signatures_give_the_same_bands():
+    rng = np.random.RandomState(0)
+    table = {f"doc {i}": rng.randint(0, 2**32, size=16, dtype=np.uint64).astype(np.uint32) for i in range(8)}
+    frames = [pd.DataFrame({"__id__": np.arange(8), "content": list(table)})]
+    hashranges = [(0, 4), (4, 8), (8, 12), (12, 16)]
+    for band_bits in [32, 8]:
+        keys = [frame.assign(__hash__=frame["__id__"] * 7, __length__=frame["content"].str.len()) for frame in frames]
+        stored = [
+            frame.assign(__id__=frame["__hash__"] // 7)[["__id__", "signature"]]
+            for frame in signature_frames(keys, "content", table.get)
+        ]
+        expected = pd.concat(band_frames(frames, "content", table.get, hashranges, band_bits))
+        actual = pd.concat(stored_band_frames(stored, hashranges, band_bits))
+        pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_signatures_made_differently_are_refused(spark, tmp_path):
+    metadata = {"seed": 42, "num_perm": 16, "ngram_size": 5, "hash_name": "xxh32"}
+    path = str(tmp_path / "signatures")
+    with pytest.raises(ValueError, match="no _signature_metadata"):
+        check_signature_metadata(spark, path, metadata)
+    write_signature_metadata(spark, path, metadata)
+    check_signature_metadata(spark, path, metadata)
+    with pytest.raises(ValueError, match="ngram_size"):
+        check_signature_metadata(spark, path, {**metadata, "ngram_size": 3})
+
+
+def test_signatures_are_matched_by_content(spark, tmp_path):
+    rng = np.random.RandomState(0)
+    table = {f"doc {i}": rng.randint(0, 2**32, size=16, dtype=np.uint64).astype(np.uint32) for i in range(6)}
+    path = str(tmp_path / "signatures")
+    metadata = {"seed": 42, "num_perm": 16}
+    first = spark.createDataFrame(pd.DataFrame({"__id__": np.arange(6), "content": list(table)}))
+    write_signatures(spark, first, "content", table.get, path, metadata)
+    # another run reads the files in another order, with other ids and an exact copy
+    contents = list(reversed(table)) + ["doc 0"]
+    second = spark.createDataFrame(pd.DataFrame({"__id__": np.arange(7) * 10, "content": contents}))
+    matched = document_signatures(read_signatures(spark, path, metadata), second, "content").toPandas()
+    assert len(matched) == 7
+    for id_, signature in zip(matched["__id__"], matched["signature"]):
+        expected = table[contents[id_ // 10]].view(np.int32)
+        np.testing.assert_array_equal(np.asarray(signature, dtype=np.int32), expected)
+    missing = spark.createDataFrame(pd.DataFrame({"__id__": [0], "content": ["doc 9"]}))
+    assert document_signatures(read_signatures(spark, path, metadata), missing, "content").toPandas()[
+        "signature"
+    ].isna().all()
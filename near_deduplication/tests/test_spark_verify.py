@@ -0,0 +1,24 @@
+import zlib
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pyspark")
+
+from utils.spark import candidate_shingles  # noqa: E402
+from utils.spark import verified_edges  # noqa: E402
+
+
+def test_pairs_below_the_threshold_are_dropped(spark):
+    documents = spark.createDataFrame(
+        [(0, "a b c d e"), (1, "a b c d e"), (2, "a b c d f"), (3, "x y z")], schema="__id__ long, content string"
+    )
+    # 0-1 are identical, 0-2 have a similarity of 4 / 6 and 0-3 of 0
+    candidates = spark.createDataFrame([(1, 0, 0), (2, 0, 1), (3, 0, 2)], schema="src long, dst long, band int")
+    # a lambda is pickled by value, the workers cannot import this module
+    word_shingles = lambda content: np.unique(  # noqa: E731
+        np.array([zlib.crc32(word.encode()) for word in content.split()], dtype=np.uint32)
+    )
+    shingles = candidate_shingles(candidates, documents, "content", word_shingles).cache()
+    assert {tuple(row) for row in verified_edges(candidates, shingles, 0.6).collect()} == {(1, 0, 0), (2, 0, 1)}
+    assert {tuple(row) for row in verified_edges(candidates, shingles, 0.7).collect()} == {(1, 0, 0)}
@@ -0,0 +1,17 @@
+import pyarrow.parquet as pq
+import pytest
+
+pytest.importorskip("pyspark")
+
+from utils.spark import write_parquet  # noqa: E402
+
+
+def test_write_parquet_targets_the_file_size(spark, tmp_path):
+    df = spark.createDataFrame([(i, "x" * 1000) for i in range(4000)], schema="__id__ long, content string")
+    # about 4 MB of rows, in files of 1 MB
+    write_parquet(df.coalesce(1), str(tmp_path), num_rows=4000, target_file_mb=1)
+    files = list(tmp_path.glob("*.parquet"))
+    assert 4 <= len(files) <= 6
+    table = pq.read_table(str(tmp_path))
+    assert table.column_names == ["__id__", "content"]
+    assert sorted(table.column("__id__").to_pylist()) == list(range(4000))
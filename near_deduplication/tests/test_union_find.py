@@ -0,0 +1,35 @@
+import numpy as np
+
+from minhash_deduplication import UnionFind
+
+
+def naive_cluster_ids(size, edges):
+    labels = list(range(size))
+    changed = True
+    while changed:
+        changed = False
+        for x, y in edges:
+            low = min(labels[x], labels[y])
+            if labels[x] != low or labels[y] != low:
+                labels[x] = labels[y] = low
+                changed = True
+    return labels
+
+
+def test_union_pairs_matches_naive_components():
+    rng = np.random.RandomState(0)
+    size = 2000
+    src = rng.randint(0, size, size=1500)
+    dst = rng.randint(0, size, size=1500)
+    uf = UnionFind(size)
+    uf.union_pairs(src, dst)
+    assert uf.cluster_ids().tolist() == naive_cluster_ids(size, list(zip(src, dst)))
+
+
+def test_long_chain_and_scalar_api():
+    size = 100_000
+    uf = UnionFind(size)
+    uf.union_pairs(np.arange(1, size), np.arange(size - 1))
+    uf.union(5, 3)
+    assert uf.find(size - 1) == uf.find(0)
+    assert set(uf.cluster_ids().tolist()) == {0}
@@ -0,0 +1,115 @@
+"""
+Audit tables of the near-duplicate clusters, written next to the deduplicated output so that the
+clusters can be inspected without rerunning anything or joining the text back.
+
+`clusters.parquet` has one row per document in a cluster of two or more: its `__id__`, the
+`__root__` of its cluster (the document that is kept), the `__size__` of the cluster, and the
+`__band__` that first linked the document to another one. The band is -1 for a document that was
+only linked as an exact copy, and null where bands are not tracked. `clusters.json` summarizes the
+cluster sizes and lists the largest clusters.
+"""
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any
+from typing import Dict
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+TABLE_FILE = "clusters.parquet"
+SUMMARY_FILE = "clusters.json"
+
+
+def cluster_table(clusters: np.ndarray, bands: np.ndarray | None = None) -> pa.Table:
+    """
+    The members of every non-trivial cluster.
+
+    Parameters
+    ----------
+    clusters : np.ndarray
+        The cluster root of each document.
+    bands : np.ndarray | None
+        The band that first linked each document, or None if it is not tracked.
+
+    Returns
+    -------
+    pa.Table
+        The `__id__`, `__root__`, `__size__` and `__band__` of every document in a cluster.
+
+    Examples
+    --------
+    >>> cluster_table(np.array([0, 1, 0, 3, 1]), np.array([2, 0, 2, -1, 5])).to_pydict()
+    {'__id__': [0, 1, 2, 4], '__root__': [0, 1, 0, 1], '__size__': [2, 2, 2, 2], '__band__': [2, 0, 2, 5]}
+    """
+    sizes = np.bincount(clusters, minlength=len(clusters))[clusters]
+    members = np.flatnonzero(sizes > 1)
+    if bands is None:
+        band_column = pa.nulls(len(members), pa.int16())
+    else:
+        band_column = pa.array(bands[members].astype(np.int16))
+    return pa.table(
+        {
+            "__id__": pa.array(members.astype(np.uint64)),
+            "__root__": pa.array(clusters[members].astype(np.uint64)),
+            "__size__": pa.array(sizes[members].astype(np.uint32)),
+            "__band__": band_column,
+        }
+    )
+
+
+def cluster_summary(clusters: np.ndarray, top: int = 10) -> Dict[str, Any]:
+    """
+    Summarize the clusters: a histogram of their sizes and the largest ones.
+
+    Parameters
+    ----------
+    clusters : np.ndarray
+        The cluster root of each document.
+    top : int
+        The number of largest clusters to list.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The summary.
+
+    Examples
+    --------
+    >>> summary = cluster_summary(np.array([0, 0, 0, 3, 3, 5]), top=1)
+    >>> summary["histogram"], summary["largest"]
+    ({'2': 1, '3': 1}, [{'root': 0, 'size': 3}])
+    """
+    counts = np.bincount(clusters, minlength=len(clusters))
+    roots = np.flatnonzero(counts > 1)
+    sizes, frequencies = np.unique(counts[roots], return_counts=True)
+    largest = roots[np.argsort(-counts[roots], kind="stable")[:top]]
+    return {
+        "documents": len(clusters),
+        "clusters": len(roots),
+        "clustered_documents": int(counts[roots].sum()),
+        "histogram": {str(size): int(frequency) for size, frequency in zip(sizes, frequencies)},
+        "largest": [{"root": int(root), "size": int(counts[root])} for root in largest],
+    }
+
+
+def write_audit(directory: str | Path, clusters: np.ndarray, bands: np.ndarray | None = None, top: int = 10):
+    """
+    Write the cluster table and its summary.
+
+    Parameters
+    ----------
+    directory : str | Path
+        The output directory.
+    clusters : np.ndarray
+        The cluster root of each document.
+    bands : np.ndarray | None
+        The band that first linked each document, or None if it is not tracked.
+    top : int
+        The number of largest clusters listed in the summary.
+    """
+    directory = Path(directory)
+    pq.write_table(cluster_table(clusters, bands), directory / TABLE_FILE)
+    (directory / SUMMARY_FILE).write_text(json.dumps(cluster_summary(clusters, top), indent=2))
@@ -0,0 +1,353 @@
+"""Sort-based LSH bucketing: band keys in flat NumPy arrays instead of dict-of-sets hash tables."""
+from __future__ import annotations
+
+import math
+import os
+from pathlib import Path
+from typing import List
+from typing import Tuple
+
+import numpy as np
+import pyarrow as pa
+
+# 64-bit FNV prime and the murmur3 `fmix64` constants
+KEY_PRIME = np.uint64(0x100000001B3)
+FMIX_C1 = np.uint64(0xFF51AFD7ED558CCD)
+FMIX_C2 = np.uint64(0xC4CEB9FE1A85EC53)
+# band value dtypes: `64` is the legacy big-endian uint64 layout, `32` is lossless for 32-bit hash
+# values, `16` and `8` are b-bit minwise truncations
+BAND_DTYPES = {64: ">u8", 32: "<u4", 16: "<u2", 8: "u1"}
+# a spilled record is a uint64 key and a uint64 id; sorting a partition needs about four times that
+RECORD_BYTES = 16
+SORT_OVERHEAD = 4
+
+
+def fmix64(h: np.ndarray) -> np.ndarray:
+    """
+    Murmur3 64-bit finalizer, applied in place, so that every bit of the key depends on every
+    bit of the band.
+
+    Parameters
+    ----------
+    h : np.ndarray
+        The `uint64` values to mix.
+
+    Returns
+    -------
+    np.ndarray
+        The mixed values.
+    """
+    h ^= h >> np.uint64(33)
+    h *= FMIX_C1
+    h ^= h >> np.uint64(33)
+    h *= FMIX_C2
+    h ^= h >> np.uint64(33)
+    return h
+
+
+def truncate_signatures(signatures: np.ndarray, band_bits: int = 32) -> np.ndarray:
+    """
+    Keep the lowest `band_bits` bits of every hash value (b-bit minwise hashing), in the smallest
+    dtype that holds them. Bands packed from the result are `band_bits / 8` bytes per row.
+
+    Parameters
+    ----------
+    signatures : np.ndarray
+        The signatures, with 32-bit hash values.
+    band_bits : int
+        The number of bits kept per hash value, one of 64, 32, 16 or 8.
+
+    Returns
+    -------
+    np.ndarray
+        The truncated signatures.
+
+    Examples
+    --------
+    >>> truncate_signatures(np.array([0x12345678], dtype=np.uint64), 16).tobytes().hex()
+    '7856'
+    >>> truncate_signatures(np.array([0x12345678], dtype=np.uint64), 64).tobytes().hex()
+    '0000000012345678'
+    """
+    if band_bits not in BAND_DTYPES:
+        raise ValueError(f"band_bits must be one of {sorted(BAND_DTYPES)}, got {band_bits}")
+    if band_bits < 32:
+        signatures = signatures & ((1 << band_bits) - 1)
+    return signatures.astype(BAND_DTYPES[band_bits])
+
+
+def band_keys(signatures: np.ndarray, hashranges: List[Tuple[int, int]], band_bits: int = 32) -> np.ndarray:
+    """
+    Reduce each band of each signature to a single 64-bit key. The band index is part of the key,
+    so keys of different bands never collide and can be bucketed together.
+
+    Parameters
+    ----------
+    signatures : np.ndarray
+        The `(batch, num_perm)` signature matrix.
+    hashranges : List[Tuple[int, int]]
+        The ranges of hash values of each band.
+    band_bits : int
+        The number of bits of each hash value that take part in the key, see `truncate_signatures`.
+
+    Returns
+    -------
+    np.ndarray
+        The `(batch, num_bands)` key matrix.
+
+    Examples
+    --------
+    >>> sigs = np.array([[1, 2, 3, 4], [1, 2, 5, 6], [7, 8, 3, 4]], dtype=np.uint64)
+    >>> keys = band_keys(sigs, [(0, 2), (2, 4)])
+    >>> keys.shape
+    (3, 2)
+    >>> bool(keys[0, 0] == keys[1, 0]), bool(keys[0, 1] == keys[2, 1]), bool(keys[0, 0] == keys[2, 0])
+    (True, True, False)
+    >>> bool(band_keys(sigs, [(0, 2), (0, 2)])[0, 0] == band_keys(sigs, [(0, 2), (0, 2)])[0, 1])
+    False
+    """
+    if band_bits < 32:
+        signatures = truncate_signatures(signatures, band_bits)
+    keys = np.empty((len(signatures), len(hashranges)), dtype=np.uint64)
+    for band_idx, (start, end) in enumerate(hashranges):
+        h = np.full(len(signatures), band_idx, dtype=np.uint64)
+        for col in range(start, end):
+            h *= KEY_PRIME
+            h += signatures[:, col].astype(np.uint64)
+        keys[:, band_idx] = fmix64(h)
+    return keys
+
+
+def band_table(
+    signatures: np.ndarray, ids: np.ndarray, hashranges: List[Tuple[int, int]], band_bits: int = 32
+) -> pa.Table:
+    """
+    Lay the bands of a batch of signatures out as `(band, band_hash, __id__)` columns, one row per
+    band and document, for the DataFrame bucketing of the Spark scripts. The band bytes are the
+    same as the ones the RDD bucketing shuffled, and the binary column is built around the
+    signature buffer without going through Python `bytes`.
+
+    Parameters
+    ----------
+    signatures : np.ndarray
+        The `(batch, num_perm)` signature matrix.
+    ids : np.ndarray
+        The id of each document.
+    hashranges : List[Tuple[int, int]]
+        The ranges of hash values of each band.
+    band_bits : int
+        The number of bits per hash value in the band bytes, see `truncate_signatures`.
+
+    Returns
+    -------
+    pa.Table
+        The band rows, band by band.
+
+    Examples
+    --------
+    >>> sigs = np.array([[1, 2, 3, 4], [1, 2, 5, 6]], dtype=np.uint64)
+    >>> table = band_table(sigs, np.array([10, 11]), [(0, 2), (2, 4)], band_bits=8).to_pydict()
+    >>> table["band"], table["__id__"]
+    ([0, 0, 1, 1], [10, 11, 10, 11])
+    >>> table["band_hash"]
+    [b'\\x01\\x02', b'\\x01\\x02', b'\\x03\\x04', b'\\x05\\x06']
+    """
+    signatures = truncate_signatures(signatures, band_bits)
+    values = []
+    for start, end in hashranges:
+        band = np.ascontiguousarray(signatures[:, start:end])
+        width = band.itemsize * (end - start)
+        offsets = np.arange(len(band) + 1, dtype=np.int32) * width
+        values.append(
+            pa.Array.from_buffers(pa.binary(), len(band), [None, pa.py_buffer(offsets), pa.py_buffer(band)])
+        )
+    return pa.table(
+        {
+            "band": pa.array(np.repeat(np.arange(len(hashranges), dtype=np.int32), len(signatures))),
+            "band_hash": pa.concat_arrays(values) if values else pa.array([], pa.binary()),
+            "__id__": pa.array(np.tile(np.asarray(ids, dtype=np.int64), len(hashranges))),
+        }
+    )
+
+
+def bucket_edges(keys: np.ndarray, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the buckets of one band by sorting its keys, and link every member of a bucket to the
+    smallest id in it, like the dict-of-sets tables did.
+
+    Parameters
+    ----------
+    keys : np.ndarray
+        The band key of each document.
+    ids : np.ndarray
+        The id of each document.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The `(src, dst)` union edges.
+
+    Examples
+    --------
+    >>> src, dst = bucket_edges(np.array([5, 3, 5, 9, 5, 3], dtype=np.uint64), np.arange(6))
+    >>> sorted(zip(src.tolist(), dst.tolist()))
+    [(2, 0), (4, 0), (5, 1)]
+    """
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    sorted_ids = ids[order]
+    is_head = np.empty(len(keys), dtype=bool)
+    is_head[:1] = True
+    np.not_equal(sorted_keys[1:], sorted_keys[:-1], out=is_head[1:])
+    heads = np.flatnonzero(is_head)
+    run_min = np.minimum.reduceat(sorted_ids, heads) if len(heads) else sorted_ids[:0]
+    dst = run_min[np.cumsum(is_head) - 1]
+    linked = sorted_ids != dst
+    return sorted_ids[linked], dst[linked]
+
+
+def relink_unverified(src: np.ndarray, dst: np.ndarray, verified: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Link the members of a bucket that are not similar to its smallest id to the smallest of
+    them instead, so that they are compared with one another in the next round of verification.
+
+    Parameters
+    ----------
+    src : np.ndarray
+        The members of the buckets, from `bucket_edges`.
+    dst : np.ndarray
+        The smallest id of the bucket of each member.
+    verified : np.ndarray
+        Whether each `(src, dst)` pair is above the threshold.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The `(src, dst)` edges to verify next.
+
+    Examples
+    --------
+    >>> verified = np.array([True, False, False, False, True])
+    >>> src, dst = relink_unverified(np.array([2, 4, 5, 7, 6]), np.array([0, 0, 0, 0, 1]), verified)
+    >>> sorted(zip(src.tolist(), dst.tolist()))
+    [(5, 4), (7, 4)]
+    """
+    return bucket_edges(dst[~verified], src[~verified])
+
+
+def exact_representatives(hashes: np.ndarray) -> np.ndarray:
+    """
+    Group exact duplicates by their content hash.
+
+    Parameters
+    ----------
+    hashes : np.ndarray
+        The content hash of each document.
+
+    Returns
+    -------
+    np.ndarray
+        For each document, the smallest index with the same content hash.
+
+    Examples
+    --------
+    >>> exact_representatives(np.array([7, 3, 7, 7, 1], dtype=np.uint64)).tolist()
+    [0, 1, 0, 0, 4]
+    """
+    representatives = np.arange(len(hashes))
+    src, dst = bucket_edges(hashes, representatives)
+    representatives[src] = dst
+    return representatives
+
+
+# region: Out-of-core partitions
+def partition_count(num_records: int, memory_budget: float) -> int:
+    """
+    Pick the number of spill partitions so that bucketing one of them fits in the memory budget.
+    It is a power of two, because partitions are selected by the top bits of the keys.
+
+    Parameters
+    ----------
+    num_records : int
+        The total number of band keys, i.e. the number of documents times the number of bands.
+    memory_budget : float
+        The memory budget in bytes.
+
+    Returns
+    -------
+    int
+        The number of partitions.
+
+    Examples
+    --------
+    >>> partition_count(1_000, 2**30)
+    1
+    >>> partition_count(100_000_000 * 25, 16 * 2**30)
+    16
+    """
+    needed = num_records * RECORD_BYTES * SORT_OVERHEAD
+    return 1 << max(0, math.ceil(math.log2(max(1.0, needed / memory_budget))))
+
+
+def spill_band_keys(keys: np.ndarray, ids: np.ndarray, directory: str | Path, num_partitions: int):
+    """
+    Append the `(key, id)` records of a batch to the partition files they belong to. Every process
+    writes its own files, named after its pid, so workers never append to the same file.
+
+    Parameters
+    ----------
+    keys : np.ndarray
+        The `(batch, num_bands)` key matrix.
+    ids : np.ndarray
+        The id of each row.
+    directory : str | Path
+        The spill directory, with one sub-directory per partition.
+    num_partitions : int
+        The number of partitions.
+    """
+    flat_keys = keys.reshape(-1)
+    flat_ids = np.repeat(np.asarray(ids, dtype=np.uint64), keys.shape[1])
+    bits = num_partitions.bit_length() - 1
+    if bits:
+        parts = flat_keys >> np.uint64(64 - bits)
+    else:
+        parts = np.zeros(len(flat_keys), dtype=np.uint64)
+    order = np.argsort(parts, kind="stable")
+    parts = parts[order]
+    bounds = np.flatnonzero(np.r_[True, parts[1:] != parts[:-1], True])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        base = Path(directory) / f"{int(parts[start]):05d}" / str(os.getpid())
+        with open(base.with_suffix(".keys"), "ab") as f:
+            flat_keys[order[start:end]].tofile(f)
+        with open(base.with_suffix(".ids"), "ab") as f:
+            flat_ids[order[start:end]].tofile(f)
+
+
+def load_partition(directory: str | Path, partition: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Memory-map and gather all the records of one partition.
+
+    Parameters
+    ----------
+    directory : str | Path
+        The spill directory.
+    partition : int
+        The partition to load.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The keys and ids of the partition.
+    """
+    keys, ids = [], []
+    for path in sorted((Path(directory) / f"{partition:05d}").glob("*.keys")):
+        if path.stat().st_size == 0:
+            continue
+        keys.append(np.memmap(path, dtype=np.uint64, mode="r"))
+        ids.append(np.memmap(path.with_suffix(".ids"), dtype=np.uint64, mode="r"))
+    if not keys:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64)
+    return np.concatenate(keys), np.concatenate(ids)
+
+
+# endregion
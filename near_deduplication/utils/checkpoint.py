@@ -0,0 +1,89 @@
+"""
+Stage checkpoints for the single-node pipeline, so that a run that dies half way resumes from the
+last completed stage instead of starting over.
+
+Every stage is an `.npz` file of NumPy arrays next to a `.json` manifest. The manifest records the
+parameters of the run and is written last, so a stage is complete only if its manifest exists and
+its parameters match the current run; stale stages are simply computed again.
+"""
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from typing import Any
+from typing import Dict
+
+import numpy as np
+
+
+class Checkpoints:
+    """
+    A directory of stage checkpoints. Without a directory nothing is saved and no stage is ever
+    complete, so the pipeline does not need a separate code path when checkpointing is off.
+
+    Parameters
+    ----------
+    directory : str | Path | None
+        The checkpoint directory, or None to disable checkpointing.
+    params : Dict[str, Any]
+        The parameters the stages depend on, they must be JSON serializable.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> Checkpoints(directory, {"b": 2}).save("band-00000", src=np.arange(3))
+    >>> Checkpoints(directory, {"b": 2}).load("band-00000")["src"].tolist()
+    [0, 1, 2]
+    >>> Checkpoints(directory, {"b": 3}).done("band-00000"), Checkpoints(None, {"b": 2}).done("band-00000")
+    (False, False)
+    """
+
+    def __init__(self, directory: str | Path | None, params: Dict[str, Any]):
+        self.directory = Path(directory) if directory is not None else None
+        # round-trip so that tuples and lists compare equal to what was read back
+        self.params = json.loads(json.dumps(params))
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _manifest(self, stage: str) -> Path:
+        return self.directory / f"{stage}.json"
+
+    def _arrays(self, stage: str) -> Path:
+        return self.directory / f"{stage}.npz"
+
+    def done(self, stage: str) -> bool:
+        if self.directory is None or not self._manifest(stage).exists():
+            return False
+        return json.loads(self._manifest(stage).read_text())["params"] == self.params
+
+    def save(self, stage: str, **arrays: np.ndarray):
+        """
+        Persist the arrays of a completed stage, then its manifest.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage.
+        **arrays : np.ndarray
+            The arrays to persist.
+        """
+        if self.directory is None:
+            return
+        self._manifest(stage).unlink(missing_ok=True)
+        tmp = self.directory / f"{stage}.tmp.npz"
+        np.savez(tmp, **arrays)
+        os.replace(tmp, self._arrays(stage))
+        manifest = {
+            "stage": stage,
+            "params": self.params,
+            "arrays": {name: {"shape": list(a.shape), "dtype": a.dtype.str} for name, a in arrays.items()},
+        }
+        tmp = self.directory / f"{stage}.tmp.json"
+        tmp.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp, self._manifest(stage))
+
+    def load(self, stage: str) -> Dict[str, np.ndarray]:
+        with np.load(self._arrays(stage)) as data:
+            return {name: data[name] for name in data.files}
@@ -0,0 +1,99 @@
+"""
+Exact Jaccard similarity of shingle sets, to verify LSH candidate pairs before they are merged.
+
+A shingle set is a sorted array of unique hash values. For the single-node script, the sets of many
+documents are concatenated into one flat array with offsets, like the signature engine does.
+"""
+from __future__ import annotations
+
+import numpy as np
+
+
+def jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    The Jaccard similarity of two shingle sets. Two empty sets are identical.
+
+    Parameters
+    ----------
+    a : np.ndarray
+        The sorted unique shingle hashes of the first document.
+    b : np.ndarray
+        The sorted unique shingle hashes of the second document.
+
+    Returns
+    -------
+    float
+        The Jaccard similarity.
+
+    Examples
+    --------
+    >>> jaccard(np.array([1, 2, 3]), np.array([2, 3, 4]))
+    0.5
+    >>> jaccard(np.array([], dtype=np.uint32), np.array([], dtype=np.uint32))
+    1.0
+    """
+    intersection = len(np.intersect1d(a, b, assume_unique=True))
+    union = len(a) + len(b) - intersection
+    return intersection / union if union else 1.0
+
+
+def pair_jaccard(
+    values: np.ndarray,
+    offsets: np.ndarray,
+    src: np.ndarray,
+    dst: np.ndarray,
+    batch_size: int = 4096,
+) -> np.ndarray:
+    """
+    The Jaccard similarity of many pairs of documents at once. Within a batch, every shingle is
+    tagged with the index of its pair in the upper 32 bits, so a single `np.intersect1d` finds the
+    intersections of all pairs and a `np.bincount` sizes them.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The concatenated sorted unique 32-bit shingle hashes of all documents.
+    offsets : np.ndarray
+        The start of each document in `values`, followed by `len(values)`.
+    src : np.ndarray
+        The first document of each pair.
+    dst : np.ndarray
+        The second document of each pair.
+    batch_size : int
+        The number of pairs compared at once.
+
+    Returns
+    -------
+    np.ndarray
+        The Jaccard similarity of each pair.
+
+    Examples
+    --------
+    >>> values = np.array([1, 2, 3, 2, 3, 4, 7], dtype=np.uint32)
+    >>> offsets = np.array([0, 3, 6, 7, 7])
+    >>> pair_jaccard(values, offsets, np.array([0, 0, 3]), np.array([1, 2, 3])).tolist()
+    [0.5, 0.0, 1.0]
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    values = np.asarray(values, dtype=np.uint64)
+    result = np.empty(len(src), dtype=np.float64)
+    for start in range(0, len(src), batch_size):
+        a, b = src[start : start + batch_size], dst[start : start + batch_size]
+        a_keys, a_sizes = _tagged(values, offsets, a)
+        b_keys, b_sizes = _tagged(values, offsets, b)
+        common = np.intersect1d(a_keys, b_keys, assume_unique=True)
+        intersection = np.bincount((common >> np.uint64(32)).astype(np.int64), minlength=len(a))
+        union = a_sizes + b_sizes - intersection
+        result[start : start + batch_size] = np.divide(
+            intersection, union, out=np.ones(len(a), dtype=np.float64), where=union > 0
+        )
+    return result
+
+
+def _tagged(values: np.ndarray, offsets: np.ndarray, docs: np.ndarray):
+    """The shingles of `docs`, each tagged with the position of its document in `docs`."""
+    starts, sizes = offsets[docs], offsets[docs + 1] - offsets[docs]
+    pair = np.repeat(np.arange(len(docs), dtype=np.uint64), sizes)
+    # position of every gathered shingle within its own document
+    within = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return (pair << np.uint64(32)) | values[np.repeat(starts, sizes) + within], sizes
@@ -0,0 +1,118 @@
+"""LSH parameter selection shared by the single-node and the Spark deduplication scripts."""
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+
+CACHE_FILE = Path(
+    os.environ.get("NEAR_DEDUP_CACHE", Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "near_dedup")
+) / "optimal_param.json"
+
+
+def _false_probabilities(
+    threshold: float,
+    num_perm: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Evaluate the false positive and false negative areas of every `(b, r)` with `b * r <= num_perm`.
+    Both integrands are polynomials of degree `b * r`, so a Gauss-Legendre rule with
+    `num_perm // 2 + 1` nodes integrates them exactly.
+
+    Parameters
+    ----------
+    threshold : float
+        The threshold for similarity.
+    num_perm : int
+        The number of permutations.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+        The `b` and `r` of each candidate, in the order of the original double loop, and their
+        false positive and false negative areas.
+    """
+    bands = np.arange(1, num_perm + 1)
+    b = np.repeat(bands, num_perm // bands).astype(np.float64)
+    r = np.concatenate([np.arange(1, num_perm // band + 1) for band in bands]).astype(np.float64)
+    nodes, weights = np.polynomial.legendre.leggauss(num_perm // 2 + 1)
+    nodes = (nodes + 1) / 2
+
+    s = threshold * nodes
+    fp = (1 - (1 - s ** r[:, None]) ** b[:, None]) @ (weights * threshold / 2)
+    s = threshold + (1 - threshold) * nodes
+    fn = ((1 - s ** r[:, None]) ** b[:, None]) @ (weights * (1 - threshold) / 2)
+    return b.astype(int), r.astype(int), fp, fn
+
+
+def _read_cache() -> dict:
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(cache: dict):
+    # write to a temporary file first, so concurrent runs never read a partial file
+    try:
+        CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=CACHE_FILE.parent, delete=False) as f:
+            json.dump(cache, f)
+        os.replace(f.name, CACHE_FILE)
+    except OSError:
+        pass
+
+
+@lru_cache(maxsize=None)
+def optimal_param(
+    threshold: float,
+    num_perm: int,
+    false_positive_weight: float = 0.5,
+    false_negative_weight: float = 0.5,
+) -> Tuple[int, int]:
+    """
+    Compute the optimal `MinHashLSH` parameter that minimizes the weighted sum
+    of probabilities of false positive and false negative, taken from datasketch.
+    All candidates are evaluated at once, and the result is cached on disk.
+
+    Parameters
+    ----------
+    threshold : float
+        The threshold for similarity.
+    num_perm : int
+        The number of permutations.
+    false_positive_weight : float
+        The weight of false positive.
+    false_negative_weight : float
+        The weight of false negative.
+
+    Returns
+    -------
+    Tuple[int, int]
+        The optimal `b` and `r` parameters.
+        The number of bands, and the number of rows per band respectively.
+
+    Examples
+    --------
+    >>> optimal_param(0.7, 256)
+    (25, 10)
+    >>> optimal_param(0.85, 128)
+    (8, 16)
+    """
+    key = f"{threshold!r}/{num_perm}/{false_positive_weight!r}/{false_negative_weight!r}"
+    cache = _read_cache()
+    if key in cache:
+        return tuple(cache[key])
+
+    b, r, fp, fn = _false_probabilities(threshold, num_perm)
+    # argmin keeps the first minimum, as the strict comparison in the original loop did
+    opt = int(np.argmin(fp * false_positive_weight + fn * false_negative_weight))
+    cache[key] = (int(b[opt]), int(r[opt]))
+    _write_cache(cache)
+    return cache[key]
@@ -0,0 +1,195 @@
+"""
+Streaming access to a local directory of Parquet shards, as an alternative to materializing the
+corpus as a Hugging Face dataset: only the text column is read, in bounded batches, and the output
+is every input shard rewritten without the removed rows.
+
+Rows are identified by their global position: the shards are sorted by path, and the rows of a
+shard follow the rows of the shards before it.
+"""
+from __future__ import annotations
+
+import multiprocessing as mp
+import os
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class ParquetShards:
+    """
+    The Parquet shards of a directory, read one text column at a time.
+
+    Parameters
+    ----------
+    directory : str | Path
+        The directory, searched recursively for `*.parquet` files.
+    column : str
+        The text column.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> directory = Path(tempfile.mkdtemp())
+    >>> pq.write_table(pa.table({"content": ["a", "b"], "stars": [1, 2]}), directory / "0.parquet")
+    >>> pq.write_table(pa.table({"content": ["c"], "stars": [3]}), directory / "1.parquet")
+    >>> shards = ParquetShards(directory, "content")
+    >>> len(shards), shards.offsets.tolist()
+    (3, [0, 2, 3])
+    >>> shards.filter(np.array([True, False, True]), directory / "out", num_proc=1)
+    2
+    >>> pq.read_table(directory / "out" / "0.parquet").to_pydict()
+    {'content': ['a'], 'stars': [1]}
+    """
+
+    def __init__(self, directory: str | Path, column: str):
+        self.directory = Path(directory)
+        self.column = column
+        self.paths = sorted(self.directory.rglob("*.parquet"))
+        if not self.paths:
+            raise FileNotFoundError(f"No Parquet files in {self.directory}")
+        sizes = [pq.ParquetFile(path).metadata.num_rows for path in self.paths]
+        self.offsets = np.cumsum([0] + sizes)
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def map(
+        self,
+        function: Callable[..., Dict[str, Any]],
+        fn_kwargs: Dict[str, Any] | None = None,
+        rows: np.ndarray | None = None,
+        with_indices: bool = False,
+        batch_size: int = 1000,
+        num_proc: int | None = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Apply a batched function to the text of the selected rows, one process per shard, and yield
+        its outputs in row order. Like `Dataset.select(rows).map(with_indices=True)`, the indices
+        passed to the function are positions among the selected rows.
+
+        Parameters
+        ----------
+        function : Callable[..., Dict[str, Any]]
+            The function, called as `function(contents, **fn_kwargs)` or
+            `function(contents, indices, **fn_kwargs)`. It must be picklable.
+        fn_kwargs : Dict[str, Any] | None
+            The keyword arguments of the function.
+        rows : np.ndarray | None
+            The sorted global positions of the rows to process, or None for all of them.
+        with_indices : bool
+            Whether to pass the indices to the function.
+        batch_size : int
+            The number of rows per call of the function.
+        num_proc : int | None
+            The number of processes, by default the number of CPUs.
+
+        Returns
+        -------
+        Iterator[Dict[str, Any]]
+            The output of every call of the function.
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        bounds = np.searchsorted(rows, self.offsets)
+        tasks = [
+            (
+                path,
+                self.column,
+                rows[bounds[i] : bounds[i + 1]] - self.offsets[i],
+                np.arange(bounds[i], bounds[i + 1]),
+                function,
+                fn_kwargs or {},
+                with_indices,
+                batch_size,
+            )
+            for i, path in enumerate(self.paths)
+            if bounds[i] < bounds[i + 1]
+        ]
+        with mp.Pool(num_proc or os.cpu_count()) as pool:
+            for outputs in pool.imap(_map_shard, tasks):
+                yield from outputs
+
+    def read_columns(self, columns: List[str]) -> pa.Table:
+        """
+        Read whole columns of every shard, in row order. Only meant for small metadata columns.
+
+        Parameters
+        ----------
+        columns : List[str]
+            The columns to read.
+
+        Returns
+        -------
+        pa.Table
+            The columns of all rows.
+        """
+        return pa.concat_tables([pq.read_table(path, columns=columns) for path in self.paths])
+
+    @property
+    def column_names(self) -> List[str]:
+        return pq.ParquetFile(self.paths[0]).schema_arrow.names
+
+    def filter(self, keep: np.ndarray, output: str | Path, batch_size: int = 10000, num_proc: int | None = None) -> int:
+        """
+        Rewrite every shard under the output directory, at the same relative path, with only the
+        kept rows and the original schema.
+
+        Parameters
+        ----------
+        keep : np.ndarray
+            Whether to keep each row.
+        output : str | Path
+            The output directory.
+        batch_size : int
+            The number of rows read at once.
+        num_proc : int | None
+            The number of processes, by default the number of CPUs.
+
+        Returns
+        -------
+        int
+            The number of rows written.
+        """
+        output = Path(output)
+        tasks = [
+            (path, output / path.relative_to(self.directory), keep[self.offsets[i] : self.offsets[i + 1]], batch_size)
+            for i, path in enumerate(self.paths)
+        ]
+        with mp.Pool(num_proc or os.cpu_count()) as pool:
+            return sum(pool.imap_unordered(_filter_shard, tasks))
+
+
+def _map_shard(task) -> List[Dict[str, Any]]:
+    path, column, rows, indices, function, fn_kwargs, with_indices, batch_size = task
+    outputs = []
+    start = 0
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=[column]):
+        lo, hi = np.searchsorted(rows, [start, start + batch.num_rows])
+        start += batch.num_rows
+        if lo == hi:
+            continue
+        contents = batch.column(0).take(pa.array(rows[lo:hi] - (start - batch.num_rows))).to_pylist()
+        args = (contents, indices[lo:hi].tolist()) if with_indices else (contents,)
+        outputs.append(function(*args, **fn_kwargs))
+    return outputs
+
+
+def _filter_shard(task) -> int:
+    path, output, keep, batch_size = task
+    output.parent.mkdir(parents=True, exist_ok=True)
+    source = pq.ParquetFile(path)
+    written = 0
+    start = 0
+    with pq.ParquetWriter(output, source.schema_arrow) as writer:
+        for batch in source.iter_batches(batch_size=batch_size):
+            mask = keep[start : start + batch.num_rows]
+            start += batch.num_rows
+            writer.write_batch(batch.filter(pa.array(mask)))
+            written += int(mask.sum())
+    return written
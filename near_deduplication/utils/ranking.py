@@ -0,0 +1,102 @@
+"""
+Quality ranking of the documents of a cluster, to keep the best one instead of the first one.
+
+The ranking is the one of `bigcode-v2/intra_dedup.py --rank`, hard-coded for The Stack: the most
+permissive license first, then the most stars, the most forks, the latest revision and the latest
+visit. Every criterion becomes an integer key where lower is better, so a single `np.lexsort`
+ranks all documents at once and the best document of a cluster is the first of its run.
+"""
+from __future__ import annotations
+
+from typing import List
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+LICENSE_ORDER = ["permissive", "no_license", "non_permissive"]
+RANK_COLUMNS = ["license_type", "star_events_count", "fork_events_count", "revision_date", "visit_date"]
+MISSING = np.iinfo(np.int64).max
+
+
+def _descending(column: pa.ChunkedArray, missing: int) -> np.ndarray:
+    return -pc.fill_null(column.cast(pa.int64()), missing).to_numpy().astype(np.int64)
+
+
+def _latest(column: pa.ChunkedArray) -> np.ndarray:
+    if not pa.types.is_timestamp(column.type):
+        column = column.cast(pa.timestamp("ns"))
+    # a missing date ranks after every real one
+    return np.where(column.is_null().to_numpy(), MISSING, _descending(column, 0))
+
+
+def rank_keys(table: pa.Table) -> List[np.ndarray]:
+    """
+    The integer rank keys of every row, lower is better, the most significant key first.
+
+    Parameters
+    ----------
+    table : pa.Table
+        The `RANK_COLUMNS` of the rows.
+
+    Returns
+    -------
+    List[np.ndarray]
+        One `int64` key per ranking criterion.
+
+    Examples
+    --------
+    >>> table = pa.table(
+    ...     {
+    ...         "license_type": ["no_license", "permissive", None],
+    ...         "star_events_count": [3, None, 1],
+    ...         "fork_events_count": [0, 2, None],
+    ...         "revision_date": ["2022-01-01", None, "2021-01-01"],
+    ...         "visit_date": ["2022-02-01", "2022-03-01", None],
+    ...     }
+    ... )
+    >>> [key.tolist()[:2] for key in rank_keys(table)[:3]]
+    [[1, 0], [-3, 0], [0, -2]]
+    """
+    licenses = pc.index_in(table.column("license_type"), value_set=pa.array(LICENSE_ORDER))
+    return [
+        pc.fill_null(licenses, len(LICENSE_ORDER)).to_numpy().astype(np.int64),
+        _descending(table.column("star_events_count"), 0),
+        _descending(table.column("fork_events_count"), 0),
+        _latest(table.column("revision_date")),
+        _latest(table.column("visit_date")),
+    ]
+
+
+def ranked_clusters(clusters: np.ndarray, keys: List[np.ndarray]) -> np.ndarray:
+    """
+    Relabel every cluster with its best document. The rows of clusters with more than one row are
+    sorted by cluster and then by rank with one `np.lexsort`, and the head of every cluster run is
+    its best row; ties go to the smallest index, since the sort is stable.
+
+    Parameters
+    ----------
+    clusters : np.ndarray
+        The cluster id of each row, which is a row of the cluster.
+    keys : List[np.ndarray]
+        The rank keys of each row, see `rank_keys`.
+
+    Returns
+    -------
+    np.ndarray
+        The best row of the cluster of each row.
+
+    Examples
+    --------
+    >>> ranked_clusters(np.array([0, 0, 2, 0, 2]), [np.array([1, 0, 0, 0, 0]), np.array([0, 5, 1, 3, 1])])
+    array([3, 3, 2, 3, 2])
+    """
+    # a document alone in its cluster is its own best, only the others are sorted
+    members = np.flatnonzero(np.bincount(clusters, minlength=len(clusters))[clusters] > 1)
+    groups = clusters[members]
+    order = np.lexsort([key[members] for key in reversed(keys)] + [groups])
+    sorted_groups = groups[order]
+    heads = order[np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]]
+    best = np.arange(len(clusters), dtype=clusters.dtype)
+    best[groups[heads]] = members[heads]
+    return best[clusters]
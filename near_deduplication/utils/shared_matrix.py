@@ -0,0 +1,67 @@
+"""
+A matrix in a memory-mapped `.npy` file, shared by the fingerprinting workers and the parent
+process. Every worker writes the rows it computed straight into the file, and the parent maps the
+same pages after the map is done, so nothing is serialized into Arrow cache files on the way.
+
+The pages of a memory-mapped file are shared between processes through the page cache: what a
+worker writes is visible to every other mapping of the file, without an explicit flush.
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+
+
+def create_matrix(path: str | Path, shape: Tuple[int, ...], dtype: np.dtype) -> np.memmap:
+    """
+    Preallocate the matrix. The file is sparse until the workers write to it.
+
+    Parameters
+    ----------
+    path : str | Path
+        The `.npy` file.
+    shape : Tuple[int, ...]
+        The shape of the matrix.
+    dtype : np.dtype
+        The type of its values.
+
+    Returns
+    -------
+    np.memmap
+        The writable matrix.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> path = Path(tempfile.mkdtemp()) / "keys.npy"
+    >>> create_matrix(path, (2, 3), np.uint64).shape
+    (2, 3)
+    >>> open_matrix(str(path))[:, [0, 2]] = [[1, 2], [3, 4]]
+    >>> np.load(path).tolist()
+    [[1, 0, 2], [3, 0, 4]]
+    """
+    # a mapping of a previous file at the same path would not see the new one
+    open_matrix.cache_clear()
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+
+@lru_cache(maxsize=None)
+def open_matrix(path: str) -> np.memmap:
+    """
+    Map the matrix for writing. The mapping is cached, so a worker maps the file only once no
+    matter how many batches it processes.
+
+    Parameters
+    ----------
+    path : str
+        The `.npy` file.
+
+    Returns
+    -------
+    np.memmap
+        The writable matrix.
+    """
+    return np.load(path, mmap_mode="r+")
@@ -0,0 +1,69 @@
+"""
+Rolling-hash shingling: every distinct token is hashed once and the hashes of `n` consecutive
+tokens are combined with a vectorized polynomial, so no n-gram string is ever built.
+
+The shingle hashes differ from the ones of the string-joining `ngrams` helpers, so this is a
+separate hash scheme, tagged with `ROLLING_VERSION` wherever signatures are persisted.
+"""
+from __future__ import annotations
+
+from typing import Callable
+from typing import List
+
+import numpy as np
+
+from utils.bucketing import fmix64
+
+ROLLING_VERSION = "rolling-v1"
+ROLLING_PRIME = np.uint64(0x9E3779B97F4A7C15)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def rolling_shingle_hashes(
+    tokens: List[str],
+    ngram_size: int,
+    token_hash: Callable[[bytes], int],
+    pad_short: bool = False,
+) -> np.ndarray:
+    """
+    Hash the distinct n-gram shingles of a token sequence.
+
+    Parameters
+    ----------
+    tokens : List[str]
+        The tokens of the document.
+    ngram_size : int
+        The size of n-grams.
+    token_hash : Callable[[bytes], int]
+        The hash function applied to each distinct token.
+    pad_short : bool
+        Whether a document shorter than `ngram_size` yields one shingle of all its tokens, like in
+        `intra_dedup.py`, rather than none.
+
+    Returns
+    -------
+    np.ndarray
+        The distinct 32-bit shingle hashes, as `uint64`.
+
+    Examples
+    --------
+    >>> import zlib
+    >>> len(rolling_shingle_hashes("a b c a b c".split(), 3, zlib.crc32))
+    3
+    >>> len(rolling_shingle_hashes(["a", "b"], 3, zlib.crc32))
+    0
+    >>> len(rolling_shingle_hashes(["a", "b"], 3, zlib.crc32, pad_short=True))
+    1
+    """
+    if len(tokens) < ngram_size:
+        if not pad_short or not tokens:
+            return np.empty(0, dtype=np.uint64)
+        ngram_size = len(tokens)
+    lookup = {token: token_hash(token.encode("utf-8")) for token in dict.fromkeys(tokens)}
+    token_hashes = np.fromiter(map(lookup.__getitem__, tokens), dtype=np.uint64, count=len(tokens))
+    num_shingles = len(tokens) - ngram_size + 1
+    h = token_hashes[:num_shingles].copy()
+    for k in range(1, ngram_size):
+        h *= ROLLING_PRIME
+        h += token_hashes[k : k + num_shingles]
+    return np.unique(fmix64(h) & MAX_HASH)
@@ -0,0 +1,224 @@
+"""
+A persistent store of full MinHash signatures, so that a corpus is fingerprinted once and can be
+re-banded at any threshold without touching the text again.
+
+A store is a directory of Parquet files with three columns: `__id__` (uint64), `__content_hash__`
+(uint64) and `__signature__` (fixed-size list of `num_perm` uint32). Everything that determines
+the signatures is recorded in `metadata.json`, which is written last and so also marks the store
+as complete.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+STORE_VERSION = 1
+METADATA_FILE = "metadata.json"
+
+
+def content_hash(content: str) -> int:
+    """
+    A fast 64-bit hash of the raw content, to tell exact copies apart.
+
+    Parameters
+    ----------
+    content : str
+        The content to hash.
+
+    Returns
+    -------
+    int
+        The hash value.
+
+    Examples
+    --------
+    >>> content_hash("hello") == content_hash("hello"), content_hash("hello") == content_hash("hello ")
+    (True, False)
+    """
+    return int.from_bytes(hashlib.blake2b(content.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def store_metadata(
+    *,
+    seed: int,
+    num_perm: int,
+    ngram_size: int,
+    min_ngram_size: int,
+    hash_name: str,
+    tokenizer: str,
+    permutations: np.ndarray,
+    sketch: str = "minhash",
+    exact_dedup: bool = False,
+) -> Dict[str, Any]:
+    """
+    Describe how the signatures of a store are produced.
+
+    Parameters
+    ----------
+    seed : int
+        The seed of the permutations.
+    num_perm : int
+        The number of permutations.
+    ngram_size : int
+        The size of n-grams.
+    min_ngram_size : int
+        The minimum size of n-grams.
+    hash_name : str
+        The name (and version) of the shingle hash function.
+    tokenizer : str
+        The pattern used to split the content into tokens.
+    permutations : np.ndarray
+        The `(a, b)` permutation parameters.
+    sketch : str
+        The signature algorithm, `minhash` or `oph`.
+    exact_dedup : bool
+        Whether only one representative of each group of exact duplicates is stored.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The metadata.
+    """
+    return {
+        "version": STORE_VERSION,
+        "seed": seed,
+        "num_perm": num_perm,
+        "ngram_size": ngram_size,
+        "min_ngram_size": min_ngram_size,
+        "hash_name": hash_name,
+        "tokenizer": tokenizer,
+        "permutations": np.asarray(permutations).tolist(),
+        "sketch": sketch,
+        "exact_dedup": exact_dedup,
+    }
+
+
+def is_complete(path: str | Path) -> bool:
+    return (Path(path) / METADATA_FILE).exists()
+
+
+def check_compatible(path: str | Path, metadata: Dict[str, Any]):
+    """
+    Refuse to reuse a store whose signatures were produced differently.
+
+    Parameters
+    ----------
+    path : str | Path
+        The store directory.
+    metadata : Dict[str, Any]
+        The metadata of the current run.
+
+    Raises
+    ------
+    ValueError
+        If any of the recorded parameters differs.
+    """
+    with open(Path(path) / METADATA_FILE) as f:
+        check_metadata(path, json.load(f), metadata)
+
+
+def check_metadata(path: str | Path, stored: Dict[str, Any], metadata: Dict[str, Any]):
+    """
+    Compare the recorded metadata of a store with the one of the current run, see `check_compatible`.
+
+    Parameters
+    ----------
+    path : str | Path
+        The store directory, for the error message.
+    stored : Dict[str, Any]
+        The recorded metadata.
+    metadata : Dict[str, Any]
+        The metadata of the current run. Only its keys are compared.
+
+    Raises
+    ------
+    ValueError
+        If any of the recorded parameters differs.
+    """
+    mismatches = [key for key in metadata if stored.get(key) != metadata[key]]
+    if mismatches:
+        raise ValueError(f"Signature store {path} is incompatible with this run, it differs in: {mismatches}")
+
+
+def write_signatures(
+    path: str | Path,
+    batches: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+    metadata: Dict[str, Any],
+):
+    """
+    Write a signature store.
+
+    Parameters
+    ----------
+    path : str | Path
+        The store directory.
+    batches : Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]]
+        The `(ids, content_hashes, signatures)` batches.
+    metadata : Dict[str, Any]
+        The metadata of the signatures.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    (path / METADATA_FILE).unlink(missing_ok=True)
+    num_perm = metadata["num_perm"]
+    schema = pa.schema(
+        [
+            ("__id__", pa.uint64()),
+            ("__content_hash__", pa.uint64()),
+            ("__signature__", pa.list_(pa.uint32(), num_perm)),
+        ]
+    )
+    with pq.ParquetWriter(path / "part-00000.parquet", schema) as writer:
+        for ids, hashes, signatures in batches:
+            signatures = np.ascontiguousarray(signatures, dtype=np.uint32)
+            writer.write_table(
+                pa.table(
+                    [
+                        pa.array(np.asarray(ids).astype(np.uint64)),
+                        # a uint64 hash may come back as int64 from `datasets`, same bits
+                        pa.array(np.asarray(hashes).astype(np.uint64)),
+                        pa.FixedSizeListArray.from_arrays(pa.array(signatures.reshape(-1)), num_perm),
+                    ],
+                    schema=schema,
+                )
+            )
+    with open(path / METADATA_FILE, "w") as f:
+        json.dump(metadata, f)
+
+
+def iter_signatures(path: str | Path, batch_size: int = 10000) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Read the signatures of a store in batches, without the content hashes.
+
+    Parameters
+    ----------
+    path : str | Path
+        The store directory.
+    batch_size : int
+        The number of rows per batch.
+
+    Yields
+    ------
+    Tuple[np.ndarray, np.ndarray]
+        The ids and the `(batch, num_perm)` uint32 signatures.
+    """
+    for file in sorted(Path(path).glob("*.parquet")):
+        for batch in pq.ParquetFile(file).iter_batches(batch_size, columns=["__id__", "__signature__"]):
+            ids = batch.column(0).to_numpy()
+            signatures = batch.column(1)
+            num_perm = signatures.type.list_size
+            yield ids, signatures.flatten().to_numpy().reshape(-1, num_perm)
+
+
+def num_rows(path: str | Path) -> int:
+    return sum(pq.ParquetFile(file).metadata.num_rows for file in Path(path).glob("*.parquet"))
@@ -0,0 +1,95 @@
+"""
+One-permutation hashing (OPH) with optimal densification, an alternative to classic MinHash that
+costs O(#shingles + num_perm) per document instead of O(#shingles * num_perm).
+
+Each script applies its own single permutation to the shingle hashes, so that OPH follows the
+hashing of the script it runs in. The permuted values are split into `num_perm` bins by their top
+bits and each bin keeps its minimum. Empty bins borrow the value of another bin, picked with a
+fixed random sequence shared by all documents (Shrivastava, "Optimal Densification for Fast and
+Accurate Minwise Hashing", 2017).
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+
+import numpy as np
+
+SKETCHES = ("minhash", "oph")
+MAX_HASH = np.uint64((1 << 32) - 1)
+DENSIFY_ATTEMPTS = 32
+
+
+@lru_cache(maxsize=None)
+def densify_table(num_perm: int, seed: int = 42) -> np.ndarray:
+    """
+    The bins each empty bin tries to borrow from, in order. It has its own random state so that it
+    does not shift the permutations drawn by the scripts.
+
+    Parameters
+    ----------
+    num_perm : int
+        The number of bins.
+    seed : int
+        The random seed.
+
+    Returns
+    -------
+    np.ndarray
+        The `(num_perm, DENSIFY_ATTEMPTS)` table of bin indices.
+    """
+    return np.random.RandomState(seed).randint(0, num_perm, size=(num_perm, DENSIFY_ATTEMPTS))
+
+
+def oph_signatures(values: np.ndarray, offsets: np.ndarray, num_perm: int, table: np.ndarray) -> np.ndarray:
+    """
+    Compute the densified one-permutation signatures of a batch of documents.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The permuted 32-bit shingle hashes of all documents, concatenated.
+    offsets : np.ndarray
+        The start offset of each document in `values`, followed by `len(values)`.
+    num_perm : int
+        The number of bins, i.e. the signature length.
+    table : np.ndarray
+        The densification table from `densify_table`.
+
+    Returns
+    -------
+    np.ndarray
+        The `(batch, num_perm)` uint64 signatures. Documents without shingles are all `MAX_HASH`,
+        like with classic MinHash.
+
+    Examples
+    --------
+    >>> table = densify_table(8)
+    >>> values = np.array([1, 2**31, 3, 2**31 + 5, 7], dtype=np.uint64)
+    >>> sigs = oph_signatures(values, np.array([0, 2, 4, 5, 5]), 8, table)
+    >>> sigs.shape
+    (4, 8)
+    >>> bool((sigs[3] == MAX_HASH).all()), bool((sigs[:3] != MAX_HASH).all())
+    (True, True)
+    >>> bool((oph_signatures(values[:2], np.array([0, 2]), 8, table) == sigs[0]).all())
+    True
+    """
+    values = values.astype(np.uint64)
+    num_docs = len(offsets) - 1
+    doc_ids = np.repeat(np.arange(num_docs), np.diff(offsets))
+    bins = (values * np.uint64(num_perm)) >> np.uint64(32)
+    signatures = np.full((num_docs, num_perm), MAX_HASH, dtype=np.uint64)
+    np.minimum.at(signatures.reshape(-1), doc_ids * num_perm + bins.astype(np.int64), values)
+
+    filled = signatures != MAX_HASH
+    rows, cols = np.nonzero(~filled & filled.any(axis=1, keepdims=True))
+    if len(rows):
+        candidates = table[cols]
+        usable = filled[rows[:, None], candidates]
+        found = usable.any(axis=1)
+        pick = candidates[np.arange(len(rows)), usable.argmax(axis=1)]
+        # the table ran out of attempts: take the next filled bin to the right instead
+        for i in np.flatnonzero(~found):
+            shifted = np.roll(filled[rows[i]], -cols[i])
+            pick[i] = (cols[i] + shifted.argmax()) % num_perm
+        signatures[rows, cols] = signatures[rows, pick]
+    return signatures
@@ -0,0 +1,742 @@
+"""
+DataFrame building blocks shared by the Spark scripts. Unlike the rest of `utils`, this module
+needs PySpark, so the single-node script never imports it.
+
+The LSH bucketing runs on DataFrames instead of RDDs of Python tuples: signatures are computed by
+a `mapInPandas` UDF that emits `(band, band_hash, __id__)` columns, and the buckets are grouped by
+Spark itself, so nothing in the shuffle is pickled. The 32-bit signatures can also be stored as
+`SIGNATURE_SCHEMA` rows, with the bits of every hash value in a signed `int`, and banded again
+later without hashing the documents. They are keyed by the hash and the length of the content,
+like the exact deduplication, since the `monotonically_increasing_id()` of a document changes with
+the partitioning of the input. Like the single-node signature store, the parameters of the
+signatures are recorded next to them, in a `_signature_metadata` JSON line that Parquet readers
+skip, and checked before the signatures are used again.
+
+A band value shared by very many documents (license headers, generated stubs) makes one bucket
+as large as a partition. Such heavy buckets are estimated from a sample of the documents, and
+their members are salted over several sub-buckets, whose minimums are combined afterwards.
+
+Candidate pairs are verified by shingling every candidate once into an `array<int>` of hashes,
+joining the arrays onto the pairs, and computing the exact Jaccard similarity of each batch of
+pairs with `utils.jaccard.pair_jaccard` in a `mapInPandas` UDF.
+
+The best document of every cluster is picked with a window function over native columns, in the
+order of `utils.ranking`.
+
+Connected components use the large-star/small-star iterations of "Connected Components in
+MapReduce and Beyond" (Kiveris et al., 2014) on DataFrames, with window minimums instead of
+grouping the neighbors of every node into Python lists.
+
+The output is written by `write_parquet` in files of a target size, estimated from a sample.
+"""
+from __future__ import annotations
+
+import json
+from itertools import count
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+import pyspark
+from pyspark.sql import Column
+from pyspark.sql import DataFrame
+from pyspark.sql import Window
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+from pyspark.sql.utils import AnalysisException
+
+from utils.bucketing import band_table
+from utils.jaccard import pair_jaccard
+from utils.ranking import LICENSE_ORDER
+from utils.signature_store import check_metadata
+
+BAND_SCHEMA = "band int, band_hash binary, __id__ long"
+SIGNATURE_SCHEMA = "__hash__ long, __length__ int, signature array<int>"
+SIGNATURE_METADATA = "_signature_metadata"
+SHINGLE_SCHEMA = "__id__ long, shingles array<int>"
+EDGE_SCHEMA = "src long, dst long, band int"
+
+
+def band_frames(
+    frames: Iterator[pd.DataFrame],
+    column: str,
+    signature: Callable[[str], np.ndarray],
+    hashranges: List[Tuple[int, int]],
+    band_bits: int = 32,
+) -> Iterator[pd.DataFrame]:
+    """
+    The `mapInPandas` UDF of the bucketing: the `BAND_SCHEMA` rows of every batch of documents.
+
+    Parameters
+    ----------
+    frames : Iterator[pd.DataFrame]
+        The batches of `(__id__, column)` documents.
+    column : str
+        The text column.
+    signature : Callable[[str], np.ndarray]
+        The signature of one document.
+    hashranges : List[Tuple[int, int]]
+        The ranges of hash values of each band.
+    band_bits : int
+        The number of bits per hash value in the band bytes, see `truncate_signatures`.
+
+    Returns
+    -------
+    Iterator[pd.DataFrame]
+        The band rows of every batch.
+    """
+    for frame in frames:
+        if frame.empty:
+            continue
+        signatures = np.stack([signature(content) for content in frame[column]])
+        yield band_table(signatures, frame["__id__"].to_numpy(), hashranges, band_bits).to_pandas()
+
+
+def content_key(column: str) -> List[Column]:
+    """
+    The `(__hash__, __length__)` columns that identify the content of a document across runs.
+
+    Parameters
+    ----------
+    column : str
+        The text column.
+
+    Returns
+    -------
+    List[Column]
+        The key columns.
+    """
+    return [F.xxhash64(column).alias("__hash__"), F.length(column).alias("__length__")]
+
+
+def signature_frames(
+    frames: Iterator[pd.DataFrame], column: str, signature: Callable[[str], np.ndarray]
+) -> Iterator[pd.DataFrame]:
+    """
+    The `mapInPandas` UDF that stores the signatures: the `SIGNATURE_SCHEMA` rows of every batch
+    of documents.
+
+    Parameters
+    ----------
+    frames : Iterator[pd.DataFrame]
+        The batches of `(__hash__, __length__, column)` documents, see `content_key`.
+    column : str
+        The text column.
+    signature : Callable[[str], np.ndarray]
+        The 32-bit signature of one document.
+
+    Returns
+    -------
+    Iterator[pd.DataFrame]
+        The signature rows of every batch.
+    """
+    for frame in frames:
+        if frame.empty:
+            continue
+        yield pd.DataFrame(
+            {
+                "__hash__": frame["__hash__"],
+                "__length__": frame["__length__"],
+                "signature": [signature(content).astype(np.uint32).view(np.int32) for content in frame[column]],
+            }
+        )
+
+
+def stored_band_frames(
+    frames: Iterator[pd.DataFrame], hashranges: List[Tuple[int, int]], band_bits: int = 32
+) -> Iterator[pd.DataFrame]:
+    """
+    The `mapInPandas` UDF of the bucketing of stored signatures, see `band_frames`.
+
+    Parameters
+    ----------
+    frames : Iterator[pd.DataFrame]
+        The batches of `(__id__, signature)` rows, see `document_signatures`.
+    hashranges : List[Tuple[int, int]]
+        The ranges of hash values of each band.
+    band_bits : int
+        The number of bits per hash value in the band bytes, see `truncate_signatures`.
+
+    Returns
+    -------
+    Iterator[pd.DataFrame]
+        The band rows of every batch.
+    """
+    for frame in frames:
+        if frame.empty:
+            continue
+        signatures = np.stack(frame["signature"]).astype(np.int32).view(np.uint32)
+        yield band_table(signatures, frame["__id__"].to_numpy(), hashranges, band_bits).to_pandas()
+
+
+def write_signature_metadata(spark: SparkSession, path: str, metadata: Dict[str, Any]):
+    """
+    Record the parameters of the signatures stored in `path`, after the signatures themselves.
+
+    Parameters
+    ----------
+    spark : SparkSession
+        The Spark session.
+    path : str
+        The directory of the `SIGNATURE_SCHEMA` Parquet files.
+    metadata : Dict[str, Any]
+        The parameters, see `utils.signature_store.store_metadata`.
+    """
+    spark.createDataFrame([(json.dumps(metadata),)], schema="value string").coalesce(1).write.mode("overwrite").text(
+        f"{path}/{SIGNATURE_METADATA}"
+    )
+
+
+def check_signature_metadata(spark: SparkSession, path: str, metadata: Dict[str, Any]):
+    """
+    Refuse to band the signatures stored in `path` if they were produced differently.
+
+    Parameters
+    ----------
+    spark : SparkSession
+        The Spark session.
+    path : str
+        The directory of the `SIGNATURE_SCHEMA` Parquet files.
+    metadata : Dict[str, Any]
+        The parameters of the current run. Only its keys are compared.
+
+    Raises
+    ------
+    ValueError
+        If the parameters are missing, or any of them differs.
+    """
+    try:
+        stored = spark.read.text(f"{path}/{SIGNATURE_METADATA}").first()
+    except AnalysisException:
+        stored = None
+    if stored is None:
+        raise ValueError(f"Signatures in {path} have no {SIGNATURE_METADATA}, they are incomplete or too old")
+    check_metadata(path, json.loads(stored["value"]), metadata)
+
+
+def write_signatures(
+    spark: SparkSession,
+    documents: DataFrame,
+    column: str,
+    signature: Callable[[str], np.ndarray],
+    path: str,
+    metadata: Dict[str, Any],
+):
+    """
+    Store the signatures of the documents as `SIGNATURE_SCHEMA` Parquet files, and their
+    parameters last, so an interrupted write is never read back.
+
+    Parameters
+    ----------
+    spark : SparkSession
+        The Spark session.
+    documents : DataFrame
+        The documents, with `column`.
+    column : str
+        The text column.
+    signature : Callable[[str], np.ndarray]
+        The 32-bit signature of one document.
+    path : str
+        The output directory, which is overwritten.
+    metadata : Dict[str, Any]
+        The parameters, see `utils.signature_store.store_metadata`.
+    """
+    documents.select(*content_key(column), column).mapInPandas(
+        lambda frames: signature_frames(frames, column, signature), schema=SIGNATURE_SCHEMA
+    ).write.parquet(path, mode="overwrite", compression="snappy")
+    write_signature_metadata(spark, path, metadata)
+
+
+def read_signatures(spark: SparkSession, path: str, metadata: Dict[str, Any]) -> DataFrame:
+    """
+    Read the signatures stored by `write_signatures`, if they were produced like the current run.
+
+    Parameters
+    ----------
+    spark : SparkSession
+        The Spark session.
+    path : str
+        The directory of the signatures.
+    metadata : Dict[str, Any]
+        The parameters of the current run, see `check_signature_metadata`.
+
+    Returns
+    -------
+    DataFrame
+        The `SIGNATURE_SCHEMA` rows.
+    """
+    check_signature_metadata(spark, path, metadata)
+    return spark.read.parquet(path)
+
+
+def document_signatures(signatures: DataFrame, documents: DataFrame, column: str) -> DataFrame:
+    """
+    Match the stored signatures to the documents by content, see `content_key`. Exact copies share
+    a signature, so the signatures may have been stored with or without exact deduplication.
+
+    Parameters
+    ----------
+    signatures : DataFrame
+        The `SIGNATURE_SCHEMA` rows.
+    documents : DataFrame
+        The documents, with `__id__` and `column`.
+    column : str
+        The text column.
+
+    Returns
+    -------
+    DataFrame
+        The `(__id__, signature)` of every document, where the signature is null if the content of
+        the document was not stored.
+    """
+    return (
+        documents.select("__id__", *content_key(column))
+        .join(signatures.dropDuplicates(["__hash__", "__length__"]), on=["__hash__", "__length__"], how="left")
+        .select("__id__", "signature")
+    )
+
+
+def heavy_buckets(sample: DataFrame, fraction: float, min_size: int) -> DataFrame:
+    """
+    Estimate the buckets with at least `min_size` documents from the bands of a sample of them.
+
+    Parameters
+    ----------
+    sample : DataFrame
+        The `BAND_SCHEMA` rows of a sample of the documents.
+    fraction : float
+        The sampled fraction of the documents.
+    min_size : int
+        The estimated size from which a bucket is heavy.
+
+    Returns
+    -------
+    DataFrame
+        The `(band, band_hash)` of the heavy buckets.
+    """
+    return (
+        sample.groupBy("band", "band_hash")
+        .count()
+        .filter(F.col("count") >= min_size * fraction)
+        .select("band", "band_hash")
+    )
+
+
+def bucket_table(bands: DataFrame, heavy: DataFrame | None = None, num_salts: int = 64) -> DataFrame:
+    """
+    Group the band rows into buckets. The members of a heavy bucket are spread over `num_salts`
+    sub-buckets by a hash of their id, so no task holds a whole heavy bucket. The minimum and the
+    size of the whole bucket are aggregated from its sub-buckets without their members, and
+    broadcast back onto them.
+
+    Parameters
+    ----------
+    bands : DataFrame
+        The `BAND_SCHEMA` rows.
+    heavy : DataFrame | None
+        The `(band, band_hash)` of the heavy buckets, see `heavy_buckets`, or None.
+    num_salts : int
+        The number of sub-buckets of a heavy bucket.
+
+    Returns
+    -------
+    DataFrame
+        The `(band, band_hash, dst, __ids__, __size__)` (sub-)buckets of more than one document,
+        where `dst` is the smallest id and `__size__` the size of the whole bucket.
+    """
+    flagged = bands.withColumn("__heavy__", F.lit(False))
+    if heavy is not None:
+        flagged = bands.join(
+            F.broadcast(heavy.select("band", "band_hash", F.lit(True).alias("__heavy__"))),
+            on=["band", "band_hash"],
+            how="left",
+        ).fillna(False, subset=["__heavy__"])
+    salt = F.when(F.col("__heavy__"), F.pmod(F.xxhash64("__id__"), F.lit(num_salts))).otherwise(F.lit(0))
+    buckets = (
+        flagged.withColumn("__salt__", salt)
+        .groupBy("band", "band_hash", "__heavy__", "__salt__")
+        .agg(F.min("__id__").alias("dst"), F.collect_list("__id__").alias("__ids__"), F.count("*").alias("__size__"))
+    )
+    if heavy is None:
+        return buckets.filter(F.col("__size__") > 1).select("band", "band_hash", "dst", "__ids__", "__size__")
+    # only heavy buckets have several parts, and a sub-bucket of one document still joins the others. The minimum and
+    # the size of every heavy bucket are one small row, broadcast back onto its sub-buckets, so they stay apart.
+    parts = buckets.filter(F.col("__heavy__"))
+    whole = parts.groupBy("band", "band_hash").agg(F.min("dst").alias("__min__"), F.sum("__size__").alias("__total__"))
+    split = parts.join(F.broadcast(whole), on=["band", "band_hash"]).select(
+        "band", "band_hash", F.col("__min__").alias("dst"), "__ids__", F.col("__total__").alias("__size__")
+    )
+    return (
+        buckets.filter(~F.col("__heavy__"))
+        .select("band", "band_hash", "dst", "__ids__", "__size__")
+        .unionByName(split)
+        .filter(F.col("__size__") > 1)
+    )
+
+
+def band_edges(buckets: DataFrame, max_bucket_size: int | None = None) -> DataFrame:
+    """
+    Link every member of a bucket to the smallest id in it, with native aggregations only. A pair
+    that shares several buckets keeps the first band, like `reduceByKey(min)` did.
+
+    Parameters
+    ----------
+    buckets : DataFrame
+        The buckets, see `bucket_table`.
+    max_bucket_size : int | None
+        Skip the buckets of more documents, or None to keep all of them.
+
+    Returns
+    -------
+    DataFrame
+        The `(src, dst, band)` edges.
+    """
+    if max_bucket_size is not None:
+        buckets = buckets.filter(F.col("__size__") <= max_bucket_size)
+    return (
+        buckets.select(F.explode("__ids__").alias("src"), "dst", "band")
+        .filter(F.col("src") != F.col("dst"))
+        .groupBy("src", "dst")
+        .agg(F.min("band").alias("band"))
+    )
+
+
+def oversized_buckets(buckets: DataFrame, max_bucket_size: int) -> DataFrame:
+    """
+    The buckets skipped by `band_edges`, for a side table.
+
+    Parameters
+    ----------
+    buckets : DataFrame
+        The buckets, see `bucket_table`.
+    max_bucket_size : int
+        The largest bucket size that is kept.
+
+    Returns
+    -------
+    DataFrame
+        The `(band, band_hash, size)` of every skipped bucket.
+    """
+    return (
+        buckets.filter(F.col("__size__") > max_bucket_size)
+        .select("band", "band_hash", F.col("__size__").alias("size"))
+        .distinct()
+    )
+
+
+def candidate_shingles(
+    candidates: DataFrame, documents: DataFrame, column: str, shingles: Callable[[str], np.ndarray]
+) -> DataFrame:
+    """
+    The shingle set of every document of a candidate pair, each shingled once.
+
+    Parameters
+    ----------
+    candidates : DataFrame
+        The `(src, dst, band)` candidate pairs.
+    documents : DataFrame
+        The documents, with `__id__` and `column`.
+    column : str
+        The text column.
+    shingles : Callable[[str], np.ndarray]
+        The sorted unique 32-bit shingle hashes of one document.
+
+    Returns
+    -------
+    DataFrame
+        The `SHINGLE_SCHEMA` rows, with the bits of every hash value in a signed `int`.
+    """
+    ids = (
+        candidates.select(F.col("src").alias("__id__"))
+        .unionByName(candidates.select(F.col("dst").alias("__id__")))
+        .distinct()
+    )
+
+    def shingle_frames(frames: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        for frame in frames:
+            if frame.empty:
+                continue
+            yield pd.DataFrame(
+                {
+                    "__id__": frame["__id__"],
+                    "shingles": [shingles(content).astype(np.uint32).view(np.int32) for content in frame[column]],
+                }
+            )
+
+    return (
+        documents.select("__id__", column)
+        .join(ids, on="__id__", how="left_semi")
+        .mapInPandas(shingle_frames, schema=SHINGLE_SCHEMA)
+    )
+
+
+def jaccard_frames(frames: Iterator[pd.DataFrame], threshold: float) -> Iterator[pd.DataFrame]:
+    """
+    The `mapInPandas` UDF of the verification: the pairs of every batch whose exact Jaccard
+    similarity reaches `threshold`.
+
+    Parameters
+    ----------
+    frames : Iterator[pd.DataFrame]
+        The batches of `(src, dst, band, src_shingles, dst_shingles)` pairs.
+    threshold : float
+        The minimum Jaccard similarity.
+
+    Returns
+    -------
+    Iterator[pd.DataFrame]
+        The `EDGE_SCHEMA` rows of the similar pairs.
+    """
+    for frame in frames:
+        if frame.empty:
+            continue
+        sets = list(frame["src_shingles"]) + list(frame["dst_shingles"])
+        sizes = np.array([len(values) for values in sets], dtype=np.int64)
+        values = np.concatenate([np.asarray(values, dtype=np.int32) for values in sets]).view(np.uint32)
+        pairs = np.arange(len(frame))
+        similarity = pair_jaccard(values, np.r_[0, np.cumsum(sizes)], pairs, pairs + len(frame))
+        yield frame.loc[similarity >= threshold, ["src", "dst", "band"]]
+
+
+def verified_edges(candidates: DataFrame, shingles: DataFrame, threshold: float) -> DataFrame:
+    """
+    The candidate pairs whose exact Jaccard similarity reaches `threshold`.
+
+    Parameters
+    ----------
+    candidates : DataFrame
+        The `(src, dst, band)` candidate pairs.
+    shingles : DataFrame
+        The shingles of the candidates, see `candidate_shingles`. They are read twice, so they
+        should be persisted.
+    threshold : float
+        The minimum Jaccard similarity.
+
+    Returns
+    -------
+    DataFrame
+        The `(src, dst, band)` verified pairs.
+    """
+    return (
+        candidates.join(shingles.select(F.col("__id__").alias("src"), F.col("shingles").alias("src_shingles")), "src")
+        .join(shingles.select(F.col("__id__").alias("dst"), F.col("shingles").alias("dst_shingles")), "dst")
+        .select("src", "dst", "band", "src_shingles", "dst_shingles")
+        .mapInPandas(lambda frames: jaccard_frames(frames, threshold), schema=EDGE_SCHEMA)
+    )
+
+
+def duplicates_of_reference(bands: DataFrame, reference_bands: DataFrame, exact_edges: DataFrame) -> DataFrame:
+    """
+    The new documents that share a bucket with a reference corpus, and their exact copies. Only the
+    distinct band keys of the reference are shuffled, and the new bands are semi-joined on them.
+
+    Parameters
+    ----------
+    bands : DataFrame
+        The `BAND_SCHEMA` rows of the new documents.
+    reference_bands : DataFrame
+        The `BAND_SCHEMA` rows of the reference corpus.
+    exact_edges : DataFrame
+        The `(src, dst, band)` edges from every exact copy to its first copy, which is the one banded.
+
+    Returns
+    -------
+    DataFrame
+        The `__id__` of the new documents to drop.
+    """
+    keys = reference_bands.select("band", "band_hash").distinct()
+    collisions = bands.join(keys, on=["band", "band_hash"], how="left_semi").select("__id__")
+    copies = exact_edges.join(collisions.select(F.col("__id__").alias("dst")), on="dst", how="left_semi")
+    return collisions.unionByName(copies.select(F.col("src").alias("__id__"))).distinct()
+
+
+def rank_order() -> List[Column]:
+    """
+    The ranking of `utils.ranking` as sort columns, best first: the most permissive license, the
+    most stars, the most forks, the latest revision and the latest visit. Ties go to the smallest id.
+
+    Returns
+    -------
+    List[Column]
+        The sort columns.
+    """
+    license_rank = F.lit(len(LICENSE_ORDER))
+    for i, license_type in reversed(list(enumerate(LICENSE_ORDER))):
+        license_rank = F.when(F.col("license_type") == license_type, F.lit(i)).otherwise(license_rank)
+    return [
+        license_rank.asc(),
+        F.coalesce(F.col("star_events_count"), F.lit(0)).desc(),
+        F.coalesce(F.col("fork_events_count"), F.lit(0)).desc(),
+        F.col("revision_date").desc_nulls_last(),
+        F.col("visit_date").desc_nulls_last(),
+        F.col("__id__").asc(),
+    ]
+
+
+def best_duplicates(duplicates: DataFrame) -> DataFrame:
+    """
+    The best document of every component, with `row_number()` over a window per component, so the
+    comparisons run in the JVM.
+
+    Parameters
+    ----------
+    duplicates : DataFrame
+        The documents of the components, with `__id__`, `__component__` and the ranking columns.
+
+    Returns
+    -------
+    DataFrame
+        The `__id__` of the best document of every component.
+    """
+    window = Window.partitionBy("__component__").orderBy(*rank_order())
+    return (
+        duplicates.withColumn("__rank__", F.row_number().over(window))
+        .filter(F.col("__rank__") == 1)
+        .select("__id__")
+    )
+
+
+def large_star(edges: DataFrame) -> DataFrame:
+    """
+    Link every neighbor larger than a node to the smallest node of its neighborhood.
+
+    Parameters
+    ----------
+    edges : DataFrame
+        The `(src, dst)` edges.
+
+    Returns
+    -------
+    DataFrame
+        The new `(src, dst)` edges.
+    """
+    both = edges.unionByName(edges.select(F.col("dst").alias("src"), F.col("src").alias("dst")))
+    smallest = F.least(F.col("src"), F.min("dst").over(Window.partitionBy("src")))
+    return (
+        both.select("src", "dst", smallest.alias("__min__"))
+        .filter(F.col("dst") > F.col("src"))
+        .select(F.col("dst").alias("src"), F.col("__min__").alias("dst"))
+        .distinct()
+    )
+
+
+def small_star(edges: DataFrame) -> DataFrame:
+    """
+    Link every node and its smaller neighbors to the smallest of them.
+
+    Parameters
+    ----------
+    edges : DataFrame
+        The `(src, dst)` edges.
+
+    Returns
+    -------
+    DataFrame
+        The new `(src, dst)` edges.
+    """
+    oriented = edges.select(F.greatest("src", "dst").alias("src"), F.least("src", "dst").alias("dst"))
+    stars = oriented.withColumn("__min__", F.min("dst").over(Window.partitionBy("src")))
+    return (
+        stars.select(F.col("dst").alias("src"), F.col("__min__").alias("dst"))
+        .unionByName(stars.select("src", F.col("__min__").alias("dst")))
+        .filter(F.col("src") != F.col("dst"))
+        .distinct()
+    )
+
+
+def connected_components(edges: DataFrame, checkpoint_interval: int = 5) -> DataFrame:
+    """
+    Alternate large-star and small-star rounds until the edges stop changing. Convergence is
+    tested with a distributed count of the changed edges, every round is persisted and the
+    previous one released, and the lineage is cut by a checkpoint every few rounds, so it does
+    not grow with the number of rounds. The checkpoint directory of the Spark context must be set.
+
+    Parameters
+    ----------
+    edges : DataFrame
+        The `(src, dst)` edges.
+    checkpoint_interval : int
+        The number of rounds between two checkpoints.
+
+    Returns
+    -------
+    DataFrame
+        The `(__id__, component)` of every node that is not the smallest of its component, where
+        the component is that smallest node. It is persisted.
+    """
+    current = edges.select("src", "dst").distinct().persist(pyspark.StorageLevel.DISK_ONLY)
+    for iteration in count(1):
+        updated = small_star(large_star(current))
+        if iteration % checkpoint_interval == 0:
+            updated = updated.checkpoint()
+        updated = updated.persist(pyspark.StorageLevel.DISK_ONLY)
+        changes = (
+            updated.join(current, on=["src", "dst"], how="left_anti").count()
+            + current.join(updated, on=["src", "dst"], how="left_anti").count()
+        )
+        current.unpersist()
+        current = updated
+        if changes == 0:
+            break
+    return current.select(F.col("src").alias("__id__"), F.col("dst").alias("component"))
+
+
+def write_parquet(
+    df: DataFrame,
+    output: str,
+    num_rows: int,
+    target_file_mb: int = 256,
+    row_group_mb: int = 128,
+    compression: str = "snappy",
+    sample_rows: int = 1000,
+    range_column: str | None = None,
+):
+    """
+    Write a DataFrame into Parquet files of about `target_file_mb` each. The bytes per row are
+    estimated from the first `sample_rows` rows, which Spark reads from as few partitions as it
+    can, so the estimate is not another pass over the rows. The JSON size of a row is only a rough
+    proxy of its Parquet size: it is about the uncompressed size, it ignores the column encodings,
+    and the first rows may not look like the others. Fewer files than partitions are coalesced
+    without a shuffle, more files are range-partitioned on `range_column`, or spread evenly
+    without one.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The rows to write.
+    output : str
+        The output directory, which is overwritten.
+    num_rows : int
+        The number of rows, which the callers already counted.
+    target_file_mb : int
+        The target size of each file, in MB before compression.
+    row_group_mb : int
+        The Parquet row group size, in MB.
+    compression : str
+        The Parquet codec, snappy or zstd.
+    sample_rows : int
+        The number of rows the bytes per row are estimated from.
+    range_column : str | None
+        The column to range-partition on, or None.
+    """
+    sample = df.select(F.octet_length(F.to_json(F.struct(*df.columns))).alias("bytes")).take(sample_rows)
+    num_files = 1
+    if sample:
+        row_bytes = sum(row["bytes"] for row in sample) / len(sample)
+        num_files = max(1, int(np.ceil(num_rows * row_bytes / (target_file_mb * 2**20))))
+    if num_files <= df.rdd.getNumPartitions():
+        df = df.coalesce(num_files)
+    elif range_column is not None:
+        df = df.repartitionByRange(num_files, range_column)
+    else:
+        df = df.repartition(num_files)
+    (
+        df.write.option("compression", compression)
+        .option("parquet.block.size", row_group_mb * 2**20)
+        .parquet(output, mode="overwrite")
+    )